@@ -1,17 +1,65 @@
 import os
 import json
 import datetime
+import logging
+import gzip
+import mmap
+import hashlib
+import io
 import uuid
-from collections import defaultdict
+import atexit
+import bisect
+import itertools
+import math
+import random
+import re
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import unicodedata
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout, as_completed
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from urllib.request import url2pathname
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from slugify import slugify
 
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+from flask import Flask, Response, render_template, request, jsonify, redirect, send_file, url_for
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+import numpy as np
 import pandas as pd
 import openpyxl
 from openpyxl import Workbook, load_workbook
 from openpyxl.worksheet.datavalidation import DataValidation
-import tempfile
+
+try:
+    import fcntl
+except ImportError:  # Windows dev machines: workers are not forked there
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:  # optional: responses fall back to gzip
+    brotli = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional: without Pillow images are cached but not resized
+    Image = ImageOps = None
+
+try:
+    import pyarrow
+except ImportError:  # optional: only needed for Parquet report downloads
+    pyarrow = None
 
 app = Flask(__name__)
 
@@ -19,6 +67,10 @@ app = Flask(__name__)
 FB_ACCESS_TOKEN = os.getenv('FBACCSESSTOKEN', 'your_access_token_here')
 ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', 'admin123')
 
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s')
+logger = logging.getLogger('argento')
+
 BUSINESS_CATALOGS = {
     'CASTELPHARMA': '1341574140528980',  # castel pharma
     'FOFO': '1816910538949001',  # fofo
@@ -143,143 +195,1710 @@ CATALOG_SENDERS = {
     }
 }
 
+# Instrumentation: span() times a block of work. Inside a request the spans are
+# sent back in the Server-Timing header; everywhere they feed the histograms
+# served by /metrics. Each process keeps its own histograms and dumps them to
+# METRICS_DIR, so /metrics on any worker reports the whole server.
+METRICS_DIR = 'data/metrics'
+METRICS_EXITED_PATH = os.path.join(METRICS_DIR, 'exited.json')  # folded totals of workers that have exited
+METRICS_LOCK_PATH = os.path.join(METRICS_DIR, 'metrics.lock')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+METRIC_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# name -> (help, label names); every metric is a histogram in seconds
+METRICS = {
+    'argento_request_seconds': ('Request latency by endpoint, method and status', ('endpoint', 'method', 'status')),
+    'argento_span_seconds': ('Time spent in instrumented spans', ('span',)),
+}
+SLOW_REQUEST_MS = float(os.getenv('SLOW_REQUEST_MS', '1000'))
+# Opt-in stack sampling: share of requests (0-1) whose stacks are sampled every
+# PROFILE_INTERVAL_MS; samples of requests slower than SLOW_REQUEST_MS are kept
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL_MS', '5')) / 1000
+PROFILE_DIR = 'data/profiles'
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '50'))
+
+# series values: per-bucket counts (the last one is +Inf), then sum and count
+_metrics = {'pid': None, 'path': None, 'series': {}, 'dirty': False, 'flusher': None, 'lock': threading.Lock()}
+_request_timing = threading.local()
+_profiler = {'pid': None, 'thread': None, 'wake': None, 'active': {}, 'lock': threading.Lock()}
+# Called with a record dict for every slow request (after it is logged)
+SLOW_REQUEST_HOOKS = []
+
+def _metric_series():
+    """This process's series; forked workers start empty instead of re-reporting the master's"""
+    if _metrics['pid'] != os.getpid():
+        _metrics.update(pid=os.getpid(), series={}, dirty=False,
+                        path=os.path.join(METRICS_DIR, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.json"),
+                        flusher=threading.Thread(target=_metrics_flusher, name='metrics-flush', daemon=True))
+        _metrics['flusher'].start()
+    return _metrics['series']
+
+def _metrics_flusher():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        flush_metrics()
+
+def observe(metric, labels, seconds):
+    """Add one observation to a histogram series"""
+    with _metrics['lock']:
+        series = _metric_series()
+        values = series.get((metric, labels))
+        if values is None:
+            values = series[(metric, labels)] = [0] * (len(METRIC_BUCKETS) + 3)
+        values[bisect.bisect_left(METRIC_BUCKETS, seconds)] += 1
+        values[-2] += seconds
+        values[-1] += 1
+        _metrics['dirty'] = True
+
+@contextmanager
+def span(name):
+    """Time a block into argento_span_seconds and the current request's Server-Timing"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        observe('argento_span_seconds', (name,), elapsed)
+        spans = getattr(_request_timing, 'spans', None)
+        if spans is not None:
+            spans.append((name, elapsed))
+
+def flush_metrics():
+    """Dump this process's series to METRICS_DIR if they changed (every METRICS_FLUSH_INTERVAL from the flusher thread)"""
+    with _metrics['lock']:
+        if _metrics['pid'] != os.getpid() or not _metrics['dirty']:
+            return
+        payload = [[metric, list(labels), list(values)] for (metric, labels), values in _metrics['series'].items()]
+        path = _metrics['path']
+        _metrics['dirty'] = False
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'pid': os.getpid(), 'series': payload}, f)
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.warning("Could not write metrics to %s: %s", path, e)
+
+atexit.register(flush_metrics)
+
+def _reset_instrumentation_after_fork():
+    # The master (preload_app) may fork while its flusher or sampler holds a
+    # lock; the child gets fresh locks and starts its own threads on first use
+    _metrics.update(pid=None, series={}, dirty=False, flusher=None, lock=threading.Lock())
+    _profiler.update(pid=None, thread=None, wake=None, active={}, lock=threading.Lock())
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_instrumentation_after_fork)
+
+def _read_metric_file(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f).get('series', [])
+    except (OSError, ValueError):
+        return []
+
+def _merge_series(merged, series):
+    for metric, labels, values in series:
+        if metric not in METRICS or len(values) != len(METRIC_BUCKETS) + 3:
+            continue  # written with other buckets by an older deploy
+        total = merged.setdefault((metric, tuple(labels)), [0] * len(values))
+        for i, value in enumerate(values):
+            total[i] += value
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass  # exists but belongs to someone else
+    return True
+
+def _fold_exited_metrics():
+    """Move the dumps of exited workers into METRICS_EXITED_PATH so recycled workers don't pile up files"""
+    if fcntl is None:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    lock_fd = os.open(METRICS_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        exited = [name for name in os.listdir(METRICS_DIR)
+                  if name.endswith('.json') and name.split('-', 1)[0].isdigit()
+                  and not _process_alive(int(name.split('-', 1)[0]))]
+        if not exited:
+            return
+        merged = {}
+        _merge_series(merged, _read_metric_file(METRICS_EXITED_PATH))
+        for name in exited:
+            _merge_series(merged, _read_metric_file(os.path.join(METRICS_DIR, name)))
+        temp_path = METRICS_EXITED_PATH + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'series': [[metric, list(labels), values] for (metric, labels), values in merged.items()]}, f)
+        os.replace(temp_path, METRICS_EXITED_PATH)
+        for name in exited:
+            os.remove(os.path.join(METRICS_DIR, name))
+    finally:
+        os.close(lock_fd)
+
+def collect_metrics():
+    """{(metric, labels): values} summed over every process of this server"""
+    flush_metrics()
+    _fold_exited_metrics()
+    merged = {}
+    try:
+        names = os.listdir(METRICS_DIR)
+    except OSError:
+        names = []
+    for name in names:
+        if name.endswith('.json'):
+            _merge_series(merged, _read_metric_file(os.path.join(METRICS_DIR, name)))
+    return merged
+
+def _metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_metrics(merged, gauges=()):
+    """Prometheus text exposition of collect_metrics() plus (name, help, value) gauges"""
+    lines = []
+    for metric, (help_text, label_names) in METRICS.items():
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} histogram")
+        for (name, labels), values in sorted(merged.items()):
+            if name != metric:
+                continue
+            base = ','.join(f'{k}="{_metric_label(v)}"' for k, v in zip(label_names, labels))
+            cumulative = 0
+            for le, count in zip(METRIC_BUCKETS + (None,), values):
+                cumulative += count
+                lines.append(f'{metric}_bucket{{{base},le="{"+Inf" if le is None else f"{le:g}"}"}} {cumulative}')
+            lines.append(f"{metric}_sum{{{base}}} {values[-2]:.6f}")
+            lines.append(f"{metric}_count{{{base}}} {values[-1]}")
+    for name, help_text, value in gauges:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return '\n'.join(lines) + '\n'
+
+def _collapsed_stack(frame):
+    """'module:func;module:func;...:line' from the outermost call to frame (flamegraph input)"""
+    line = frame.f_lineno
+    names = []
+    while frame is not None and len(names) < 128:
+        names.append(f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names)) + f":{line}"
+
+def _profile_sampler():
+    wake = _profiler['wake']
+    while True:
+        with _profiler['lock']:
+            active = dict(_profiler['active'])
+            if not active:
+                wake.clear()
+        if not active:
+            wake.wait()
+            continue
+        frames = sys._current_frames()
+        with _profiler['lock']:
+            for thread_id, samples in active.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    samples[_collapsed_stack(frame)] += 1
+        del frames
+        time.sleep(PROFILE_INTERVAL)
+
+def start_request_profile():
+    """Sample this thread's stacks for the rest of the request, for PROFILE_SAMPLE_RATE of requests"""
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE:
+        return
+    with _profiler['lock']:
+        if _profiler['thread'] is None or _profiler['pid'] != os.getpid() or not _profiler['thread'].is_alive():
+            _profiler.update(pid=os.getpid(), wake=threading.Event(), active={})
+            _profiler['thread'] = threading.Thread(target=_profile_sampler, name='request-profiler', daemon=True)
+            _profiler['thread'].start()
+        _profiler['active'][threading.get_ident()] = Counter()
+        _profiler['wake'].set()
+
+def stop_request_profile():
+    """Stop sampling this thread; returns its Counter of collapsed stacks (None if not sampled)"""
+    if _profiler['pid'] != os.getpid():
+        return None
+    with _profiler['lock']:
+        return _profiler['active'].pop(threading.get_ident(), None)
+
+def save_request_profile(record):
+    """Slow request hook: write sampled stacks to PROFILE_DIR in collapsed format, keeping PROFILE_KEEP files"""
+    if not record.get('profile'):
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    stamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    path = os.path.join(PROFILE_DIR, f"{stamp}-{record['endpoint']}-{os.getpid()}.txt")
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"# {record['method']} {record['path']} {record['status']} {record['duration_ms']}ms\n")
+        for stack, count in record['profile'].most_common():
+            f.write(f"{stack} {count}\n")
+    for name in sorted(os.listdir(PROFILE_DIR))[:-PROFILE_KEEP or None]:
+        os.remove(os.path.join(PROFILE_DIR, name))
+    logger.info("Saved profile of slow request to %s", path)
+
+SLOW_REQUEST_HOOKS.append(save_request_profile)
+
+@app.before_request
+def _start_request_timing():
+    _request_timing.spans = []
+    _request_timing.started = time.perf_counter()
+    start_request_profile()
+
+@app.after_request
+def _finish_request_timing(response):
+    spans = getattr(_request_timing, 'spans', None)
+    if spans is None:
+        return response
+    elapsed = time.perf_counter() - _request_timing.started
+    totals = {}
+    for name, seconds in spans:
+        totals[name] = totals.get(name, 0.0) + seconds
+    entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in totals.items()]
+    entries.append(f"app;dur={elapsed * 1000:.2f}")
+    response.headers['Server-Timing'] = ', '.join(entries)
+    endpoint = request.endpoint or 'unmatched'
+    observe('argento_request_seconds', (endpoint, request.method, str(response.status_code)), elapsed)
+    profile = stop_request_profile()
+    if elapsed * 1000 >= SLOW_REQUEST_MS:
+        record = {'method': request.method, 'path': request.path, 'endpoint': endpoint,
+                  'status': response.status_code, 'duration_ms': round(elapsed * 1000, 3),
+                  'spans': {name: round(seconds * 1000, 3) for name, seconds in totals.items()}, 'profile': profile}
+        logger.warning("Slow request %s %s -> %s in %.1fms: %s", request.method, request.path,
+                       response.status_code, elapsed * 1000, response.headers['Server-Timing'])
+        for hook in SLOW_REQUEST_HOOKS:
+            try:
+                hook(record)
+            except Exception:
+                logger.exception("Slow request hook %r failed", hook)
+    return response
+
+@app.teardown_request
+def _clear_request_timing(exc):
+    _request_timing.spans = None
+    stop_request_profile()
+
+ADDRESSES_PATH = 'addresses.xlsx'
+# Compiled city -> areas mapping, keyed by the sha256 of addresses.xlsx
+CITY_AREA_CACHE_PATH = 'data/city_areas.cache.json'
+CITY_AREA_VERSION = None  # sha256 of the addresses.xlsx CITY_AREA_DICT was built from
+_city_area_signature = None
+_city_area_lock = threading.Lock()
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _parse_city_areas(path):
+    """Read city -> areas from the 'Speedaf standard address data' sheet"""
+    cities = {}
+    wb = load_workbook(path, read_only=True)
+    try:
+        if 'Speedaf standard address data' not in wb.sheetnames:
+            logger.warning("Sheet 'Speedaf standard address data' not found in %s", path)
+            return {}
+        sheet = wb['Speedaf standard address data']
+        header = [value for value in next(sheet.iter_rows(max_row=1, values_only=True), ()) if value]
+        if 'City' not in header or 'Area' not in header:
+            logger.warning("City or Area column not found in header of %s", path)
+            return {}
+        city_idx = header.index('City')
+        area_idx = header.index('Area')
+        for row in sheet.iter_rows(min_row=2, values_only=True):
+            city = row[city_idx]
+            area = row[area_idx]
+            if city and area:
+                # dict keys as an ordered set: O(1) dedupe, first-seen order kept
+                cities.setdefault(str(city).strip(), {})[str(area).strip()] = None
+    finally:
+        wb.close()
+    return {city: list(areas) for city, areas in cities.items()}
+
 def load_city_area_dict():
-    """Load city to areas mapping from addresses.xlsx"""
-    global CITY_AREA_DICT
-    CITY_AREA_DICT = defaultdict(list)
-    if os.path.exists('addresses.xlsx'):
+    """Load city to areas mapping, from the compiled cache when addresses.xlsx is unchanged"""
+    global CITY_AREA_DICT, CITY_AREA_VERSION, _city_area_signature
+    try:
+        st = os.stat(ADDRESSES_PATH)
+    except OSError:
+        logger.warning("%s file not found", ADDRESSES_PATH)
+        CITY_AREA_DICT, CITY_AREA_VERSION, _city_area_signature = {}, None, None
+        return
+    cities = None
+    try:
+        source_hash = _file_sha256(ADDRESSES_PATH)
         try:
-            wb = load_workbook('addresses.xlsx')
-            if 'Speedaf standard address data' in wb.sheetnames:
-                sheet = wb['Speedaf standard address data']
-                header = [cell.value for cell in sheet[1] if cell.value]
-                print(f"Header found: {header}")
-                if 'City' in header and 'Area' in header:
-                    city_idx = header.index('City')
-                    area_idx = header.index('Area')
-                    for row in sheet.iter_rows(min_row=2):
-                        city = row[city_idx].value
-                        area = row[area_idx].value
-                        if city and area:
-                            city_key = str(city).strip()
-                            area_value = str(area).strip()
-                            if area_value not in CITY_AREA_DICT[city_key]:
-                                CITY_AREA_DICT[city_key].append(area_value)
-                else:
-                    print("City or Area column not found in header")
-            else:
-                print("Sheet 'Speedaf standard address data' not found")
-        except Exception as e:
-            print(f"Error loading addresses.xlsx: {e}")
+            with open(CITY_AREA_CACHE_PATH, 'r', encoding='utf-8') as f:
+                cached = json.load(f)
+            if cached.get('source_hash') == source_hash:
+                cities = cached['cities']
+        except (OSError, ValueError, KeyError):
+            pass
+        if cities is None:
+            cities = _parse_city_areas(ADDRESSES_PATH)
+            os.makedirs(os.path.dirname(CITY_AREA_CACHE_PATH), exist_ok=True)
+            temp_path = CITY_AREA_CACHE_PATH + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'source_hash': source_hash, 'cities': cities}, f, ensure_ascii=False)
+            os.replace(temp_path, CITY_AREA_CACHE_PATH)
+            logger.info("Compiled city/area cache from %s", ADDRESSES_PATH)
+    except Exception as e:
+        logger.error("Error loading %s: %s", ADDRESSES_PATH, e)
+        # Remember the broken file too, so it is not re-read on every request
+        CITY_AREA_DICT, CITY_AREA_VERSION, _city_area_signature = {}, None, (st.st_mtime_ns, st.st_size)
+        return
+    CITY_AREA_DICT = cities
+    CITY_AREA_VERSION = source_hash
+    _city_area_signature = (st.st_mtime_ns, st.st_size)
+    logger.info("Loaded %d cities with areas", len(CITY_AREA_DICT))
+
+def get_city_area_dict():
+    """Return CITY_AREA_DICT, reloading it if addresses.xlsx changed on disk"""
+    try:
+        st = os.stat(ADDRESSES_PATH)
+        signature = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        signature = None
+    if signature != _city_area_signature:
+        with _city_area_lock:
+            if signature != _city_area_signature:
+                load_city_area_dict()
+    return CITY_AREA_DICT
+
+# City normalization: every spelling a customer or sheet might use (Speedaf
+# keys, English variants, Arabic, area names) resolves to one canonical city,
+# the key used by SHIPPING_PRICES and CITY_AREA_DICT. Governorate names map
+# to a city with the same shipping rate.
+CITY_ALIASES = {
+    'AinShams': ['Ain Shams', 'عين شمس'],
+    'Al-agamy': ['Agamy', 'El Agamy', 'العجمي'],
+    'Alex': ['Alexandria', 'الإسكندرية', 'اسكندرية'],
+    'Aswan': ['أسوان'],
+    'Asyut': ['Assiut', 'Assiout', 'أسيوط'],
+    'Badrashin': ['Badrasheen', 'البدرشين'],
+    'Abu Tesht': ['أبو تشت'],
+    'Farshut': ['فرشوط'],
+    'Dar El-Salam': ['دار السلام'],
+    'Al Balena': ['Balyana', 'البلينا'],
+    'Gerga': ['Girga', 'جرجا'],
+    'Banha': ['Benha', 'Qalyubia', 'بنها', 'القليوبية'],
+    'Behira': ['Beheira', 'البحيرة', 'دمنهور'],
+    'BeniSuef': ['Beni Suef', 'بني سويف'],
+    'Helwan': ['حلوان'],
+    'Damietta': ['دمياط'],
+    'Dekernes': ['دكرنس'],
+    'Desouk': ['دسوق'],
+    'Dokki': ['Giza', 'الدقي', 'الجيزة'],
+    'Downtown': ['Cairo', 'وسط البلد', 'القاهرة'],
+    'Abu Sinbil': ['Abu Simbel', 'أبو سمبل'],
+    'Administrative Capital': ['New Capital', 'العاصمة الإدارية'],
+    'New Heliopolis City': ['هليوبوليس الجديدة'],
+    'Zaafarana': ['الزعفرانة'],
+    'Shalateen': ['الشلاتين'],
+    'Marsa Alam': ['مرسى علم'],
+    'Halaib': ['حلايب'],
+    'Sallum': ['السلوم'],
+    'Siwa Oasis': ['Siwa', 'سيوة', 'واحة سيوة'],
+    'Sidi Barrani': ['سيدي براني'],
+    'Farafra': ['الفرافرة'],
+    'Dakhla': ['الداخلة'],
+    'Kharga': ['New Valley', 'الخارجة', 'الوادي الجديد'],
+    'Sharm El-Sheikh': ['South Sinai', 'شرم الشيخ', 'جنوب سيناء'],
+    'Abu Radis': ['أبو رديس'],
+    'Ain Sokhna': ['Sokhna', 'العين السخنة'],
+    'Faiyum': ['Fayoum', 'الفيوم'],
+    'Faqus': ['فاقوس'],
+    'Fardos': ['الفردوس'],
+    'Faisal': ['فيصل'],
+    'Haram': ['Pyramids', 'الهرم'],
+    'Hurghada': ['Red Sea', 'الغردقة', 'البحر الأحمر'],
+    'Ismailia': ['الإسماعيلية'],
+    'Kafr El-Sheikh': ['كفر الشيخ'],
+    'Khanka': ['الخانكة'],
+    'Luxor': ['الأقصر'],
+    'Maadi': ['المعادي'],
+    'Mahala': ['Mahalla', 'El Mahalla El Kubra', 'المحلة', 'المحلة الكبرى'],
+    'Mansoura': ['Dakahlia', 'المنصورة', 'الدقهلية'],
+    'Dayrout': ['ديروط'],
+    'Al Qusiyyah': ['القوصية'],
+    'Malawi': ['ملوي'],
+    'Dayr Mawas': ['دير مواس'],
+    'Menya': ['Minya', 'المنيا'],
+    'Moharram Bek': ['محرم بك'],
+    'Monufia': ['Menoufia', 'المنوفية', 'شبين الكوم'],
+    'Nasr City': ['مدينة نصر'],
+    'New Cairo': ['Fifth Settlement', 'القاهرة الجديدة', 'التجمع', 'التجمع الخامس'],
+    'Matrouh': ['Marsa Matrouh', 'مطروح', 'مرسى مطروح'],
+    'North Coast': ['الساحل الشمالي'],
+    'Oct6th': ['6th of October', '6 October', 'October', '6 أكتوبر', 'السادس من أكتوبر'],
+    'Port said': ['بورسعيد', 'بور سعيد'],
+    'Qena': ['قنا'],
+    'Sharqia': ['Sharkia', 'الشرقية', 'الزقازيق'],
+    'Shorouk': ['الشروق'],
+    'Shoubara El Khima': ['Shubra El Kheima', 'شبرا الخيمة'],
+    'Sohag': ['سوهاج'],
+    'Suez': ['السويس'],
+    'Tanta': ['Gharbia', 'طنطا', 'الغربية'],
+    'Zayton': ['Zeitoun', 'الزيتون'],
+    '10th of Ramadan City': ['10th of Ramadan', 'العاشر من رمضان'],
+}
+# Distinct spellings remembered per index (typo lookups are the slow path)
+CITY_RESOLVE_CACHE_SIZE = 10000
+
+ARABIC_DIGITS = str.maketrans('٠١٢٣٤٥٦٧٨٩۰۱۲۳۴۵۶۷۸۹', '01234567890123456789')
+_ARABIC_MARKS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')  # harakat and tatweel
+_ARABIC_LETTERS = str.maketrans({'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا', 'ة': 'ه', 'ى': 'ي', 'ئ': 'ي', 'ؤ': 'و'})
+
+CityIndex = namedtuple('CityIndex', 'version names area_keys trigrams resolved')
+_city_index = {'index': None}
+
+_WORD = re.compile(r'[^\W_]+')
+
+def _fold_arabic_text(text):
+    """text with case folded and diacritics/tatweel stripped (letters are folded per word)"""
+    return _ARABIC_MARKS.sub('', unicodedata.normalize('NFKC', str(text or '')).casefold())
+
+def fold_arabic_words(text):
+    """Words of text with case, diacritics, hamza/taa marbuta/alef maqsura and digits folded"""
+    return _WORD.findall(_fold_arabic_text(text).translate(_ARABIC_LETTERS).translate(ARABIC_DIGITS))
+
+def fold_city_name(name):
+    """Comparison key: case, spacing, punctuation, diacritics, hamza/taa marbuta/alef maqsura and 'ال' folded away"""
+    return ''.join(token[2:] if token.startswith('ال') and len(token) > 4 else token
+                   for token in fold_arabic_words(name))
+
+def _trigrams(key):
+    padded = f'  {key} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def build_city_index(cities):
+    """Folded name -> canonical city, from areas, then aliases, then the city keys (later wins)"""
+    owners = {}
+    for city, areas in cities.items():
+        for area in areas:
+            owners.setdefault(fold_city_name(area), set()).add(city)
+    # Area names shared by two cities say nothing about the city
+    names = {key: next(iter(cities_)) for key, cities_ in owners.items() if len(cities_) == 1}
+    primary = set()
+    for city, aliases in CITY_ALIASES.items():
+        for alias in aliases:
+            names[fold_city_name(alias)] = city
+            primary.add(fold_city_name(alias))
+    for city in itertools.chain(SHIPPING_PRICES, cities):
+        names[fold_city_name(city)] = city
+        primary.add(fold_city_name(city))
+    names.pop('', None)
+    trigrams = {}
+    for key in names:
+        for gram in _trigrams(key):
+            trigrams.setdefault(gram, []).append(key)
+    return CityIndex(CITY_AREA_VERSION, names, frozenset(names.keys() - primary), trigrams, {})
+
+def city_index():
+    """CityIndex for the current CITY_AREA_DICT, rebuilt when addresses.xlsx changes"""
+    cities = get_city_area_dict()
+    index = _city_index['index']
+    if index is None or index.version != CITY_AREA_VERSION:
+        index = _city_index['index'] = build_city_index(cities)
+    return index
+
+def _edit_distance(a, b, limit):
+    """Levenshtein distance, or limit + 1 once it is certain to exceed limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+def _closest_city_key(index, key):
+    """Closest indexed name within a quarter of the input's length in edits (cities beat areas on ties)"""
+    shared = Counter(candidate for gram in _trigrams(key) for candidate in index.trigrams.get(gram, ()))
+    limit = max(1, len(key) // 4)
+    best, best_rank = None, (limit + 1, True)
+    for candidate, _ in shared.most_common(10):
+        rank = (_edit_distance(key, candidate, limit), candidate in index.area_keys)
+        if rank < best_rank:
+            best, best_rank = candidate, rank
+    return best if best_rank[0] <= limit else None
+
+def resolve_city(name):
+    """Canonical city (a SHIPPING_PRICES / CITY_AREA_DICT key) for any spelling, or None"""
+    if not name:
+        return None
+    index = city_index()
+    name = str(name)
+    if name in index.resolved:
+        return index.resolved[name]
+    key = fold_city_name(name)
+    city = index.names.get(key)
+    if city is None and len(key) >= 3:
+        closest = _closest_city_key(index, key)
+        city = index.names[closest] if closest else None
+    if len(index.resolved) < CITY_RESOLVE_CACHE_SIZE:
+        index.resolved[name] = city
+    return city
+
+# Pre-encoded /api/city_areas bodies for the current CITY_AREA_VERSION, keyed by city (None = all)
+CITY_AREA_BODIES = {}
+
+def precompress(body):
+    """Encode a response body once: identity, gzip and (if available) brotli, plus a strong ETag"""
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    bodies = {
+        'identity': body,
+        'gzip': gzip.compress(body, compresslevel=9, mtime=0),
+        'etag': hashlib.sha256(body).hexdigest()[:32],
+    }
+    if brotli is not None:
+        bodies['br'] = brotli.compress(body)
+    return bodies
+
+def is_not_modified(etag, last_modified=None):
+    """True if the request's If-None-Match / If-Modified-Since already match"""
+    if request.if_none_match:
+        return etag in request.if_none_match
+    since = request.if_modified_since
+    return bool(last_modified and since and since >= last_modified.replace(microsecond=0))
+
+def precompressed_response(bodies, mimetype='application/json', cache_control='no-cache', last_modified=None):
+    """Serve a precompress() result with ETag/If-None-Match and Accept-Encoding negotiation"""
+    headers = {'ETag': f'"{bodies["etag"]}"', 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if last_modified:
+        headers['Last-Modified'] = http_date(last_modified)
+    if is_not_modified(bodies['etag'], last_modified):
+        return Response(status=304, headers=headers)
+    encoding = 'identity'
+    if 'br' in bodies and request.accept_encodings['br']:
+        encoding = 'br'
+    elif request.accept_encodings['gzip']:
+        encoding = 'gzip'
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(bodies[encoding], mimetype=mimetype, headers=headers)
+
+def city_area_bodies(city=None):
+    """Return the pre-encoded JSON for all cities (or one city), or None if unknown"""
+    cities = get_city_area_dict()
+    version = CITY_AREA_VERSION
+    cached = CITY_AREA_BODIES.get(city)
+    if cached is not None and cached['version'] == version:
+        return cached
+    if city is None:
+        payload = {'ok': True, 'version': version, 'cities': cities}
+    elif city in cities:
+        payload = {'ok': True, 'version': version, 'city': city, 'areas': cities[city]}
     else:
-        print("addresses.xlsx file not found")
-    
-    print(f"Loaded {len(CITY_AREA_DICT)} cities with areas")
-    # Debug: print first few cities
-    if CITY_AREA_DICT:
-        print("Sample cities:", list(CITY_AREA_DICT.keys())[:5])
+        return None
+    cached = dict(precompress(json.dumps(payload, ensure_ascii=False, separators=(',', ':'))), version=version)
+    if len(CITY_AREA_BODIES) > len(cities) + 1:
+        CITY_AREA_BODIES.clear()  # stale versions
+    CITY_AREA_BODIES[city] = cached
+    return cached
 
-def load_catalog():
-    """Load products from first valid catalog file"""
-    paths = ['data/catalog_cache.json', 'catalog.json', 'data/catalogs/latest.json']
-    for path in paths:
+# Rendered landing pages: LRU keyed by (product id, city data version), bounded by encoded size.
+# An entry is reused across catalog versions as long as the product dict is the same object
+# (admin writes replace changed products copy-on-write), so editing one product only
+# invalidates that product's page.
+LANDING_CACHE_MAX_BYTES = int(os.getenv('LANDING_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+LANDING_CACHE = OrderedDict()
+LANDING_CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'bytes': 0}
+_landing_cache_lock = threading.Lock()
+
+def _landing_entry_size(entry):
+    return sum(len(entry[k]) for k in ('identity', 'gzip', 'br') if k in entry)
+
+def render_landing_page(product):
+    """Return precompress()ed HTML for a product's landing page, rendering only on a miss"""
+    key = (str(product.get('id')), CITY_AREA_VERSION)
+    catalog_version = CATALOG_SNAPSHOT.version
+    with _landing_cache_lock:
+        entry = LANDING_CACHE.get(key)
+        if entry is not None and (entry['catalog_version'] == catalog_version or entry['product'] is product):
+            entry['catalog_version'] = catalog_version
+            LANDING_CACHE.move_to_end(key)
+            LANDING_CACHE_STATS['hits'] += 1
+            return entry
+        LANDING_CACHE_STATS['misses'] += 1
+    with span('render'):
+        html = render_template('product_landing.html', product=product, city_areas_version=CITY_AREA_VERSION)
+        entry = dict(precompress(html), product=product, catalog_version=catalog_version)
+    size = _landing_entry_size(entry)
+    with _landing_cache_lock:
+        old = LANDING_CACHE.pop(key, None)
+        if old is not None:
+            LANDING_CACHE_STATS['bytes'] -= _landing_entry_size(old)
+        LANDING_CACHE[key] = entry
+        LANDING_CACHE_STATS['bytes'] += size
+        while LANDING_CACHE_STATS['bytes'] > LANDING_CACHE_MAX_BYTES and len(LANDING_CACHE) > 1:
+            _, evicted = LANDING_CACHE.popitem(last=False)
+            LANDING_CACHE_STATS['bytes'] -= _landing_entry_size(evicted)
+            LANDING_CACHE_STATS['evictions'] += 1
+    return entry
+
+def invalidate_landing_cache(product_ids=None):
+    """Drop cached pages for the given product ids (all pages if None)"""
+    with _landing_cache_lock:
+        if product_ids is None:
+            keys = list(LANDING_CACHE)
+        else:
+            product_ids = {str(pid) for pid in product_ids}
+            keys = [key for key in LANDING_CACHE if key[0] in product_ids]
+        for key in keys:
+            LANDING_CACHE_STATS['bytes'] -= _landing_entry_size(LANDING_CACHE.pop(key))
+        LANDING_CACHE_STATS['invalidations'] += len(keys)
+
+def landing_cache_stats():
+    with _landing_cache_lock:
+        return dict(LANDING_CACHE_STATS, entries=len(LANDING_CACHE), max_bytes=LANDING_CACHE_MAX_BYTES)
+
+def _city_area_cache_control():
+    # URLs carrying the current version never change, so they can be cached forever
+    if CITY_AREA_VERSION and request.args.get('v') == CITY_AREA_VERSION:
+        return 'public, max-age=31536000, immutable'
+    return 'public, max-age=300'
+
+CATALOG_PATHS = ['data/catalog_cache.json', 'catalog.json', 'data/catalogs/latest.json']
+# How often (seconds) a worker re-stats the catalog files to notice writes from other processes
+CATALOG_CHECK_INTERVAL = float(os.getenv('CATALOG_CHECK_INTERVAL', '1.0'))
+
+# Immutable catalog snapshot shared by every route in this process. It is only ever
+# replaced as a whole (never mutated), so readers need no locking.
+CatalogSnapshot = namedtuple('CatalogSnapshot', ['products', 'path', 'signature', 'generation', 'version', 'loaded_at', 'index'])
+# Lookup maps searched by find_product_by_slug, in priority order
+PRODUCT_INDEX_KEYS = ('website', 'id', 'sku', 'slug')
+CATALOG_SNAPSHOT = CatalogSnapshot((), None, None, -1, 0, 0.0, None)
+CATALOG_STATS = {'hits': 0, 'reloads': 0, 'load_time': 0.0, 'last_load_ms': 0.0, 'checks': 0}
+_catalog_lock = threading.Lock()
+_catalog_generation = 0
+_catalog_checked_at = 0.0
+
+# Binary catalog snapshot, written next to catalog_cache.json. Every product
+# field is stored as a compact JSON fragment in one heap, addressed by a
+# uint32 offset table (products x keys + 1), so the file is mmap()ed and shared
+# by all workers through the page cache. The small fields the hot paths read
+# (HOT_PRODUCT_FIELDS) are also stored as one JSON array per field and decoded
+# in bulk on load; long descriptions and signed image URLs stay in the mapping
+# and are decoded only when read.
+CATALOG_BINARY_PATH = 'data/catalog_cache.bin'
+CATALOG_BINARY_MAGIC = b'ARGCAT01'
+# magic, byte-order mark, source JSON (inode, mtime_ns, size), products, keys, key table length, hot columns length
+_CATALOG_BINARY_HEADER = struct.Struct('=8sIQqQIIII')
+_CATALOG_BINARY_BOM = 0x01020304
+HOT_PRODUCT_FIELDS = ('id', 'sku', 'title', 'price', 'currency', 'brand', 'shipping_price', 'free_shipping',
+                      'offers', 'website', 'image_hash')
+# Low-cardinality fields whose strings are interned: one copy per process
+INTERNED_PRODUCT_FIELDS = frozenset(['brand', 'currency'])
+
+class CatalogBinary:
+    """A mapped catalog_cache.bin: key table, offset table, value heap and decoded hot columns"""
+    __slots__ = ('mm', 'keys', 'key_index', 'key_json', 'hot_index', 'offsets', 'heap', 'count', 'source', 'hot_rows',
+                 'title_slugs')
+
+    def __init__(self, mm):
+        magic, bom, ino, mtime_ns, size, count, nkeys, keys_len, hot_len = _CATALOG_BINARY_HEADER.unpack_from(mm, 0)
+        if magic != CATALOG_BINARY_MAGIC or bom != _CATALOG_BINARY_BOM:
+            raise ValueError('not a catalog snapshot for this platform')
+        pos = _CATALOG_BINARY_HEADER.size
+        self.keys = tuple(sys.intern(key) for key in json.loads(mm[pos:pos + keys_len]))
+        if len(self.keys) != nkeys:
+            raise ValueError('corrupt key table')
+        self.key_index = {key: j for j, key in enumerate(self.keys)}
+        self.key_json = tuple(json.dumps(key, ensure_ascii=False).encode('utf-8') + b':' for key in self.keys)
+        pos += keys_len
+        hot = json.loads(mm[pos:pos + hot_len])
+        columns = []
+        for key, column in zip(hot['keys'], hot['columns']):
+            if key in INTERNED_PRODUCT_FIELDS:
+                column = [sys.intern(v) if isinstance(v, str) else v for v in column]
+            columns.append(column)
+        self.hot_index = {key: h for h, key in enumerate(hot['keys'])}
+        self.hot_rows = list(zip(*columns)) if columns else [()] * count
+        # Slugs of the titles, so loading doesn't slugify the whole catalog again
+        titles = columns[self.hot_index['title']] if 'title' in self.hot_index else [None] * count
+        self.title_slugs = dict(zip(('' if t is None else t for t in titles), hot['slugs']))
+        pos += hot_len + (-(pos + hot_len) % 4)
+        table = count * nkeys + 1
+        self.offsets = memoryview(mm)[pos:pos + table * 4].cast('I')
+        self.heap = pos + table * 4
+        if len(self.offsets) != table or len(self.hot_rows) != count or self.heap + self.offsets[-1] > len(mm):
+            raise ValueError('truncated catalog snapshot')
+        self.mm, self.count, self.source = mm, count, (ino, mtime_ns, size)
+
+    def raw(self, start, end):
+        return self.mm[self.heap + start:self.heap + end]
+
+    def decode(self, start, end):
+        raw = self.mm[self.heap + start:self.heap + end]
+        if raw[:1] == b'"' and b'\\' not in raw:
+            return raw[1:-1].decode('utf-8')  # plain string: skip the JSON parser
+        return json.loads(raw)
+
+    def products(self):
+        rows, self.hot_rows = self.hot_rows, None  # owned by the records from here on
+        return tuple(Product(self, i, row) for i, row in enumerate(rows))
+
+class Product(Mapping):
+    """Read-only catalog record mapped from catalog_cache.bin.
+
+    Behaves like the product dicts it replaces (get, [], in, items, dict(p, ...)),
+    and like them is never mutated: admin writes replace it with a new dict.
+    Hot fields are held decoded; the rest is decoded from the mapping when read.
+    """
+    __slots__ = ('_catalog', '_row', '_hot')
+
+    def __init__(self, catalog, pos, hot):
+        self._catalog = catalog
+        self._row = pos * len(catalog.keys)
+        self._hot = hot
+
+    def get(self, key, default=None):
+        catalog = self._catalog
+        j = catalog.key_index.get(key)
+        if j is None:
+            return default
+        start, end = catalog.offsets[self._row + j], catalog.offsets[self._row + j + 1]
+        if start == end:
+            return default
+        h = catalog.hot_index.get(key)
+        return self._hot[h] if h is not None else catalog.decode(start, end)
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key):
+        catalog = self._catalog
+        j = catalog.key_index.get(key)
+        return j is not None and catalog.offsets[self._row + j] != catalog.offsets[self._row + j + 1]
+
+    def __iter__(self):
+        offsets, row = self._catalog.offsets, self._row
+        for j, key in enumerate(self._catalog.keys):
+            if offsets[row + j] != offsets[row + j + 1]:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return f"Product({dict(self)!r})"
+
+    def raw_items(self):
+        """(key, JSON fragment bytes) for the fields present"""
+        catalog, row = self._catalog, self._row
+        offsets = catalog.offsets
+        for j, key in enumerate(catalog.keys):
+            start, end = offsets[row + j], offsets[row + j + 1]
+            if start != end:
+                yield key, catalog.raw(start, end)
+
+    def to_json(self):
+        """The record as compact JSON bytes, copied from the snapshot without decoding"""
+        catalog, row = self._catalog, self._row
+        offsets, key_json = catalog.offsets, catalog.key_json
+        parts = []
+        for j in range(len(key_json)):
+            start, end = offsets[row + j], offsets[row + j + 1]
+            if start != end:
+                parts.append(key_json[j] + catalog.raw(start, end))
+        return b'{' + b','.join(parts) + b'}'
+
+_MISSING = object()
+
+def _json_default(o):
+    if isinstance(o, Product):
+        return dict(o)
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+def _json_fragment(value):
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=_json_default).encode('utf-8')
+
+def product_json(p):
+    """Compact JSON bytes of a catalog product (Product record or dict)"""
+    return p.to_json() if isinstance(p, Product) else _json_fragment(p)
+
+def catalog_json_chunks(products, chunk=1000):
+    """The product list as a JSON array, in byte chunks"""
+    yield b'['
+    for i in range(0, len(products), chunk):
+        yield (b',' if i else b'') + b','.join(product_json(p) for p in products[i:i + chunk])
+    yield b']'
+
+class CatalogJSONProvider(DefaultJSONProvider):
+    """jsonify() and |tojson that also accept mapped Product records"""
+
+    @staticmethod
+    def default(o):
+        if isinstance(o, Product):
+            return dict(o)
+        return DefaultJSONProvider.default(o)
+
+app.json = CatalogJSONProvider(app)
+
+def write_catalog_binary(products, source_stat, out_path=CATALOG_BINARY_PATH):
+    """Write products as a binary snapshot tagged with the catalog JSON's stat"""
+    keys, key_index = [], {}
+    for p in products:
+        for key in p:
+            if key not in key_index:
+                key_index[key] = len(keys)
+                keys.append(key)
+    hot_keys = [key for key in HOT_PRODUCT_FIELDS if key in key_index]
+    offsets = array('I')
+    heap = bytearray()
+    for p in products:
+        raw = dict(p.raw_items()) if isinstance(p, Product) else None
+        for key in keys:
+            offsets.append(len(heap))
+            if raw is not None:
+                heap += raw.get(key, b'')
+            elif key in p:
+                heap += _json_fragment(p[key])
+        if len(heap) >= 1 << 32:
+            raise ValueError('catalog too large for a binary snapshot')
+    offsets.append(len(heap))
+    if offsets.itemsize != 4:
+        raise ValueError('no 4-byte unsigned int array type on this platform')
+    key_table = json.dumps(keys, ensure_ascii=False).encode('utf-8')
+    known = (CATALOG_SNAPSHOT.index or {}).get('titles', {})
+    slugs = [known.get(title) or slugify(title) for title in (p.get('title', '') for p in products)]
+    hot = _json_fragment({'keys': hot_keys, 'columns': [[p.get(key) for p in products] for key in hot_keys],
+                          'slugs': slugs})
+    header = _CATALOG_BINARY_HEADER.pack(CATALOG_BINARY_MAGIC, _CATALOG_BINARY_BOM, source_stat.st_ino,
+                                         source_stat.st_mtime_ns, source_stat.st_size, len(products), len(keys),
+                                         len(key_table), len(hot))
+    fd, temp_path = tempfile.mkstemp(prefix='.catalog-', suffix='.tmp', dir=os.path.dirname(out_path) or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(key_table)
+            f.write(hot + b'\0' * (-(_CATALOG_BINARY_HEADER.size + len(key_table) + len(hot)) % 4))
+            f.write(offsets.tobytes())
+            f.write(heap)
+        os.replace(temp_path, out_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def load_catalog_binary(source_stat, path=CATALOG_BINARY_PATH):
+    """Products mapped from the binary snapshot, or None if it is missing or not built from this catalog JSON"""
+    try:
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        catalog = CatalogBinary(mm)
+    except (OSError, ValueError, struct.error):
+        return None
+    if catalog.source != (source_stat.st_ino, source_stat.st_mtime_ns, source_stat.st_size):
+        return None
+    return catalog.products()
+
+def map_catalog(products, source_stat):
+    """Write the binary snapshot for products and return them mapped from it (products on failure)"""
+    try:
+        write_catalog_binary(products, source_stat)
+        mapped = load_catalog_binary(source_stat)
+    except (OSError, ValueError) as e:
+        logger.warning("Could not write %s: %s", CATALOG_BINARY_PATH, e)
+        return products
+    return mapped if mapped is not None else products
+
+def _catalog_signature():
+    """Return (path, mtime, size) for every existing catalog path"""
+    signature = []
+    for path in CATALOG_PATHS:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        signature.append((path, st.st_mtime_ns, st.st_size))
+    return tuple(signature)
+
+def _read_catalog_file():
+    """Parse products from first valid catalog file.
+
+    The primary catalog is mapped from its binary snapshot when that was built
+    from the JSON as it is now; otherwise the JSON is decoded and the snapshot
+    rebuilt, so the next worker (or restart) can map it.
+    """
+    for path in CATALOG_PATHS:
         if os.path.exists(path):
             try:
-                with open(path, 'r', encoding='utf-8') as f:
+                with open(path, 'rb') as f:
+                    st = os.fstat(f.fileno())
+                    if path == CATALOG_PATHS[0]:
+                        mapped = load_catalog_binary(st)
+                        if mapped is not None:
+                            return mapped, path
                     data = json.load(f)
-                    if isinstance(data, list):
-                        return data, path
-                    elif isinstance(data, dict) and 'products' in data:
-                        return data['products'], path
+                products = None
+                if isinstance(data, list):
+                    products = data
+                elif isinstance(data, dict) and 'products' in data:
+                    products = data['products']
+                if products is not None:
+                    if path == CATALOG_PATHS[0]:
+                        products = map_catalog(products, st)
+                    return products, path
             except Exception as e:
-                print(f"Error loading {path}: {e}")
+                logger.error("Error loading %s: %s", path, e)
     return [], None
 
-def save_catalog_products(products, out_path=None):
-    """Save products to JSON safely"""
+def _index_product(index, pos, p):
+    """Add one product's lookup keys to the index (first product wins on clashes)"""
+    website = str(p.get('website') or '')
+    if '/' in website:
+        index['website'].setdefault(website.rsplit('/', 1)[-1], pos)
+    for name in ('id', 'sku'):
+        key = p.get(name)
+        if key not in (None, ''):
+            index[name].setdefault(str(key), pos)
+    title = p.get('title', '')
+    slug = index['titles'].get(title)
+    if slug is None:
+        slug = index['titles'][title] = slugify(title)
+    if slug:
+        index['slug'].setdefault(slug, pos)
+
+def _unindex_product(index, pos, p):
+    """Remove the keys that point at position pos"""
+    website = str(p.get('website') or '')
+    keys = {
+        'website': website.rsplit('/', 1)[-1] if '/' in website else None,
+        'id': str(p.get('id', '')),
+        'sku': str(p.get('sku', '')),
+        'slug': index['titles'].get(p.get('title', '')),
+    }
+    for name, key in keys.items():
+        if key is not None and index[name].get(key) == pos:
+            del index[name][key]
+
+def build_product_index(products, previous=None):
+    """Build website/id/sku/title-slug -> position maps for a catalog snapshot"""
+    index = {name: {} for name in PRODUCT_INDEX_KEYS}
+    # Reuse slugs computed for the previous snapshot or stored in the binary one: slugify is the expensive part
+    old_titles = previous['titles'] if previous else {}
+    stored = {}
+    if products and isinstance(products[0], Product):
+        stored, products[0]._catalog.title_slugs = products[0]._catalog.title_slugs, {}
+    index['titles'] = {}
+    for p in products:
+        title = p.get('title', '')
+        if title in old_titles:
+            index['titles'][title] = old_titles[title]
+        elif title in stored:
+            index['titles'][title] = stored[title]
+    for pos, p in enumerate(products):
+        _index_product(index, pos, p)
+    return index
+
+def patch_product_index(index, old_products, products, changed):
+    """Return a copy of index updated only for the changed positions"""
+    if index is None or len(products) < len(old_products):
+        return build_product_index(products, index)
+    # Copy the maps so readers of the previous snapshot keep a consistent view
+    index = {name: dict(value) for name, value in index.items()}
+    for pos in changed:
+        if pos < len(old_products):
+            _unindex_product(index, pos, old_products[pos])
+    for pos in sorted(changed):
+        _index_product(index, pos, products[pos])
+    return index
+
+def _install_catalog(products, path, signature, generation, changed=None):
+    """Publish a new immutable snapshot (products + lookup index) for all routes"""
+    global CATALOG_SNAPSHOT
+    previous = CATALOG_SNAPSHOT
+    products = tuple(products)
+    if changed is None:
+        index = build_product_index(products, previous.index)
+    else:
+        index = patch_product_index(previous.index, previous.products, products, changed)
+    CATALOG_SNAPSHOT = CatalogSnapshot(
+        products=products,
+        path=path,
+        signature=signature,
+        generation=generation,
+        version=previous.version + 1,
+        loaded_at=time.time(),
+        index=index
+    )
+    return CATALOG_SNAPSHOT
+
+def get_catalog_snapshot():
+    """Return the current catalog snapshot, reloading only if the source file changed"""
+    global _catalog_checked_at
+    snapshot = CATALOG_SNAPSHOT
+    now = time.monotonic()
+    if snapshot.generation == _catalog_generation and now - _catalog_checked_at < CATALOG_CHECK_INTERVAL:
+        CATALOG_STATS['hits'] += 1
+        return snapshot
+
+    CATALOG_STATS['checks'] += 1
+    signature = _catalog_signature()
+    if snapshot.generation == _catalog_generation and signature == snapshot.signature:
+        _catalog_checked_at = now
+        CATALOG_STATS['hits'] += 1
+        return snapshot
+
+    with _catalog_lock:
+        # Another thread may have reloaded while we waited for the lock
+        snapshot = CATALOG_SNAPSHOT
+        generation = _catalog_generation
+        signature = _catalog_signature()
+        if snapshot.generation == generation and signature == snapshot.signature:
+            CATALOG_STATS['hits'] += 1
+            return snapshot
+        started = time.perf_counter()
+        with span('catalog_load'):
+            products, path = _read_catalog_file()
+            snapshot = _install_catalog(products, path, signature, generation)
+        elapsed = time.perf_counter() - started
+        CATALOG_STATS['reloads'] += 1
+        CATALOG_STATS['load_time'] += elapsed
+        CATALOG_STATS['last_load_ms'] = round(elapsed * 1000, 3)
+        _catalog_checked_at = time.monotonic()
+    return snapshot
+
+def invalidate_catalog():
+    """Force the next get_catalog_snapshot() call to re-check the catalog files"""
+    global _catalog_generation
+    with _catalog_lock:
+        _catalog_generation += 1
+
+def catalog_stats():
+    """Counters proving how often the catalog is actually read from disk"""
+    snapshot = CATALOG_SNAPSHOT
+    return dict(CATALOG_STATS, version=snapshot.version, path=snapshot.path,
+                products=len(snapshot.products), generation=snapshot.generation)
+
+def load_catalog():
+    """Return the shared (read-only) product tuple and its source path"""
+    snapshot = get_catalog_snapshot()
+    return snapshot.products, snapshot.path
+
+def save_catalog_products(products, out_path=None, changed=None):
+    """Save products to JSON safely.
+
+    When saving the primary catalog, the binary snapshot is rewritten next to
+    it and the saved list is published as the new snapshot directly;
+    ``changed`` (positions that were replaced or appended) lets the lookup
+    index be patched instead of rebuilt.
+    """
     if out_path is None:
-        out_path = 'data/catalog_cache.json'
+        out_path = CATALOG_PATHS[0]
     dir_path = os.path.dirname(out_path)
     if dir_path:
         os.makedirs(dir_path, exist_ok=True)
     temp_path = out_path + '.tmp'
     try:
-        with open(temp_path, 'w', encoding='utf-8') as f:
-            json.dump(products, f, ensure_ascii=False, indent=2)
+        with open(temp_path, 'wb') as f:
+            for chunk in catalog_json_chunks(products):
+                f.write(chunk)
         os.replace(temp_path, out_path)
-        print(f"Saved {len(products)} products to {out_path}")
+        if out_path == CATALOG_PATHS[0]:
+            try:
+                write_catalog_binary(products, os.stat(out_path))
+            except (OSError, ValueError) as e:
+                # Workers fall back to decoding the JSON (and retry the snapshot)
+                logger.warning("Could not write %s: %s", CATALOG_BINARY_PATH, e)
+            with _catalog_lock:
+                _install_catalog(products, out_path, _catalog_signature(), _catalog_generation, changed)
+        else:
+            invalidate_catalog()
+        logger.info("Saved %d products to %s", len(products), out_path)
     except Exception as e:
-        print(f"Error saving {out_path}: {e}")
+        logger.error("Error saving %s: %s", out_path, e)
         if os.path.exists(temp_path):
             os.remove(temp_path)
 
-def fetch_facebook_products(catalog_id, access_token):
-    """Fetch products from Facebook catalog"""
-    url = f"https://graph.facebook.com/v18.0/{catalog_id}/products"
+# Graph API client settings. GRAPH_API_URL can point at a local stub server for testing.
+GRAPH_API_URL = os.getenv('GRAPH_API_URL', 'https://graph.facebook.com/v18.0').rstrip('/')
+GRAPH_PAGE_LIMIT = int(os.getenv('GRAPH_PAGE_LIMIT', '500'))
+GRAPH_TIMEOUT = (float(os.getenv('GRAPH_CONNECT_TIMEOUT', '5')), float(os.getenv('GRAPH_READ_TIMEOUT', '30')))
+GRAPH_MAX_RETRIES = int(os.getenv('GRAPH_MAX_RETRIES', '4'))
+CATALOG_FETCH_WORKERS = int(os.getenv('CATALOG_FETCH_WORKERS', str(len(BUSINESS_CATALOGS))))
+GRAPH_PRODUCT_FIELDS = 'id,name,description,price,currency,availability,brand,image_url'
+
+_graph_session = {'session': None, 'pid': None}
+
+def graph_session():
+    """Pooled requests.Session with retry/backoff on 429 and 5xx, one per process"""
+    if _graph_session['session'] is None or _graph_session['pid'] != os.getpid():
+        retry = Retry(
+            total=GRAPH_MAX_RETRIES,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset(['GET']),
+            respect_retry_after_header=True,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(4, CATALOG_FETCH_WORKERS, IMAGE_WORKERS), max_retries=retry)
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        _graph_session.update(session=session, pid=os.getpid())
+    return _graph_session['session']
+
+def is_available(item):
+    """Whether a Graph catalog item can be sold"""
+    return item.get('availability') in ['available', 'in stock', None]
+
+def fetch_facebook_products(catalog_id, access_token, report=None, since=None, include_unavailable=False):
+    """Fetch all available products from a Facebook catalog, following paging.next.
+
+    since (unix seconds) restricts the query to items updated after it;
+    include_unavailable keeps out-of-stock items so a sync can tombstone them.
+    """
+    session = graph_session()
+    url = f"{GRAPH_API_URL}/{catalog_id}/products"
     params = {
-        'fields': 'id,name,description,price,currency,availability,brand,image_url',
+        'fields': GRAPH_PRODUCT_FIELDS,
+        'limit': GRAPH_PAGE_LIMIT,
         'access_token': access_token
     }
-    response = requests.get(url, params=params)
-    print(f"Response for {catalog_id}: {response.status_code}")
-    if response.status_code == 200:
-        data = response.json()
-        print(f"Raw data from {catalog_id}: {data}")
-        all_products = data.get('data', [])
-        available_products = [p for p in all_products if p.get('availability') in ['available', 'in stock', None]]
-        print(f"Total products: {len(all_products)}, Available: {len(available_products)}")
-        return available_products
-    else:
-        print(f"Failed to fetch {catalog_id}: {response.status_code} - {response.text}")
-        return []
+    if since is not None:
+        params['filter'] = json.dumps({'updated_time': {'gt': int(since)}})
+    report = report if report is not None else {}
+    report.update(pages=0, fetched=0, available=0, error=None)
+    started = time.perf_counter()
+    all_products = []
+    try:
+        while url:
+            response = session.get(url, params=params, timeout=GRAPH_TIMEOUT)
+            if response.status_code != 200:
+                report['error'] = f"{response.status_code} - {response.text[:500]}"
+                logger.error("Failed to fetch %s: %s", catalog_id, report['error'])
+                break
+            data = response.json()
+            all_products.extend(data.get('data', []))
+            report['pages'] += 1
+            report['fetched'] = len(all_products)  # live progress for catalog jobs
+            # paging.next already carries fields, limit, cursor and token
+            url = data.get('paging', {}).get('next')
+            params = None
+    except (requests.RequestException, ValueError) as e:
+        report['error'] = str(e)
+        logger.error("Failed to fetch %s: %s", catalog_id, e)
+    available_products = [p for p in all_products if is_available(p)]
+    report.update(fetched=len(all_products), available=len(available_products),
+                  seconds=round(time.perf_counter() - started, 3))
+    logger.info("Catalog %s: %d products in %d pages, %d available (%ss)", catalog_id, len(all_products),
+                report['pages'], len(available_products), report['seconds'])
+    return all_products if include_unavailable else available_products
 
-def update_catalogs():
-    """Fetch and merge products without duplicates"""
+def _parse_graph_price(price_str):
+    """Split Facebook price strings like "EGP1,970.00" into (value, currency)"""
+    if not isinstance(price_str, str):
+        return 0.0, 'EGP'
+    price_match = re.search(r'[\d,]+\.?\d*', price_str.replace(',', ''))
+    price_value = float(price_match.group()) if price_match else 0.0
+    currency_match = re.search(r'[A-Z]{3}', price_str)
+    currency = currency_match.group() if currency_match else 'EGP'
+    return price_value, currency
+
+def product_from_graph(name, p):
+    """Build a catalog product from a Graph item of catalog `name`"""
+    price_value, currency = _parse_graph_price(p.get('price', '0'))
+    return {
+        'id': p.get('id'),
+        'sku': f"{name}-{p.get('id')}",
+        'title': p.get('name', ''),
+        'description': p.get('description', ''),
+        'price': price_value,
+        'currency': currency,
+        'brand': p.get('brand', ''),
+        'image_url': p.get('image_url', ''),
+        'shipping_price': 50.0,  # default
+        'free_shipping': False,
+        'offers': []
+    }
+
+def fetch_all_catalogs(report, since=None, include_unavailable=False):
+    """Fetch every BUSINESS_CATALOGS catalog concurrently; returns [(name, items)] in catalog order"""
+    for name in BUSINESS_CATALOGS:
+        report[name] = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(CATALOG_FETCH_WORKERS, len(BUSINESS_CATALOGS)))) as pool:
+        futures = {
+            name: pool.submit(fetch_facebook_products, cid, FB_ACCESS_TOKEN, report[name], since, include_unavailable)
+            for name, cid in BUSINESS_CATALOGS.items()
+        }
+        # Merge in BUSINESS_CATALOGS order so duplicate ids resolve the same way every run
+        return [(name, futures[name].result()) for name in BUSINESS_CATALOGS]
+
+def update_catalogs(report=None):
+    """Fetch all catalogs concurrently and merge products without duplicates.
+
+    If report is a dict it is filled with per-catalog pages/counts/timings/errors.
+    """
+    report = report if report is not None else {}
     all_products = []
     seen_ids = set()
-    for name, cid in BUSINESS_CATALOGS.items():
-        prods = fetch_facebook_products(cid, FB_ACCESS_TOKEN)
-        print(f"Fetched {len(prods)} from {name}")
+    for name, prods in fetch_all_catalogs(report):
         for p in prods:
             pid = p.get('id')
             if pid not in seen_ids:
                 seen_ids.add(pid)
-                # Handle price parsing - Facebook returns price as string like "EGP550.00"
-                price_str = p.get('price', '0')
-                if isinstance(price_str, str):
-                    # Extract numeric value from string like "EGP550.00" or "EGP1,970.00"
-                    import re
-                    price_match = re.search(r'[\d,]+\.?\d*', price_str.replace(',', ''))
-                    price_value = float(price_match.group()) if price_match else 0.0
-                    # Extract currency from string
-                    currency_match = re.search(r'[A-Z]{3}', price_str)
-                    currency = currency_match.group() if currency_match else 'EGP'
-                else:
-                    price_value = 0.0
-                    currency = 'EGP'
-                
-                all_products.append({
-                    'id': pid,
-                    'sku': f"{name}-{pid}",
-                    'title': p.get('name', ''),
-                    'description': p.get('description', ''),
-                    'price': price_value,
-                    'currency': currency,
-                    'brand': p.get('brand', ''),
-                    'image_url': p.get('image_url', ''),
-                    'shipping_price': 50.0,  # default
-                    'free_shipping': False,
-                    'offers': []
-                })
+                all_products.append(product_from_graph(name, p))
     return all_products
 
+CATALOG_SYNC_STATE_PATH = 'data/catalog_sync.json'
+# Fields that come from Facebook; everything else (shipping_price, free_shipping, offers,
+# website, ...) is owned by the admin and survives a sync
+UPSTREAM_PRODUCT_FIELDS = ('id', 'sku', 'title', 'description', 'price', 'currency', 'brand', 'image_url')
+# Re-ask Graph for a few minutes before the watermark to absorb clock skew
+CATALOG_SYNC_OVERLAP = 300
+
+def product_content_hash(p):
+    """Hash of a product's upstream fields, used to skip unchanged items"""
+    # A re-signed image link is not a change: the image itself is cached locally
+    payload = json.dumps([image_source_key(p.get(k)) if k == 'image_url' else p.get(k) for k in UPSTREAM_PRODUCT_FIELDS],
+                         ensure_ascii=False, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def load_catalog_sync_state():
+    try:
+        with open(CATALOG_SYNC_STATE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_catalog_sync_state(state):
+    os.makedirs(os.path.dirname(CATALOG_SYNC_STATE_PATH), exist_ok=True)
+    temp_path = CATALOG_SYNC_STATE_PATH + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(temp_path, CATALOG_SYNC_STATE_PATH)
+
+def sync_catalog(mode='full', catalogs=None):
+    """Sync the catalog from Facebook and apply only adds, updates and tombstones.
+
+    'incremental' only asks Graph for items updated since the last successful
+    sync; 'full' fetches everything and also tombstones products that vanished
+    from a catalog. Nothing is written when the diff is empty. Returns a
+    change report. catalogs, if given, is filled with per-catalog progress as
+    pages arrive.
+    """
+    state = load_catalog_sync_state()
+    since = None
+    if mode == 'incremental' and state.get('watermark'):
+        since = state['watermark'] - CATALOG_SYNC_OVERLAP
+    started_at = time.time()
+    catalogs = catalogs if catalogs is not None else {}
+    fetched = fetch_all_catalogs(catalogs, since=since, include_unavailable=True)
+
+    snapshot = get_catalog_snapshot()
+    products = list(snapshot.products)
+    positions = snapshot.index['id']
+    added, updated, removed, relinked = [], [], set(), []
+    unchanged = 0
+    changed = set()
+    seen = set()
+    for name, items in fetched:
+        for item in items:
+            pid = str(item.get('id'))
+            if pid in seen:
+                continue
+            seen.add(pid)
+            pos = positions.get(pid)
+            if not is_available(item):
+                if pos is not None:
+                    removed.add(pid)
+                continue
+            fresh = product_from_graph(name, item)
+            if pos is None:
+                changed.add(len(products))
+                products.append(fresh)
+                added.append(pid)
+            elif product_content_hash(products[pos]) != product_content_hash(fresh):
+                old = products[pos]
+                products[pos] = dict(old, **{k: fresh[k] for k in UPSTREAM_PRODUCT_FIELDS})
+                changed.add(pos)
+                updated.append(pid)
+            else:
+                unchanged += 1
+                if fresh.get('image_url') != products[pos].get('image_url'):
+                    # Same image, re-signed link: keep the live one so retries and the fallback URL work
+                    products[pos] = dict(products[pos], image_url=fresh.get('image_url'))
+                    changed.add(pos)
+                    relinked.append(pid)
+
+    failed = {name for name, r in catalogs.items() if r.get('error')}
+    if mode == 'full':
+        # Products of a successfully fetched catalog that Graph no longer returns
+        for p in snapshot.products:
+            prefix = catalog_prefix(p)
+            if prefix in BUSINESS_CATALOGS and prefix not in failed and str(p.get('id')) not in seen:
+                removed.add(str(p.get('id')))
+
+    if removed:
+        products = [p for p in products if str(p.get('id')) not in removed]
+        changed = None  # positions shifted: rebuild the index
+    images = cache_product_images(products, refresh_ids=set(added + updated))
+    for pos, image_hash in images.items():
+        products[pos] = dict(products[pos], image_hash=image_hash)
+        if changed is not None:
+            changed.add(pos)
+
+    written = False
+    if added or updated or removed or images or relinked:
+        generate_landing_links(products, write_back=False)
+        save_catalog_products(products, changed=changed)
+        invalidate_landing_cache(added + updated + sorted(removed) + relinked +
+                                 [str(products[pos].get('id')) for pos in images])
+        written = True
+
+    if not failed:
+        state['watermark'] = started_at
+    state['last_sync'] = {'mode': mode, 'at': started_at, 'added': len(added), 'updated': len(updated),
+                          'removed': len(removed), 'errors': sorted(failed)}
+    save_catalog_sync_state(state)
+    return {
+        'mode': mode,
+        'since': since,
+        'added': added,
+        'updated': updated,
+        'removed': sorted(removed),
+        'unchanged': unchanged,
+        'relinked': len(relinked),
+        'images': len(images),
+        'total': len(products),
+        'written': written,
+        'catalogs': catalogs
+    }
+
+# Catalog images: Facebook CDN links carry short-lived signatures, so each
+# image is downloaded during sync and stored under data/images/<hash>/,
+# content-addressed by the sha256 of the original, with resized WebP and
+# JPEG variants for /img/<hash>/<width>. Without Pillow only the original
+# is kept and served for every width.
+IMAGE_DIR = 'data/images'
+IMAGE_SOURCES_PATH = os.path.join(IMAGE_DIR, 'sources.json')  # image_url without query -> hash
+IMAGE_WIDTHS = (160, 320, 640, 1280)
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', '4'))
+IMAGE_MAX_BYTES = int(os.getenv('IMAGE_MAX_BYTES', str(15 * 1024 * 1024)))
+# file:// image URLs read local files: only for offline testing, never with a real catalog
+IMAGE_ALLOW_FILE_URLS = os.getenv('IMAGE_ALLOW_FILE_URLS', '').lower() in ('1', 'true', 'yes')
+IMAGE_QUALITY = {'webp': 80, 'jpeg': 82}
+IMAGE_MIMETYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+
+def image_source_key(url):
+    """image_url without its query string, so re-signed CDN links map to the same image"""
+    return str(url or '').split('?', 1)[0]
+
+def image_path(image_hash, name):
+    return os.path.join(IMAGE_DIR, image_hash[:2], image_hash, name)
+
+def _sniff_image_type(data):
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'image/gif'
+    return None
+
+def fetch_image_bytes(url):
+    """Image bytes from an http(s) URL, or a file:// one when IMAGE_ALLOW_FILE_URLS is set"""
+    scheme = urlparse(url).scheme.lower()
+    if scheme == 'file':
+        if not IMAGE_ALLOW_FILE_URLS:
+            raise ValueError('file:// image URLs are disabled (IMAGE_ALLOW_FILE_URLS)')
+        with open(url2pathname(urlparse(url).path), 'rb') as f:
+            data = f.read(IMAGE_MAX_BYTES + 1)
+    elif scheme in ('http', 'https'):
+        response = graph_session().get(url, timeout=GRAPH_TIMEOUT)
+        response.raise_for_status()
+        data = response.content
+    else:
+        raise ValueError(f'unsupported image URL scheme: {scheme or url}')
+    if len(data) > IMAGE_MAX_BYTES:
+        raise ValueError(f'image larger than {IMAGE_MAX_BYTES} bytes')
+    if _sniff_image_type(data) is None:
+        raise ValueError('not an image')
+    return data
+
+def _write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def _write_image_variants(image_hash, data):
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(data)))
+    has_alpha = image.mode in ('RGBA', 'LA') or (image.mode == 'P' and 'transparency' in image.info)
+    image = image.convert('RGBA' if has_alpha else 'RGB')
+    # Largest first, each one shrunk from the previous
+    for width in sorted(IMAGE_WIDTHS, reverse=True):
+        image.thumbnail((width, width * 4), Image.LANCZOS)
+        for fmt in ('webp', 'jpeg'):
+            variant = image
+            if fmt == 'jpeg' and has_alpha:
+                variant = Image.new('RGB', image.size, (255, 255, 255))
+                variant.paste(image, mask=image.getchannel('A'))
+            out = io.BytesIO()
+            variant.save(out, fmt.upper(), quality=IMAGE_QUALITY[fmt], optimize=True)
+            _write_file(image_path(image_hash, f'{width}.{fmt}'), out.getvalue())
+
+def image_is_cached(image_hash):
+    return bool(image_hash) and os.path.exists(image_path(image_hash, 'source'))
+
+def store_image(url):
+    """Download url, store the original and its variants; returns the content hash"""
+    data = fetch_image_bytes(url)
+    image_hash = hashlib.sha256(data).hexdigest()[:32]
+    if not image_is_cached(image_hash):
+        if Image is not None:
+            _write_image_variants(image_hash, data)
+        # The original goes last: its presence marks the image as complete
+        _write_file(image_path(image_hash, 'source'), data)
+    return image_hash
+
+def _load_image_sources():
+    try:
+        with open(IMAGE_SOURCES_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def cache_product_images(products, refresh_ids=()):
+    """Fetch images not cached yet in a bounded pool; returns {position: hash} where the hash changed
+
+    Products in refresh_ids are downloaded again even if their image URL is known.
+    """
+    sources = _load_image_sources()
+    changes, todo = {}, {}
+    for pos, p in enumerate(products):
+        url = p.get('image_url')
+        if not url:
+            continue
+        key = image_source_key(url)
+        known = sources.get(key)
+        if str(p.get('id')) not in refresh_ids and image_is_cached(known):
+            if known != p.get('image_hash'):
+                changes[pos] = known
+            continue
+        todo.setdefault(key, (url, []))[1].append(pos)
+    if not todo:
+        return changes
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix='catalog-images') as pool:
+        futures = {pool.submit(store_image, url): key for key, (url, _) in todo.items()}
+        for future in as_completed(futures):
+            key = futures[future]
+            try:
+                image_hash = future.result()
+            except Exception as e:
+                failures += 1
+                logger.warning("Error caching image %s: %s", key, e)
+                continue
+            sources[key] = image_hash
+            for pos in todo[key][1]:
+                if products[pos].get('image_hash') != image_hash:
+                    changes[pos] = image_hash
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    temp_path = IMAGE_SOURCES_PATH + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(sources, f)
+    os.replace(temp_path, IMAGE_SOURCES_PATH)
+    logger.info("Cached %d product images (%d failed)", len(todo) - failures, failures)
+    return changes
+
+@app.template_global()
+def product_image_url(product, width=640):
+    """Local /img URL for the product's image, or its original image_url until a sync has cached it"""
+    if product.get('image_hash'):
+        return url_for('product_image', image_hash=product['image_hash'], width=width)
+    return product.get('image_url', '')
+
+# Catalog refresh jobs run in a background thread. Job records live in
+# data/jobs/<job_id>.json so any worker can answer status polls, and the
+# flock on CATALOG_SYNC_LOCK_PATH makes sure only one sync runs at a time.
+CATALOG_JOBS_DIR = 'data/jobs'
+CATALOG_ACTIVE_JOB_PATH = os.path.join(CATALOG_JOBS_DIR, 'active.json')
+CATALOG_SYNC_LOCK_PATH = 'data/catalog_sync.lock'
+CATALOG_JOB_HISTORY = int(os.getenv('CATALOG_JOB_HISTORY', '50'))
+# In-app schedule (seconds, 0 = off) replacing the daily GitHub Actions run; daily by default
+CATALOG_SYNC_INTERVAL = float(os.getenv('CATALOG_SYNC_INTERVAL', '86400'))
+CATALOG_SYNC_MODE = os.getenv('CATALOG_SYNC_MODE', 'incremental')
+
+_catalog_job_lock = threading.Lock()
+_catalog_scheduler = {'thread': None, 'pid': None}
+
+def _write_job(job):
+    os.makedirs(CATALOG_JOBS_DIR, exist_ok=True)
+    path = os.path.join(CATALOG_JOBS_DIR, f"{job['job_id']}.json")
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(job, f, ensure_ascii=False, default=str)
+    os.replace(temp_path, path)
+
+def _catalog_job_alive(job):
+    """Whether the sync of a 'running' job still holds the sync lock (or, without flock, its process lives)"""
+    if not fcntl:
+        return not job.get('pid') or _process_alive(job['pid'])
+    try:
+        fd = os.open(CATALOG_SYNC_LOCK_PATH, os.O_RDWR)
+    except OSError:
+        return False
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(fd)  # also drops the lock if we just took it
+    return False
+
+def read_catalog_job(job_id):
+    """Return a job record, or None if unknown.
+
+    A job still 'running' whose worker died (recycled or killed) is marked failed.
+    """
+    if not re.fullmatch(r'[0-9a-f]{32}', job_id or ''):
+        return None
+    try:
+        with open(os.path.join(CATALOG_JOBS_DIR, f'{job_id}.json'), 'r', encoding='utf-8') as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if job.get('status') == 'running' and not _catalog_job_alive(job):
+        job.update(status='failed', finished_at=datetime.datetime.utcnow().isoformat(),
+                   error=f"Interrupted: worker {job.get('pid')} exited before the sync finished")
+        _write_job(job)
+    return job
+
+def _prune_catalog_jobs():
+    """Keep only the newest CATALOG_JOB_HISTORY job records"""
+    try:
+        names = [n for n in os.listdir(CATALOG_JOBS_DIR) if re.fullmatch(r'[0-9a-f]{32}\.json', n)]
+    except OSError:
+        return
+    paths = sorted((os.path.join(CATALOG_JOBS_DIR, n) for n in names), key=os.path.getmtime, reverse=True)
+    for path in paths[CATALOG_JOB_HISTORY:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+def start_catalog_job(mode='full', trigger='api'):
+    """Start a background catalog sync; returns (job, started).
+
+    If a sync is already running in any worker, its job is returned with
+    started=False instead of launching a second one.
+    """
+    os.makedirs(CATALOG_JOBS_DIR, exist_ok=True)
+    if not _catalog_job_lock.acquire(blocking=False):
+        return _active_catalog_job(), False
+    lock_fd = os.open(CATALOG_SYNC_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(lock_fd)
+        _catalog_job_lock.release()
+        return _active_catalog_job(), False
+
+    job = {
+        'job_id': uuid.uuid4().hex,
+        'mode': mode,
+        'trigger': trigger,
+        'status': 'running',
+        'pid': os.getpid(),
+        'created_at': datetime.datetime.utcnow().isoformat(),
+        'heartbeat_at': datetime.datetime.utcnow().isoformat(),
+        'finished_at': None,
+        'catalogs': {},
+        'result': None,
+        'error': None
+    }
+    _write_job(job)
+    with open(CATALOG_ACTIVE_JOB_PATH, 'w', encoding='utf-8') as f:
+        json.dump({'job_id': job['job_id']}, f)
+    _prune_catalog_jobs()
+    threading.Thread(target=_run_catalog_job, args=(job, lock_fd), name='catalog-job', daemon=True).start()
+    return job, True
+
+def _active_catalog_job():
+    try:
+        with open(CATALOG_ACTIVE_JOB_PATH, 'r', encoding='utf-8') as f:
+            return read_catalog_job(json.load(f).get('job_id'))
+    except (OSError, ValueError):
+        return None
+
+def _run_catalog_job(job, lock_fd):
+    """Run sync_catalog, publishing per-catalog progress about once a second"""
+    try:
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(sync_catalog, job['mode'], job['catalogs'])
+            while True:
+                try:
+                    report = future.result(timeout=1.0)
+                    break
+                except FuturesTimeout:
+                    job['heartbeat_at'] = datetime.datetime.utcnow().isoformat()
+                    _write_job(job)
+        job['catalogs'] = report.pop('catalogs')
+        job['result'] = report
+        job['status'] = 'done'
+        if all(r.get('error') for r in job['catalogs'].values()):
+            job['status'] = 'failed'
+            job['error'] = 'Failed to fetch catalogs'
+    except Exception as e:
+        logger.exception("Catalog job %s failed", job['job_id'])
+        job['status'] = 'failed'
+        job['error'] = str(e)
+    finally:
+        job['finished_at'] = datetime.datetime.utcnow().isoformat()
+        _write_job(job)
+        os.close(lock_fd)  # releases the flock
+        _catalog_job_lock.release()
+
+def _catalog_scheduler_loop():
+    while True:
+        # Jitter so workers started together don't all wake at once
+        time.sleep(CATALOG_SYNC_INTERVAL * random.uniform(0.9, 1.1))
+        last = load_catalog_sync_state().get('last_sync', {})
+        if time.time() - last.get('at', 0) < CATALOG_SYNC_INTERVAL * 0.9:
+            continue  # another worker already ran it
+        start_catalog_job(CATALOG_SYNC_MODE, trigger='schedule')
+
+def start_catalog_scheduler():
+    """Start the periodic catalog sync in this process if CATALOG_SYNC_INTERVAL is set"""
+    if CATALOG_SYNC_INTERVAL <= 0:
+        return
+    thread = _catalog_scheduler['thread']
+    if thread is None or _catalog_scheduler['pid'] != os.getpid() or not thread.is_alive():
+        _catalog_scheduler['pid'] = os.getpid()
+        _catalog_scheduler['thread'] = threading.Thread(target=_catalog_scheduler_loop, name='catalog-scheduler', daemon=True)
+        _catalog_scheduler['thread'].start()
+
 def generate_landing_links(products, write_back=True):
     """Add website slug to products if missing"""
     changed = 0
-    for p in products:
+    for i, p in enumerate(products):
         if 'website' not in p or not p['website']:
             slug = p.get('id') or p.get('sku') or slugify(p.get('title', ''))
-            p['website'] = f"/landing/{slug}"
+            # Copy instead of mutating: entries may be shared with the live catalog snapshot
+            products[i] = dict(p, website=f"/landing/{slug}")
             changed += 1
     if write_back and changed > 0:
         save_catalog_products(products)
@@ -287,135 +1906,1902 @@ def generate_landing_links(products, write_back=True):
 
 def find_product_by_slug(slug):
     """Find product by slug in website, id, sku, or title"""
-    products, _ = load_catalog()
-    for p in products:
-        if p.get('website', '').endswith(f"/{slug}"):
-            return p
-        if str(p.get('id', '')) == slug or str(p.get('sku', '')) == slug:
-            return p
-        if slugify(p.get('title', '')) == slug:
-            return p
+    snapshot = get_catalog_snapshot()
+    with span('slug_lookup'):
+        for name in PRODUCT_INDEX_KEYS:
+            pos = snapshot.index[name].get(slug)
+            if pos is not None:
+                return snapshot.products[pos]
     return None
 
-def calculate_order(product, quantity, customer_city=None, offer=None):
-    """Calculate prices with offers and shipping"""
-    price_per = product['price']
-    subtotal = price_per * quantity
-    
-    # Calculate shipping based on customer city
-    if product.get('free_shipping'):
-        shipping_applied = 0
-    elif customer_city and customer_city in SHIPPING_PRICES:
-        shipping_applied = SHIPPING_PRICES[customer_city]
-    else:
-        # Fallback to product's default shipping price
-        shipping_applied = product.get('shipping_price', 50.0)
-    
-    discount = 0
-    offer = product.get('offers', [])[-1] if not offer else offer  # latest if none specified
-    if offer:
-        if offer['type'] == 'percentage':
-            discount = subtotal * (offer['value'] / 100)
-        elif offer['type'] == 'fixed':
-            discount = min(offer['value'], subtotal)
-    total = subtotal - discount + shipping_applied
-    return subtotal, discount, shipping_applied, total
-
-def add_order_to_excel(order):
-    """Append order to addresses.xlsx sheet '0'"""
-    if not os.path.exists('addresses.xlsx'):
-        wb = Workbook()
-        wb['Sheet'].title = '0'
-        wb.save('addresses.xlsx')
-
-    def atomic_write(data):
-        with tempfile.NamedTemporaryFile(mode='w+', suffix='.xlsx', delete=False) as f:
-            temp_path = f.name
-        try:
-            orig_wb = load_workbook('addresses.xlsx')
-            if '0' not in orig_wb.sheetnames:
-                orig_wb.create_sheet('0')
-            sheet = orig_wb['0']
-            row = len(sheet['A']) + 1
-            for i, val in enumerate(data, 1):
-                sheet.cell(row=row, column=i, value=val)
-            orig_wb.save(temp_path)
-            os.replace(temp_path, 'addresses.xlsx')
-        except Exception as e:
-            print(f"Error adding to Excel: {e}")
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+def find_product_by_id(product_id):
+    """Find product by exact id"""
+    snapshot = get_catalog_snapshot()
+    pos = snapshot.index['id'].get(str(product_id))
+    return snapshot.products[pos] if pos is not None else None
 
-    # Map order to Excel columns
-    # Assuming columns as in read_file: S.O., Goods type, ..., Receiver Email, Delivery Type
-    goods = {'name': order['product']['title'], 'quantity': order['quantity'], 'price': order['price']}
-    sender = order.get('customer', {}).get('sender', {})
-    receiver = order['customer']
-    data = [
-        '',  # S.O.
-        'product',  # Goods type
-        order['product']['title'],  # Goods name
-        order['quantity'],  # Quantity
-        0.5,  # Weight
-        order['total'],  # COD
-        0,  # Insure price
-        'No',  # Whether to allow the package to be opened
-        order.get('notes', ''),  # Remark
-        sender.get('name', ''), sender.get('phone', ''), sender.get('city', ''), sender.get('area', ''), sender.get('address', ''), sender.get('email', ''),
-        receiver.get('name', ''), receiver.get('phone', ''), receiver.get('city', ''), receiver.get('area', ''), receiver.get('address', ''), receiver.get('email', ''),
-        'standard'  # Delivery Type
-    ]
-    atomic_write(data)
+API_PRODUCTS_MAX_LIMIT = 500
+# Per-catalog-version caches for /api/products: filter positions and the full encoded body
+_product_list_cache = {'filters_version': None, 'filters': None, 'body_version': None, 'body': None}
 
-def archive_and_reset_orders(archive_dir='data/archives'):
-    """Archive current addresses.xlsx to data/archives with timestamp and reset sheet '0'"""
-    if not os.path.exists('addresses.xlsx'):
-        return False
-    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-    os.makedirs(archive_dir, exist_ok=True)
-    archive_path = os.path.join(archive_dir, f'orders_{timestamp}.xlsx')
-    try:
-        import shutil
-        shutil.copy('addresses.xlsx', archive_path)
-        # Reset sheet '0'
-        wb = load_workbook('addresses.xlsx')
-        if '0' in wb.sheetnames:
-            wb['0'].delete_rows(2, wb['0'].max_row)  # keeps header
-            wb.save('addresses.xlsx')
-        return True, archive_path
-    except Exception as e:
-        print(f"Archive error: {e}")
-        return False, None
+def catalog_prefix(product):
+    """BUSINESS_CATALOGS key the product was imported from (its sku prefix)"""
+    sku = str(product.get('sku') or '')
+    return sku.split('-', 1)[0] if '-' in sku else ''
 
-# Routes
-@app.route('/')
-def index():
-    products, _ = load_catalog()
-    if not products:
-        # Fallback to first product if list
-        return render_template('index.html', products=[])
-    return render_template('index.html', products=products)
+def catalog_etag(snapshot):
+    """Validator shared by all workers: derived from the catalog file's mtime/size"""
+    return hashlib.sha256(repr(snapshot.signature or snapshot.version).encode()).hexdigest()[:16]
 
-@app.route('/api/products')
-def api_products():
-    products, _ = load_catalog()
-    return jsonify({'ok': True, 'count': len(products), 'products': products})
+def catalog_last_modified(snapshot):
+    mtimes = [mtime for _, mtime, _ in snapshot.signature or ()]
+    if not mtimes:
+        return None
+    return datetime.datetime.fromtimestamp(max(mtimes) / 1e9, datetime.timezone.utc)
 
-@app.route('/landing/<slug>')
-def product_landing(slug):
+def product_filter_positions(snapshot):
+    """Sorted product positions per brand / catalog prefix / free_shipping value"""
+    cache = _product_list_cache
+    if cache['filters_version'] != snapshot.version:
+        filters = {'brand': {}, 'catalog': {}, 'free_shipping': {}}
+        for pos, p in enumerate(snapshot.products):
+            filters['brand'].setdefault(str(p.get('brand') or '').strip().lower(), []).append(pos)
+            filters['catalog'].setdefault(catalog_prefix(p).upper(), []).append(pos)
+            filters['free_shipping'].setdefault('true' if p.get('free_shipping') else 'false', []).append(pos)
+        cache['filters'], cache['filters_version'] = filters, snapshot.version
+    return cache['filters']
+
+def full_products_body(snapshot):
+    """precompress()ed body of the unfiltered /api/products response, built once per version"""
+    cache = _product_list_cache
+    if cache['body_version'] != snapshot.version:
+        # Mapped products are copied into the body as stored, without decoding them
+        body = b''.join(itertools.chain([b'{"ok":true,"count":%d,"products":' % len(snapshot.products)],
+                                        catalog_json_chunks(snapshot.products), [b'}']))
+        cache['body'], cache['body_version'] = precompress(body), snapshot.version
+    return cache['body']
+
+# Product search: an inverted index (folded word -> sorted positions) over
+# title, brand and description. It is built once, then patched for the
+# products that changed in each new catalog version. Words are folded like
+# city names, and 'ال' words are indexed with and without the article so
+# "ساعة" finds "الساعة". Query words match as prefixes. Postings are compact
+# arrays, shared by the workers forked from the gunicorn master; a query
+# combines them as numpy masks over the whole catalog.
+SearchIndex = namedtuple('SearchIndex', 'version products fingerprints postings title_postings vocab '
+                                        'brands brand_keys brand_codes brand_names catalogs catalog_keys '
+                                        'catalog_codes prices buckets')
+SEARCH_PRICE_RANGES = (0, 250, 500, 1000, 2000, 5000)  # lower bounds of the price facet buckets
+SEARCH_MIN_PREFIX = 2  # shorter words only match whole words
+SEARCH_MAX_WORDS = 8
+SEARCH_MAX_LIMIT = 100
+SEARCH_CACHE_MAX_BYTES = int(os.getenv('SEARCH_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv('SEARCH_CACHE_MAX_ENTRIES', '1000'))
+SEARCH_CACHE_ENTRY_OVERHEAD = 2048  # bytes charged per entry for its key and facets
+INDEX_PAGE_SIZE = int(os.getenv('INDEX_PAGE_SIZE', '24'))
+
+_search = {'index': None, 'lock': threading.Lock(), 'cache': OrderedDict(), 'cache_lock': threading.Lock(),
+           'cache_bytes': 0, 'stats': {'builds': 0, 'patches': 0, 'last_build_ms': None, 'hits': 0, 'misses': 0}}
+
+def _search_words(text, cache):
+    """Set of the folded words of text, 'ال' words also without it; cache maps raw words to their forms"""
+    words = set()
+    for word in set(_WORD.findall(_fold_arabic_text(text))):
+        forms = cache.get(word)
+        if forms is None:
+            folded = word.translate(_ARABIC_LETTERS).translate(ARABIC_DIGITS)
+            forms = cache[word] = (folded, folded[2:]) if folded.startswith('ال') and len(folded) > 4 else (folded,)
+        words.update(forms)
+    return words
+
+def _search_fields(p):
+    return p.get('title'), p.get('brand'), p.get('description'), catalog_prefix(p), p.get('price')
+
+def _search_document(fields, cache):
+    """(all words, title and brand words) of a product's _search_fields()"""
+    title, brand, description, _, _ = fields
+    title_words = _search_words(f"{title or ''} {brand or ''}", cache)
+    return title_words | _search_words(description, cache), title_words
+
+def _search_facet_values(fields):
+    """(brand key, brand name, catalog prefix, price, price bucket) of a product's _search_fields()"""
+    _, brand, _, catalog, price = fields
+    brand = str(brand or '').strip()
+    try:
+        price = float(price)
+    except (TypeError, ValueError):
+        price = math.nan
+    bucket = bisect.bisect_right(SEARCH_PRICE_RANGES, price) - 1 if price == price else -1
+    return brand.lower(), brand, catalog.upper(), price, bucket
+
+def _facet_code(keys, codes, key):
+    code = codes.get(key)
+    if code is None:
+        code = codes[key] = len(keys)
+        keys.append(key)
+    return code
+
+def build_search_index(snapshot):
+    """Index every product of a snapshot"""
+    postings, title_postings, cache = {}, {}, {}
+    fingerprints, brands, catalogs = array('q'), array('I'), array('I')
+    prices, buckets = array('d'), array('b')
+    brand_keys, brand_codes, brand_names, catalog_keys, catalog_codes = [], {}, {}, [], {}
+    for pos, p in enumerate(snapshot.products):
+        fields = _search_fields(p)
+        words, title_words = _search_document(fields, cache)
+        for word in words:
+            positions = postings.get(word)
+            if positions is None:
+                positions = postings[word] = array('I')
+            positions.append(pos)
+        for word in title_words:
+            positions = title_postings.get(word)
+            if positions is None:
+                positions = title_postings[word] = array('I')
+            positions.append(pos)
+        brand, name, catalog, price, bucket = _search_facet_values(fields)
+        brand_names.setdefault(brand, name)
+        brands.append(_facet_code(brand_keys, brand_codes, brand))
+        catalogs.append(_facet_code(catalog_keys, catalog_codes, catalog))
+        prices.append(price)
+        buckets.append(bucket)
+        fingerprints.append(hash(fields))
+    return SearchIndex(snapshot.version, snapshot.products, fingerprints, postings, title_postings, sorted(postings),
+                       brands, brand_keys, brand_codes, brand_names, catalogs, catalog_keys, catalog_codes,
+                       prices, buckets)
+
+def _patch_postings(postings, removed, added):
+    """Copy of postings with the positions removed/added per word; returns (postings, new words, gone words)"""
+    postings = dict(postings)
+    new_words, gone_words = [], []
+    for word in set(removed).union(added):
+        old = postings.get(word)
+        positions = set(old or ()).difference(removed.get(word, ())).union(added.get(word, ()))
+        if positions:
+            postings[word] = array('I', sorted(positions))
+            if old is None:
+                new_words.append(word)
+        elif old is not None:
+            del postings[word]
+            gone_words.append(word)
+    return postings, new_words, gone_words
+
+def patch_search_index(index, snapshot):
+    """Return index updated for the products that differ from the ones it was built from"""
+    old_products, products = index.products, snapshot.products
+    if len(products) < len(old_products):
+        return build_search_index(snapshot)
+    fingerprints = array('q', index.fingerprints)
+    changed = {}
+    for pos, p in enumerate(products):
+        if pos < len(old_products) and p is old_products[pos]:
+            continue
+        fields = _search_fields(p)
+        fingerprint = hash(fields)
+        if pos < len(old_products):
+            if fingerprint == fingerprints[pos]:
+                continue
+            fingerprints[pos] = fingerprint
+        else:
+            fingerprints.append(fingerprint)
+        changed[pos] = fields
+    if len(changed) > len(products) // 4:
+        return build_search_index(snapshot)  # cheaper than patching most of the postings
+
+    removed, added, title_removed, title_added, cache = {}, {}, {}, {}, {}
+    brands, catalogs = array('I', index.brands), array('I', index.catalogs)
+    prices, buckets = array('d', index.prices), array('b', index.buckets)
+    brand_keys, brand_codes, brand_names = list(index.brand_keys), dict(index.brand_codes), dict(index.brand_names)
+    catalog_keys, catalog_codes = list(index.catalog_keys), dict(index.catalog_codes)
+    for pos, fields in changed.items():
+        if pos < len(old_products):
+            words, title_words = _search_document(_search_fields(old_products[pos]), cache)
+            for word in words:
+                removed.setdefault(word, set()).add(pos)
+            for word in title_words:
+                title_removed.setdefault(word, set()).add(pos)
+        words, title_words = _search_document(fields, cache)
+        for word in words:
+            added.setdefault(word, set()).add(pos)
+        for word in title_words:
+            title_added.setdefault(word, set()).add(pos)
+        brand, name, catalog, price, bucket = _search_facet_values(fields)
+        brand_names.setdefault(brand, name)
+        values = (_facet_code(brand_keys, brand_codes, brand), _facet_code(catalog_keys, catalog_codes, catalog),
+                  price, bucket)
+        if pos < len(brands):
+            brands[pos], catalogs[pos], prices[pos], buckets[pos] = values
+        else:
+            for column, value in zip((brands, catalogs, prices, buckets), values):
+                column.append(value)
+
+    postings, new_words, gone_words = _patch_postings(index.postings, removed, added)
+    title_postings, _, _ = _patch_postings(index.title_postings, title_removed, title_added)
+    vocab = index.vocab
+    if new_words or gone_words:
+        vocab = list(vocab)
+        for word in gone_words:
+            del vocab[bisect.bisect_left(vocab, word)]
+        for word in new_words:
+            bisect.insort(vocab, word)
+    return SearchIndex(snapshot.version, products, fingerprints, postings, title_postings, vocab,
+                       brands, brand_keys, brand_codes, brand_names, catalogs, catalog_keys, catalog_codes,
+                       prices, buckets)
+
+def search_index(snapshot=None):
+    """SearchIndex for the current catalog version"""
+    snapshot = snapshot or get_catalog_snapshot()
+    index = _search['index']
+    if index is not None and index.version == snapshot.version:
+        return index
+    with _search['lock']:
+        index = _search['index']
+        if index is None or index.version != snapshot.version:
+            started = time.perf_counter()
+            if index is None:
+                index = build_search_index(snapshot)
+                _search['stats']['builds'] += 1
+            else:
+                index = patch_search_index(index, snapshot)
+                _search['stats']['patches'] += 1
+            _search['stats']['last_build_ms'] = round((time.perf_counter() - started) * 1000, 3)
+            _search['index'] = index
+    return index
+
+def _mask(index, postings, words):
+    """Boolean mask over the products of the union of the postings of words"""
+    mask = np.zeros(len(index.products), dtype=bool)
+    for word in words:
+        if word in postings:
+            mask[np.frombuffer(postings[word], dtype=np.uint32)] = True
+    return mask
+
+def _match_word(index, word):
+    """Masks of the products matching word or a word it prefixes, those with it in the title/brand, exact matches"""
+    if len(word) < SEARCH_MIN_PREFIX:
+        words = [word]
+    else:
+        lo = bisect.bisect_left(index.vocab, word)
+        words = index.vocab[lo:bisect.bisect_left(index.vocab, word + '\U0010ffff', lo)]
+    return _mask(index, index.postings, words), _mask(index, index.title_postings, words), \
+        _mask(index, index.postings, [word])
+
+def search_query_words(query):
+    """Folded query words; 'ال' is dropped since documents are indexed without it too"""
+    words = []
+    for word in fold_arabic_words(str(query or '')[:200]):
+        word = word[2:] if word.startswith('ال') and len(word) > 4 else word
+        if word not in words:
+            words.append(word)
+    return words[:SEARCH_MAX_WORDS]
+
+def _search_facets(index, matched, brand, catalog, min_price, max_price):
+    """Mask of the matched products passing the filters, and facet counts (each under the other filters only)"""
+    brands = np.frombuffer(index.brands, dtype=np.uint32)
+    catalogs = np.frombuffer(index.catalogs, dtype=np.uint32)
+    buckets = np.frombuffer(index.buckets, dtype=np.int8)
+    b_ok = c_ok = p_ok = matched
+    if brand is not None:
+        b_ok = matched & (brands == index.brand_codes[brand]) if brand in index.brand_codes else matched & False
+    if catalog is not None:
+        c_ok = matched & (catalogs == index.catalog_codes[catalog]) if catalog in index.catalog_codes else matched & False
+    if min_price is not None or max_price is not None:
+        prices = np.frombuffer(index.prices, dtype=np.float64)
+        p_ok = matched & (prices >= (-math.inf if min_price is None else min_price)) & \
+            (prices < (math.inf if max_price is None else max_price))
+    brand_counts = np.bincount(brands[c_ok & p_ok], minlength=len(index.brand_keys))
+    catalog_counts = np.bincount(catalogs[b_ok & p_ok], minlength=len(index.catalog_keys))
+    bucket_counts = np.bincount(buckets[b_ok & c_ok & (buckets >= 0)], minlength=len(SEARCH_PRICE_RANGES))
+    bounds = SEARCH_PRICE_RANGES + (None,)
+    facets = {
+        'brand': sorted(({'value': key, 'name': index.brand_names.get(key, key), 'count': int(n)}
+                         for key, n in zip(index.brand_keys, brand_counts) if n and key),
+                        key=lambda f: (-f['count'], f['value'])),
+        'catalog': sorted(({'value': key, 'count': int(n)}
+                           for key, n in zip(index.catalog_keys, catalog_counts) if n and key),
+                          key=lambda f: (-f['count'], f['value'])),
+        'price': [{'from': bounds[b], 'to': bounds[b + 1], 'count': int(n)}
+                  for b, n in enumerate(bucket_counts) if n],
+    }
+    return b_ok & c_ok & p_ok, facets
+
+def _search_entry_size(entry):
+    return entry[0].nbytes + SEARCH_CACHE_ENTRY_OVERHEAD
+
+def search_products(query='', brand=None, catalog=None, min_price=None, max_price=None, snapshot=None):
+    """(uint32 array of ranked positions, facets) for a query on the current catalog version.
+
+    Every query word must match (as a whole word or a prefix); products with the
+    words in the title or brand, then whole-word matches, rank first.
+    """
+    snapshot = snapshot or get_catalog_snapshot()
+    words = search_query_words(query)
+    brand = str(brand or '').strip().lower() or None
+    catalog = str(catalog or '').strip().upper() or None
+    key = (snapshot.version, tuple(words), brand, catalog, min_price, max_price)
+    cache = _search['cache']
+    with _search['cache_lock']:
+        entry = cache.get(key)
+        if entry is not None:
+            cache.move_to_end(key)
+            _search['stats']['hits'] += 1
+            return entry
+        _search['stats']['misses'] += 1
+
+    with span('search'):
+        index = search_index(snapshot)
+        matched, scores = np.ones(len(index.products), dtype=bool), None
+        if words:
+            scores = np.zeros(len(index.products), dtype=np.int16)
+            for word in words:
+                found, titled, exact = _match_word(index, word)
+                matched &= found
+                scores += 2 * titled + exact
+        selected, facets = _search_facets(index, matched, brand, catalog, min_price, max_price)
+        positions = np.flatnonzero(selected).astype(np.uint32)
+        if scores is not None:
+            positions = positions[np.argsort(-scores[positions], kind='stable')]  # catalog order within a score
+        entry = (positions, facets)
+
+    with _search['cache_lock']:
+        for stale in [k for k in cache if k[0] != key[0]]:
+            _search['cache_bytes'] -= _search_entry_size(cache.pop(stale))
+        if key[0] == CATALOG_SNAPSHOT.version and key not in cache:
+            cache[key] = entry
+            _search['cache_bytes'] += _search_entry_size(entry)
+            while len(cache) > 1 and (_search['cache_bytes'] > SEARCH_CACHE_MAX_BYTES
+                                      or len(cache) > SEARCH_CACHE_MAX_ENTRIES):
+                _search['cache_bytes'] -= _search_entry_size(cache.popitem(last=False)[1])
+    return entry
+
+def search_stats():
+    """Index build/patch counters and result cache usage"""
+    index = _search['index']
+    return dict(_search['stats'], version=index.version if index else None, words=len(index.vocab) if index else 0,
+                cache_entries=len(_search['cache']), cache_bytes=_search['cache_bytes'])
+
+def search_args(args):
+    """Search filters from query args (min_price <= price < max_price); ValueError on a bad price"""
+    prices = {}
+    for name in ('min_price', 'max_price'):
+        value = args.get(name, '').strip()
+        prices[name] = float(value.translate(ARABIC_DIGITS)) if value else None
+        if prices[name] is not None and not math.isfinite(prices[name]):
+            raise ValueError(name)
+    return dict(query=args.get('q', ''), brand=args.get('brand') or None, catalog=args.get('catalog') or None,
+                **prices)
+
+# Pricing: each product's price, shipping and offers are compiled once per
+# catalog version into a PricingRule, so quotes are plain arithmetic.
+# Offers take optional 'priority' (default: list position, so the last one
+# wins as before), 'stackable' (applied on top of the winning offer) and
+# 'min_quantity'.
+PricingRule = namedtuple('PricingRule', 'source price free_shipping shipping_price offers')
+CompiledOffer = namedtuple('CompiledOffer', 'priority position type value min_quantity stackable')
+QUOTE_MAX_QUOTES = 100
+QUOTE_MAX_ITEMS = 50
+
+_pricing_rules = {'version': None, 'rules': {}}
+
+def _compile_offer(position, offer):
+    return CompiledOffer(
+        float(offer.get('priority', position)), position, offer.get('type'), float(offer.get('value') or 0),
+        int(offer.get('min_quantity') or 1), bool(offer.get('stackable')))
+
+def compile_pricing(product):
+    """PricingRule for one product dict"""
+    offers = [_compile_offer(i, o) for i, o in enumerate(product.get('offers') or []) if isinstance(o, dict)]
+    # Highest priority first; later offers win ties
+    offers.sort(key=lambda o: (o.priority, o.position), reverse=True)
+    return PricingRule(product, float(product['price']), bool(product.get('free_shipping')),
+                       float(product.get('shipping_price', 50.0)), tuple(offers))
+
+def pricing_rules(snapshot=None):
+    """{product id: PricingRule} for the current catalog version"""
+    snapshot = snapshot or get_catalog_snapshot()
+    if _pricing_rules['version'] != snapshot.version:
+        rules = {}
+        for p in snapshot.products:
+            try:
+                rules[str(p.get('id'))] = compile_pricing(p)
+            except (KeyError, TypeError, ValueError):
+                continue  # no usable price: not orderable
+        _pricing_rules['rules'], _pricing_rules['version'] = rules, snapshot.version
+    return _pricing_rules['rules']
+
+def _offer_discount(offer, amount):
+    if offer.type == 'percentage':
+        return amount * (offer.value / 100)
+    if offer.type == 'fixed':
+        return min(offer.value, amount)
+    return 0
+
+def line_discount(rule, quantity, subtotal):
+    """Best eligible offer, plus every eligible stackable one, capped at the subtotal"""
+    eligible = [o for o in rule.offers if o.min_quantity <= quantity]
+    best = next((o for o in eligible if not o.stackable), None)
+    discount = _offer_discount(best, subtotal) if best else 0
+    for offer in eligible:
+        if offer.stackable:
+            discount += _offer_discount(offer, subtotal - discount)
+    return min(discount, subtotal)
+
+def shipment_shipping(rules, city=None):
+    """Shipping for one shipment: free only if every line ships free, else the city rate once"""
+    paid = [rule for rule in rules if not rule.free_shipping]
+    if not paid:
+        return 0
+    city = resolve_city(city)
+    if city in SHIPPING_PRICES:
+        return SHIPPING_PRICES[city]
+    # Unknown city: the products' own fallback, charged once at the highest rate
+    return max(rule.shipping_price for rule in paid)
+
+def quote_cart(lines, city=None):
+    """Price [(PricingRule, quantity)] shipped together to city"""
+    with span('pricing'):
+        quoted = []
+        subtotal = discount = 0
+        for rule, quantity in lines:
+            line_subtotal = rule.price * quantity
+            line_disc = line_discount(rule, quantity, line_subtotal)
+            quoted.append({'product_id': str(rule.source.get('id')), 'quantity': quantity, 'unit_price': rule.price,
+                           'subtotal': line_subtotal, 'discount': line_disc})
+            subtotal += line_subtotal
+            discount += line_disc
+        shipping = shipment_shipping([rule for rule, _ in lines], city)
+    return {'lines': quoted, 'subtotal': subtotal, 'discount': discount, 'shipping': shipping,
+            'total': subtotal - discount + shipping, 'city': resolve_city(city) or city}
+
+def calculate_order(product, quantity, customer_city=None, offer=None):
+    """Calculate prices with offers and shipping"""
+    rule = pricing_rules().get(str(product.get('id')))
+    if rule is None or rule.source is not product:
+        rule = compile_pricing(product)
+    if offer:
+        # An explicit offer replaces the product's own
+        rule = rule._replace(offers=(_compile_offer(0, offer),))
+    quote = quote_cart([(rule, quantity)], customer_city)
+    return quote['subtotal'], quote['discount'], quote['shipping'], quote['total']
+
+# Speedaf upload layout: a group row followed by the column names
+SPEEDAF_HEADER_ROWS = [
+    ['Basic information'] + [None] * 8 + ['Sender information'] + [None] * 5
+    + ['Receiver information'] + [None] * 5 + ['Autres informations'],
+    ['S.O.', 'Goods type', 'Goods name', 'Quantity', 'Weight', 'COD', 'Insure price',
+     'Whether to allow the package to be opened', 'Remark',
+     'Name', 'Telephone', 'City', 'Area', 'Senders address', 'Sender Email',
+     'Name', 'Telephone', 'City', 'Area', 'Receivers address', 'Receiver Email', 'Delivery Type'],
+]
+
+def excel_row_for_order(order):
+    """Map an order to the Speedaf columns (SPEEDAF_HEADER_ROWS)"""
+    sender = order.get('customer', {}).get('sender', {})
+    receiver = order['customer']
+    return [
+        '',  # S.O.
+        'product',  # Goods type
+        order['product']['title'],  # Goods name
+        order['quantity'],  # Quantity
+        0.5,  # Weight
+        order['total'],  # COD
+        0,  # Insure price
+        'No',  # Whether to allow the package to be opened
+        order.get('notes', ''),  # Remark
+        sender.get('name', ''), sender.get('phone', ''), sender.get('city', ''), sender.get('area', ''), sender.get('address', ''), sender.get('email', ''),
+        receiver.get('name', ''), receiver.get('phone', ''), receiver.get('city', ''), receiver.get('area', ''), receiver.get('address', ''), receiver.get('email', ''),
+        'standard'  # Delivery Type
+    ]
+
+def write_orders_workbook(path, orders):
+    """Stream orders into a new Speedaf-layout workbook using openpyxl write-only mode"""
+    wb = Workbook(write_only=True)
+    sheet = wb.create_sheet('0')
+    for row in SPEEDAF_HEADER_ROWS:
+        sheet.append(row)
+    count = 0
+    for order in orders:
+        sheet.append(excel_row_for_order(order))
+        count += 1
+    dir_path = os.path.dirname(path)
+    if dir_path:
+        os.makedirs(dir_path, exist_ok=True)
+    temp_path = path + '.tmp'
+    try:
+        wb.save(temp_path)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return count
+
+def archive_and_reset_orders(archive_dir=None):
+    """Move the courier export batches and order journal to data/archives with timestamp and start new ones"""
+    archive_dir = archive_dir or ORDERS_ARCHIVE_DIR
+    timestamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    os.makedirs(archive_dir, exist_ok=True)
+    archive_path = os.path.join(archive_dir, f'orders_{timestamp}')
+    try:
+        # Block new orders so nothing lands between the last export and the rotation
+        with excel_export_lock(), orders_file_lock():
+            _flush_excel_export_locked()
+            os.makedirs(EXCEL_EXPORT_BATCH_DIR, exist_ok=True)
+            os.replace(EXCEL_EXPORT_BATCH_DIR, archive_path)
+            rotate_order_journal(archive_path + '.jsonl')
+            _save_excel_export_state({'ino': os.stat(ORDERS_JOURNAL_PATH).st_ino, 'offset': 0, 'batch': 0})
+        return True, archive_path
+    except Exception:
+        logger.exception("Archive error")
+        return False, None
+
+# Order journal: one JSON object per line, oldest first. Orders are only ever
+# appended; the newest ones are read through the order index (/api/orders),
+# the totals through the order stats.
+ORDERS_JOURNAL_PATH = 'data/orders.jsonl'
+ORDERS_LOCK_PATH = 'data/orders.lock'
+LEGACY_ORDERS_PATH = 'data/orders.json'
+ORDERS_ARCHIVE_DIR = 'data/archives'
+# Appends are fsynced at most this often (seconds); 0 fsyncs every order
+ORDER_FSYNC_INTERVAL = float(os.getenv('ORDER_FSYNC_INTERVAL', '0.2'))
+
+_journal_lock = threading.RLock()
+_journal = {'fd': None, 'ino': None, 'pid': None, 'dirty': False, 'synced_at': 0.0, 'syncer': None, 'migrated': False, 'lock_depth': 0}
+
+@contextmanager
+def orders_file_lock():
+    """Exclusive lock on the order journal, shared by all gunicorn workers"""
+    with _journal_lock:
+        if _journal['lock_depth']:
+            # Already held by this thread (flock is per open file, so don't re-open)
+            _journal['lock_depth'] += 1
+            try:
+                yield
+            finally:
+                _journal['lock_depth'] -= 1
+            return
+        os.makedirs(os.path.dirname(ORDERS_LOCK_PATH), exist_ok=True)
+        lock_fd = os.open(ORDERS_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if fcntl:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            _journal['lock_depth'] = 1
+            yield
+        finally:
+            _journal['lock_depth'] = 0
+            os.close(lock_fd)  # releases the flock
+
+def _journal_fd():
+    """Return an append fd for the journal, reopening after fork or rotation"""
+    try:
+        ino = os.stat(ORDERS_JOURNAL_PATH).st_ino
+    except OSError:
+        ino = None
+    if _journal['fd'] is not None and _journal['pid'] == os.getpid() and _journal['ino'] == ino:
+        return _journal['fd']
+    if _journal['fd'] is not None and _journal['pid'] == os.getpid():
+        _close_journal_fd()
+    fd = os.open(ORDERS_JOURNAL_PATH, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    _journal.update(fd=fd, ino=os.fstat(fd).st_ino, pid=os.getpid(), dirty=False)
+    return fd
+
+def _close_journal_fd():
+    """fsync and close our append fd (the file is about to be replaced)"""
+    fd = _journal['fd']
+    if fd is not None and _journal['pid'] == os.getpid():
+        try:
+            if _journal['dirty']:
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+    _journal.update(fd=None, ino=None, dirty=False)
+
+def _journal_syncer():
+    """Background group commit: fsync pending appends every ORDER_FSYNC_INTERVAL"""
+    while True:
+        time.sleep(ORDER_FSYNC_INTERVAL)
+        flush_order_journal()
+
+def flush_order_journal():
+    """fsync appends that have not reached the disk yet"""
+    with _journal_lock:
+        if _journal['dirty'] and _journal['fd'] is not None and _journal['pid'] == os.getpid():
+            os.fsync(_journal['fd'])
+            _journal['dirty'] = False
+            _journal['synced_at'] = time.monotonic()
+
+atexit.register(flush_order_journal)
+
+def _write_all(fd, payload):
+    view = memoryview(payload)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+def _migrate_legacy_orders():
+    """One-shot import of data/orders.json (newest first) into the journal"""
+    if _journal['migrated']:
+        return
+    _journal['migrated'] = True
+    if os.path.exists(ORDERS_JOURNAL_PATH) or not os.path.exists(LEGACY_ORDERS_PATH):
+        return
+    try:
+        with open(LEGACY_ORDERS_PATH, 'r', encoding='utf-8') as f:
+            orders = json.load(f)
+    except Exception as e:
+        logger.error("Error loading legacy orders: %s", e)
+        return
+    if not isinstance(orders, list):
+        orders = []
+    temp_path = ORDERS_JOURNAL_PATH + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        f.write(journal_header())
+        for order in reversed(orders):
+            f.write(json.dumps(order, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, ORDERS_JOURNAL_PATH)
+    # These orders are already on sheet '0' of addresses.xlsx (the old inline
+    # export), so the courier batches start after them
+    _save_excel_export_state({'ino': os.stat(ORDERS_JOURNAL_PATH).st_ino, 'offset': os.path.getsize(ORDERS_JOURNAL_PATH), 'batch': 0})
+    if orders:
+        # Keep the old file for reference, but never import it twice
+        os.replace(LEGACY_ORDERS_PATH, LEGACY_ORDERS_PATH + '.migrated')
+    logger.info("Migrated %d orders from %s to %s", len(orders), LEGACY_ORDERS_PATH, ORDERS_JOURNAL_PATH)
+
+def ensure_order_journal():
+    """Make sure the journal exists (running the legacy migration if needed)"""
+    if not _journal['migrated']:
+        with orders_file_lock():
+            _migrate_legacy_orders()
+
+def append_orders(orders):
+    """Append orders to the journal in one locked write"""
+    payload = ''.join(json.dumps(o, ensure_ascii=False) + '\n' for o in orders).encode('utf-8')
+    with span('order_persist'), orders_file_lock():
+        _migrate_legacy_orders()
+        fd = _journal_fd()
+        _write_all(fd, payload)
+        _journal['dirty'] = True
+        now = time.monotonic()
+        if ORDER_FSYNC_INTERVAL <= 0 or now - _journal['synced_at'] >= ORDER_FSYNC_INTERVAL:
+            flush_order_journal()
+        elif _journal['syncer'] is None or not _journal['syncer'].is_alive():
+            _journal['syncer'] = threading.Thread(target=_journal_syncer, name='order-journal-fsync', daemon=True)
+            _journal['syncer'].start()
+
+def append_order(order):
+    """Append a single order to the journal"""
+    append_orders([order])
+
+def _parse_journal_line(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        # Torn tail from a crashed writer; compaction drops these
+        return None
+
+# Status changes are journaled as event lines rather than by rewriting orders:
+# {"op": "status", "ids": [...], "status": "shipped", "at": "..."}. Readers
+# fold them into the orders they name; compaction bakes them in.
+ORDER_STATUSES = ('new', 'confirmed', 'shipped', 'delivered', 'returned')
+
+def is_order_entry(entry):
+    """True for order lines, False for events and unreadable lines"""
+    return isinstance(entry, dict) and 'op' not in entry
+
+# A rewritten journal (compaction, rotation, migration) starts with a
+# {"op": "generation", "id": ...} header. The OS may hand the new file the old
+# inode, so the views remember the id along with the inode to tell them apart.
+def journal_header():
+    return json.dumps({'op': 'generation', 'id': uuid.uuid4().hex}) + '\n'
+
+def journal_generation(path=ORDERS_JOURNAL_PATH):
+    """Id in the journal's header line, None if it has none (a journal never rewritten)"""
+    try:
+        with open(path, 'rb') as f:
+            line = f.readline()
+    except OSError:
+        return None
+    entry = _parse_journal_line(line) if line.endswith(b'\n') else None
+    return entry.get('id') if isinstance(entry, dict) and entry.get('op') == 'generation' else None
+
+def status_event_updates(entry):
+    """{order_id: (status, at)} for a status event line, else {}"""
+    if not isinstance(entry, dict) or entry.get('op') != 'status':
+        return {}
+    return {str(order_id): (entry.get('status'), entry.get('at')) for order_id in entry.get('ids') or ()}
+
+def apply_order_status(order, update):
+    if update:
+        order['status'], order['status_updated_at'] = update
+    return order
+
+def status_event(ids, status):
+    return {'op': 'status', 'ids': list(ids), 'status': status, 'at': datetime.datetime.utcnow().isoformat()}
+
+def iter_journal_entries(path, start=0, end=None):
+    """Yield (entry or None, offset after its line) for complete lines between start and end"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        offset = start
+        for line in f:
+            # A torn tail is picked up once its newline lands
+            if not line.endswith(b'\n') or (end is not None and offset + len(line) > end):
+                break
+            offset += len(line)
+            yield (_parse_journal_line(line) if line.strip() else None), offset
+
+def archived_order_journals():
+    """Journals moved aside by archive_and_reset_orders, oldest first"""
+    if not os.path.isdir(ORDERS_ARCHIVE_DIR):
+        return []
+    # Archive names carry a sortable timestamp
+    return [os.path.join(ORDERS_ARCHIVE_DIR, name) for name in sorted(os.listdir(ORDERS_ARCHIVE_DIR)) if name.endswith('.jsonl')]
+
+def compact_order_journal():
+    """Rewrite the journal keeping one valid line per order id, with status events applied"""
+    # Offsets change on rewrite, so export everything first and move the cursor to the end
+    with excel_export_lock(), orders_file_lock():
+        _migrate_legacy_orders()
+        _flush_excel_export_locked()
+        if not os.path.exists(ORDERS_JOURNAL_PATH):
+            return {'orders': 0, 'dropped': 0}
+        orders = {}
+        archived = OrderedDict()  # status changes for orders in archived journals
+        lines = 0
+        with open(ORDERS_JOURNAL_PATH, 'rb') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = _parse_journal_line(line)
+                if isinstance(entry, dict) and entry.get('op') == 'generation':
+                    continue  # replaced by a new header
+                lines += 1
+                if is_order_entry(entry):
+                    orders.pop(entry.get('id'), None)
+                    orders[entry.get('id')] = entry  # keep the latest copy, in arrival order
+                for order_id, update in status_event_updates(entry).items():
+                    if order_id in orders:
+                        apply_order_status(orders[order_id], update)
+                    else:
+                        archived.pop(order_id, None)
+                        archived[order_id] = update
+        events = OrderedDict()
+        for order_id, (status, at) in archived.items():
+            events.setdefault((status, at), []).append(order_id)
+        temp_path = ORDERS_JOURNAL_PATH + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(journal_header())
+            for order in orders.values():
+                f.write(json.dumps(order, ensure_ascii=False) + '\n')
+            for (status, at), ids in events.items():
+                f.write(json.dumps({'op': 'status', 'ids': ids, 'status': status, 'at': at}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        refresh_order_views()
+        _close_journal_fd()
+        os.replace(temp_path, ORDERS_JOURNAL_PATH)
+        rebase_order_views()
+        _save_excel_export_state(dict(_load_excel_export_state(), ino=os.stat(ORDERS_JOURNAL_PATH).st_ino,
+                                      offset=os.path.getsize(ORDERS_JOURNAL_PATH)))
+    return {'orders': len(orders), 'dropped': lines - len(orders) - len(events)}
+
+def rotate_order_journal(archive_path):
+    """Move the journal to archive_path and start an empty one"""
+    with orders_file_lock():
+        _migrate_legacy_orders()
+        refresh_order_views()
+        _close_journal_fd()
+        if os.path.exists(ORDERS_JOURNAL_PATH):
+            os.replace(ORDERS_JOURNAL_PATH, archive_path)
+        temp_path = ORDERS_JOURNAL_PATH + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(journal_header())
+        os.replace(temp_path, ORDERS_JOURNAL_PATH)
+        # The archived orders stay counted and searchable; only the offset starts over
+        rebase_order_views()
+
+# Order aggregates: running totals per day (with per-product and per-city
+# breakdowns) folded in from the journal as it grows. Each worker keeps its
+# own copy and only reads the bytes appended since its last look; a snapshot
+# in data/order_stats.json lets a fresh worker skip the replay.
+ORDER_STATS_PATH = 'data/order_stats.json'
+# Seconds between snapshot writes
+ORDER_STATS_PERSIST_INTERVAL = float(os.getenv('ORDER_STATS_PERSIST_INTERVAL', '30'))
+
+_order_stats_lock = threading.RLock()
+_order_stats = {'stats': None, 'persisted_at': 0.0, 'rebuilds': 0}
+
+def _empty_order_stats():
+    return {'ino': None, 'generation': None, 'offset': 0, 'total_orders': 0, 'total_sales': 0.0, 'days': {}}
+
+def order_revenue(order):
+    """Revenue of an order: subtotal after discount, shipping excluded"""
+    return float(order.get('subtotal', 0) or 0) - float(order.get('discount', 0) or 0)
+
+def _fold_order(stats, order):
+    """Add one journaled order to the aggregates"""
+    if not is_order_entry(order):
+        return
+    total = float(order.get('total', 0) or 0)
+    revenue = order_revenue(order)
+    quantity = int(order.get('quantity', 0) or 0)
+    product = order.get('product') or {}
+    day = stats['days'].setdefault(str(order.get('created_at', ''))[:10],
+                                   {'orders': 0, 'sales': 0.0, 'products': {}, 'cities': {}})
+    stats['total_orders'] += 1
+    stats['total_sales'] += total
+    day['orders'] += 1
+    day['sales'] += total
+    p = day['products'].setdefault(str(product.get('id', '')),
+                                   {'title': product.get('title', ''), 'orders': 0, 'quantity': 0, 'revenue': 0.0})
+    p['orders'] += 1
+    p['quantity'] += quantity
+    p['revenue'] += revenue
+    c = day['cities'].setdefault(order_city(order), {'orders': 0, 'sales': 0.0})
+    c['orders'] += 1
+    c['sales'] += total
+
+def _fold_journal_file(stats, path, start=0, end=None):
+    """Fold complete lines of path between start and end; returns the offset reached"""
+    offset = start
+    for entry, offset in iter_journal_entries(path, start, end):
+        _fold_order(stats, entry)
+    return offset
+
+def _load_order_stats_snapshot():
+    try:
+        with open(ORDER_STATS_PATH, 'r', encoding='utf-8') as f:
+            stats = json.load(f)
+        return stats if isinstance(stats, dict) and 'days' in stats else None
+    except (OSError, ValueError):
+        return None
+
+def _save_order_stats_snapshot(stats):
+    os.makedirs(os.path.dirname(ORDER_STATS_PATH), exist_ok=True)
+    temp_path = f'{ORDER_STATS_PATH}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(stats, f, ensure_ascii=False)
+    os.replace(temp_path, ORDER_STATS_PATH)
+    _order_stats['persisted_at'] = time.monotonic()
+
+def rebuild_order_stats():
+    """Recompute the aggregates from the archived journals and the live one"""
+    ensure_order_journal()
+    with _order_stats_lock:
+        stats = _empty_order_stats()
+        for path in archived_order_journals():
+            _fold_journal_file(stats, path)
+        if os.path.exists(ORDERS_JOURNAL_PATH):
+            stats['ino'] = os.stat(ORDERS_JOURNAL_PATH).st_ino
+            stats['generation'] = journal_generation()
+            stats['offset'] = _fold_journal_file(stats, ORDERS_JOURNAL_PATH)
+        _order_stats['stats'] = stats
+        _order_stats['rebuilds'] += 1
+        _save_order_stats_snapshot(stats)
+        return stats
+
+def refresh_order_stats():
+    """Bring the aggregates up to the end of the journal and return them"""
+    ensure_order_journal()
+    with _order_stats_lock:
+        try:
+            st = os.stat(ORDERS_JOURNAL_PATH)
+        except OSError:
+            return _order_stats['stats'] or _empty_order_stats()
+        generation = journal_generation()
+        stats = _order_stats['stats']
+        if (stats is None or stats['ino'] != st.st_ino or stats.get('generation') != generation
+                or stats['offset'] > st.st_size):
+            # New worker, or the journal was compacted/rotated: another process may
+            # already have carried the totals over to the new file
+            stats = _load_order_stats_snapshot()
+            if (stats is None or stats.get('ino') != st.st_ino or stats.get('generation') != generation
+                    or stats.get('offset', 0) > st.st_size):
+                return rebuild_order_stats()
+            _order_stats['stats'] = stats
+        if stats['offset'] < st.st_size:
+            stats['offset'] = _fold_journal_file(stats, ORDERS_JOURNAL_PATH, stats['offset'], st.st_size)
+            if time.monotonic() - _order_stats['persisted_at'] >= ORDER_STATS_PERSIST_INTERVAL:
+                _save_order_stats_snapshot(stats)
+        return stats
+
+def rebase_order_stats():
+    """Point the aggregates at a journal that was just rewritten without new orders
+
+    Callers hold orders_file_lock and call refresh_order_stats() before the rewrite.
+    """
+    with _order_stats_lock:
+        stats = _order_stats['stats']
+        if stats is None:
+            return rebuild_order_stats()
+        st = os.stat(ORDERS_JOURNAL_PATH)
+        stats['ino'], stats['generation'], stats['offset'] = st.st_ino, journal_generation(), st.st_size
+        _save_order_stats_snapshot(stats)
+        return stats
+
+def order_stats_range(date_from, date_to):
+    """Sum the daily aggregates between two ISO dates (inclusive)"""
+    stats = refresh_order_stats()
+    days, products, cities = [], {}, {}
+    totals = {'orders': 0, 'sales': 0.0}
+    for day in sorted(d for d in stats['days'] if date_from <= d <= date_to):
+        entry = stats['days'][day]
+        days.append({'date': day, 'orders': entry['orders'], 'sales': entry['sales']})
+        totals['orders'] += entry['orders']
+        totals['sales'] += entry['sales']
+        for pid, p in entry['products'].items():
+            agg = products.setdefault(pid, {'id': pid, 'title': p['title'], 'orders': 0, 'quantity': 0, 'revenue': 0.0})
+            agg['orders'] += p['orders']
+            agg['quantity'] += p['quantity']
+            agg['revenue'] += p['revenue']
+        for city, c in entry['cities'].items():
+            agg = cities.setdefault(city, {'city': city, 'orders': 0, 'sales': 0.0})
+            agg['orders'] += c['orders']
+            agg['sales'] += c['sales']
+    return {
+        'from': date_from,
+        'to': date_to,
+        'totals': totals,
+        'days': days,
+        'products': sorted(products.values(), key=lambda p: p['revenue'], reverse=True),
+        'cities': sorted(cities.values(), key=lambda c: c['orders'], reverse=True),
+    }
+
+def dashboard_stats():
+    """Header figures for the dashboard and admin pages"""
+    snapshot = get_catalog_snapshot()
+    stats = refresh_order_stats()
+    today = stats['days'].get(datetime.datetime.utcnow().date().isoformat(), {})
+    return {
+        'total_orders': stats['total_orders'],
+        'today_orders': today.get('orders', 0),
+        'today_sales': today.get('sales', 0.0),
+        'total_products': len(snapshot.products),
+        'free_shipping_products': len(product_filter_positions(snapshot)['free_shipping'].get('true', ())),
+    }
+
+# Order index: a SQLite copy of every journaled order with indexes on the
+# admin search fields, caught up from the journal the same way as the
+# aggregates. The journal stays the source of truth; the file can be
+# deleted at any time and is rebuilt on the next query.
+ORDERS_INDEX_PATH = 'data/orders_index.sqlite3'
+ORDERS_QUERY_MAX_LIMIT = 200
+ORDER_QUERY_FIELDS = ('phone', 'status', 'product_id', 'city')
+
+_order_index = {'conn': None, 'pid': None, 'lock': threading.RLock()}
+
+def normalize_phone(phone):
+    """Digits only, Arabic-Indic digits folded, +20 country code dropped"""
+    digits = re.sub(r'\D', '', str(phone or '').translate(ARABIC_DIGITS))
+    if digits.startswith('0020'):
+        digits = digits[2:]
+    if digits.startswith('20') and len(digits) == 12:
+        digits = '0' + digits[2:]
+    return digits
+
+def normalize_order_city(city):
+    return (resolve_city(city) or str(city or '').strip()).casefold()
+
+def order_city(order):
+    """Canonical city of an order: its city_id, else the customer's city resolved now"""
+    customer = order.get('customer') or {}
+    return order.get('city_id') or resolve_city(customer.get('city')) or str(customer.get('city') or '')
+
+def _order_index_conn():
+    """This process's connection, created on first use (and again after fork)"""
+    if _order_index['conn'] is None or _order_index['pid'] != os.getpid():
+        os.makedirs(os.path.dirname(ORDERS_INDEX_PATH), exist_ok=True)
+        conn = sqlite3.connect(ORDERS_INDEX_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS orders (
+                seq INTEGER PRIMARY KEY, id TEXT UNIQUE, created_at TEXT, phone TEXT,
+                status TEXT, product_id TEXT, city TEXT, total REAL, body TEXT);
+            CREATE INDEX IF NOT EXISTS orders_phone ON orders (phone, seq);
+            CREATE INDEX IF NOT EXISTS orders_status ON orders (status, seq);
+            CREATE INDEX IF NOT EXISTS orders_product ON orders (product_id, seq);
+            CREATE INDEX IF NOT EXISTS orders_city ON orders (city, seq);
+            CREATE INDEX IF NOT EXISTS orders_created ON orders (created_at);
+        ''')
+        _order_index['conn'], _order_index['pid'] = conn, os.getpid()
+    return _order_index['conn']
+
+def _order_index_position(conn):
+    """(inode, generation, offset) of the journal the index has read up to"""
+    meta = dict(conn.execute("SELECT key, value FROM meta WHERE key IN ('ino', 'generation', 'offset')"))
+    return (int(meta['ino']) if 'ino' in meta else None), (meta.get('generation') or None), int(meta.get('offset', 0))
+
+def _set_order_index_position(conn, ino, generation, offset):
+    conn.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                     [('ino', str(ino)), ('generation', generation or ''), ('offset', str(offset))])
+
+def _index_journal_file(conn, path, start=0, end=None):
+    """Upsert the orders of path between start and end; returns the offset reached"""
+    offset, rows = start, []
+    for entry, offset in iter_journal_entries(path, start, end):
+        updates = status_event_updates(entry)
+        if updates:
+            # Orders named by the event may still be in the batch
+            _upsert_order_rows(conn, rows)
+            rows = []
+            _apply_order_index_statuses(conn, updates)
+        elif is_order_entry(entry) and entry.get('id'):
+            customer = entry.get('customer') or {}
+            rows.append((
+                str(entry['id']), str(entry.get('created_at', '')), normalize_phone(customer.get('phone')),
+                str(entry.get('status', '')), str((entry.get('product') or {}).get('id', '')),
+                normalize_order_city(order_city(entry)), float(entry.get('total', 0) or 0),
+                json.dumps(entry, ensure_ascii=False),
+            ))
+        if len(rows) >= 1000:
+            _upsert_order_rows(conn, rows)
+            rows = []
+    _upsert_order_rows(conn, rows)
+    return offset
+
+def _apply_order_index_statuses(conn, updates):
+    ids = list(updates)
+    for i in range(0, len(ids), 500):
+        chunk = ids[i:i + 500]
+        found = conn.execute(f"SELECT id, body FROM orders WHERE id IN ({','.join('?' * len(chunk))})", chunk).fetchall()
+        conn.executemany('UPDATE orders SET status = ?, body = ? WHERE id = ?', [
+            (updates[order_id][0], json.dumps(apply_order_status(json.loads(body), updates[order_id]), ensure_ascii=False), order_id)
+            for order_id, body in found
+        ])
+
+def _upsert_order_rows(conn, rows):
+    # ON CONFLICT keeps the row's seq, so result order survives re-indexing
+    conn.executemany('''
+        INSERT INTO orders (id, created_at, phone, status, product_id, city, total, body)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (id) DO UPDATE SET created_at = excluded.created_at, phone = excluded.phone,
+            status = excluded.status, product_id = excluded.product_id, city = excluded.city,
+            total = excluded.total, body = excluded.body
+    ''', rows)
+
+@contextmanager
+def _sqlite_write(conn):
+    """Write transaction; BEGIN IMMEDIATE serializes the workers writing the same database"""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+def refresh_order_index():
+    """Bring the index up to the end of the journal and return the connection"""
+    ensure_order_journal()
+    with _order_index['lock']:
+        conn = _order_index_conn()
+        try:
+            st = os.stat(ORDERS_JOURNAL_PATH)
+        except OSError:
+            return conn
+        generation = journal_generation()
+        if _order_index_position(conn) == (st.st_ino, generation, st.st_size):
+            return conn
+        with _sqlite_write(conn):
+            # Re-read under the write lock: another worker may have caught up already
+            ino, indexed_generation, offset = _order_index_position(conn)
+            if ino != st.st_ino or indexed_generation != generation or offset > st.st_size:
+                # Unknown journal (first run, or the index file was deleted): start over
+                conn.execute('DELETE FROM orders')
+                for path in archived_order_journals():
+                    _index_journal_file(conn, path)
+                offset = 0
+            offset = _index_journal_file(conn, ORDERS_JOURNAL_PATH, offset, st.st_size)
+            _set_order_index_position(conn, st.st_ino, generation, offset)
+        return conn
+
+def rebase_order_index():
+    """Point the index at a journal that was just rewritten without new orders
+
+    Callers hold orders_file_lock and call refresh_order_index() before the rewrite.
+    """
+    with _order_index['lock']:
+        conn = _order_index_conn()
+        st = os.stat(ORDERS_JOURNAL_PATH)
+        with _sqlite_write(conn):
+            _set_order_index_position(conn, st.st_ino, journal_generation(), st.st_size)
+
+def query_orders(filters=None, date_from=None, date_to=None, limit=50, cursor=None):
+    """Newest-first orders matching filters; returns (orders, next_cursor)"""
+    filters = filters or {}
+    where, params = [], []
+    for field in ORDER_QUERY_FIELDS:
+        value = filters.get(field)
+        if value:
+            if field == 'phone':
+                value = normalize_phone(value)
+            elif field == 'city':
+                value = normalize_order_city(value)
+            where.append(f'{field} = ?')
+            params.append(str(value))
+    if date_from:
+        where.append('created_at >= ?')
+        params.append(date_from)
+    if date_to:
+        # created_at is a full ISO timestamp; compare against the start of the next day
+        where.append('created_at < ?')
+        params.append((datetime.date.fromisoformat(date_to) + datetime.timedelta(days=1)).isoformat())
+    if cursor:
+        where.append('seq < ?')
+        params.append(int(cursor))
+    sql = 'SELECT seq, body FROM orders'
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY seq DESC LIMIT ?'
+    params.append(limit + 1)
+    with _order_index['lock']:
+        rows = refresh_order_index().execute(sql, params).fetchall()
+    next_cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return [json.loads(body) for _, body in rows[:limit]], next_cursor
+
+def get_orders_by_ids(ids):
+    """{order_id: order} for the ids found in the index"""
+    ids = [str(order_id) for order_id in ids]
+    found = {}
+    with _order_index['lock']:
+        conn = refresh_order_index()
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for order_id, body in conn.execute(f"SELECT id, body FROM orders WHERE id IN ({','.join('?' * len(chunk))})", chunk):
+                found[order_id] = json.loads(body)
+    return found
+
+def iter_selected_orders(ids=None, filters=None, date_from=None, date_to=None):
+    """Orders by id (in the given order), or every match of the filters newest first"""
+    if ids is not None:
+        for i in range(0, len(ids), 500):
+            chunk = [str(order_id) for order_id in ids[i:i + 500]]
+            found = get_orders_by_ids(chunk)
+            for order_id in chunk:
+                if order_id in found:
+                    yield found[order_id]
+        return
+    cursor = None
+    while True:
+        orders, cursor = query_orders(filters, date_from, date_to, ORDERS_QUERY_MAX_LIMIT, cursor)
+        yield from orders
+        if cursor is None:
+            return
+
+def update_order_statuses(ids, status):
+    """Journal one status event for all known ids; returns (updated, unknown)"""
+    if status not in ORDER_STATUSES:
+        raise ValueError(f'status must be one of {", ".join(ORDER_STATUSES)}')
+    ids = list(dict.fromkeys(str(order_id) for order_id in ids))
+    known = get_orders_by_ids(ids)
+    updated = [order_id for order_id in ids if order_id in known]
+    if updated:
+        append_orders([status_event(updated, status)])
+        refresh_order_views()
+    return updated, [order_id for order_id in ids if order_id not in known]
+
+def refresh_order_views():
+    """Catch the aggregates and the search index up to the end of the journal"""
+    with span('order_views'):
+        refresh_order_stats()
+        refresh_order_index()
+
+def rebase_order_views():
+    """Carry the aggregates and the search index over to a rewritten journal"""
+    rebase_order_stats()
+    rebase_order_index()
+
+# Order reports: the whole order log (archives + live journal) as a pandas
+# frame, extended with the new tail of the live journal (or rebuilt when the
+# archives change), and grouped on demand.
+REPORT_GROUPS = ('summary', 'day', 'week', 'catalog', 'brand', 'product', 'city', 'zone')
+REPORT_CHUNK_SIZE = 50000
+REPORT_CACHE_SIZE = 64
+REPORT_COLUMNS = ['id', 'created_at', 'status', 'product_id', 'title', 'quantity',
+                  'subtotal', 'discount', 'shipping', 'total', 'city']
+REPORT_METRICS = ['orders', 'quantity', 'revenue', 'aov', 'subtotal', 'discount', 'shipping']
+
+_report_lock = threading.Lock()
+_order_frame = {'version': None, 'frame': None, 'statuses': {}, 'offset': 0}
+_report_cache = OrderedDict()  # key -> {'frame': DataFrame, 'json': precompress()ed body}
+
+def order_log_version():
+    """(path, inode, size, generation) of every journal that feeds the reports"""
+    ensure_order_journal()
+    paths = archived_order_journals()
+    if os.path.exists(ORDERS_JOURNAL_PATH):
+        paths.append(ORDERS_JOURNAL_PATH)
+    version = []
+    for path in paths:
+        st = os.stat(path)
+        version.append((path, st.st_ino, st.st_size, journal_generation(path)))
+    return tuple(version)
+
+def _report_record(order):
+    product = order.get('product') or {}
+    customer = order.get('customer') or {}
+    return (str(order.get('id', '')), order.get('created_at'), order.get('status', ''),
+            str(product.get('id', '')), product.get('title', ''), order.get('quantity'),
+            order.get('subtotal'), order.get('discount'), order.get('shipping'), order.get('total'),
+            str(order.get('city_id') or customer.get('city') or ''))
+
+def _journal_order_rows(path, start, end, statuses):
+    """(frame of order rows, offset parsed up to) for path[start:end]; status events go into statuses"""
+    frames, records, offset = [], [], start
+    for entry, offset in iter_journal_entries(path, start, end):
+        if is_order_entry(entry):
+            records.append(_report_record(entry))
+            if len(records) >= REPORT_CHUNK_SIZE:
+                frames.append(pd.DataFrame.from_records(records, columns=REPORT_COLUMNS))
+                records = []
+        else:
+            statuses.update(status_event_updates(entry))
+    frames.append(pd.DataFrame.from_records(records, columns=REPORT_COLUMNS))
+    return pd.concat(frames, ignore_index=True), offset
+
+def _typed_order_rows(df):
+    for column in ('quantity', 'subtotal', 'discount', 'shipping', 'total'):
+        df[column] = pd.to_numeric(df[column], errors='coerce').fillna(0)
+    # Same definition as order_revenue(), which /api/stats uses
+    df['revenue'] = df['subtotal'] - df['discount']
+    df['created_at'] = pd.to_datetime(df['created_at'], errors='coerce')
+    # Canonical city, resolved once per distinct spelling
+    df['city'] = df['city'].map({city: resolve_city(city) or city for city in df['city'].unique()})
+    # Shipping zone: the SHIPPING_PRICES tier of the destination city
+    df['zone'] = df['city'].map(SHIPPING_PRICES).map(lambda price: f'{price:g}', na_action='ignore').fillna('other')
+    return df
+
+def _apply_report_statuses(df, statuses):
+    if statuses:
+        latest = pd.Series({order_id: update[0] for order_id, update in statuses.items()}, dtype=object)
+        df['status'] = df['id'].map(latest).fillna(df['status'])
+    return df
+
+def load_orders_frame(version):
+    """One row per order from the journals in version, with status events applied.
+
+    Returns (frame, statuses, offset parsed up to in the last journal).
+    """
+    frames, statuses, offset = [], {}, 0
+    for path, _, size, _ in version:
+        frame, offset = _journal_order_rows(path, 0, size, statuses)
+        frames.append(frame)
+    if not frames:
+        frames.append(pd.DataFrame(columns=REPORT_COLUMNS))
+    df = _typed_order_rows(pd.concat(frames, ignore_index=True))
+    return _apply_report_statuses(df, statuses), statuses, offset
+
+def _order_frame_tail(version):
+    """Journal bytes (path, start, end) that extend the cached frame to version, or None
+
+    Only the live journal growing in place is a tail; a new archive or a
+    rotated journal means a full reload.
+    """
+    cached = _order_frame['version']
+    if not cached or len(cached) != len(version) or cached[:-1] != version[:-1]:
+        return None
+    (path, ino, size, generation), (new_path, new_ino, new_size, new_generation) = cached[-1], version[-1]
+    if (path, ino, generation) != (new_path, new_ino, new_generation) or new_size < size:
+        return None
+    return path, _order_frame['offset'], new_size
+
+def orders_frame():
+    """Cached load_orders_frame() for the current order log
+
+    New orders in the live journal are parsed from where the last load
+    stopped and appended, so an order costs its own line, not the whole log.
+    """
+    version = order_log_version()
+    if _order_frame['version'] == version:
+        return _order_frame['frame'], version
+    tail = _order_frame_tail(version)
+    if tail is None:
+        frame, statuses, offset = load_orders_frame(version)
+    else:
+        path, start, end = tail
+        statuses = _order_frame['statuses']
+        events = {}
+        rows, offset = _journal_order_rows(path, start, end, events)
+        statuses.update(events)
+        # Earlier events can name orders appended now; new events can name any order
+        frame = pd.concat([_apply_report_statuses(_order_frame['frame'].copy(), events),
+                           _apply_report_statuses(_typed_order_rows(rows), statuses)], ignore_index=True)
+    _order_frame.update(version=version, frame=frame, statuses=statuses, offset=offset)
+    return frame, version
+
+def _report_keys(df, group, snapshot):
+    if group == 'day':
+        return df['created_at'].dt.strftime('%Y-%m-%d').rename('day')
+    if group == 'week':
+        # Weeks start on Monday
+        return df['created_at'].dt.to_period('W').dt.start_time.dt.strftime('%Y-%m-%d').rename('week')
+    if group in ('catalog', 'brand'):
+        lookup = {str(p.get('id', '')): catalog_prefix(p) if group == 'catalog' else str(p.get('brand') or '')
+                  for p in snapshot.products}
+        return df['product_id'].map(lookup).fillna('').rename(group)
+    if group == 'product':
+        return df['product_id']
+    return df[group]
+
+def order_report(group, date_from=None, date_to=None, status=None):
+    """Cache entry {'frame', 'json'} and its key for _build_order_report()"""
+    with _report_lock:
+        df, version = orders_frame()
+        snapshot = get_catalog_snapshot()
+        key = (version, snapshot.version, group, date_from, date_to, status)
+        if key not in _report_cache:
+            _report_cache[key] = {'frame': _build_order_report(df, snapshot, group, date_from, date_to, status), 'json': None}
+            while len(_report_cache) > REPORT_CACHE_SIZE:
+                _report_cache.popitem(last=False)
+        _report_cache.move_to_end(key)
+        entry = _report_cache[key]
+        if entry['json'] is None:
+            entry['json'] = precompress(json.dumps({'ok': True, 'report': group, 'rows': entry['frame'].to_dict('records')}, ensure_ascii=False))
+        return entry, key
+
+def _build_order_report(df, snapshot, group, date_from, date_to, status):
+    """Revenue, order count, AOV, discount and shipping per group as a DataFrame"""
+
+    mask = pd.Series(True, index=df.index)
+    if date_from:
+        mask &= df['created_at'] >= pd.Timestamp(date_from)
+    if date_to:
+        mask &= df['created_at'] < pd.Timestamp(date_to) + pd.Timedelta(days=1)
+    if status:
+        mask &= df['status'] == status
+    df = df[mask]
+
+    aggregations = {'orders': ('id', 'size'), 'quantity': ('quantity', 'sum'), 'revenue': ('revenue', 'sum'),
+                    'subtotal': ('subtotal', 'sum'), 'discount': ('discount', 'sum'), 'shipping': ('shipping', 'sum')}
+    if group == 'summary':
+        report = df.assign(period='all').groupby('period').agg(**aggregations).reset_index()
+    else:
+        if group == 'product':
+            aggregations['title'] = ('title', 'last')
+        report = df.groupby(_report_keys(df, group, snapshot)).agg(**aggregations).reset_index()
+    report['aov'] = (report['revenue'] / report['orders'].where(report['orders'] > 0)).fillna(0).round(2)
+    if group in ('day', 'week'):
+        report = report.sort_values(group)
+    elif group != 'summary':
+        report = report.sort_values('revenue', ascending=False)
+    return report[[c for c in report.columns if c not in REPORT_METRICS] + REPORT_METRICS].reset_index(drop=True)
+
+# Excel export queue: the order journal doubles as the durable queue. A
+# background thread writes the orders pending past the saved journal offset
+# into a new numbered batch workbook (orders_000001.xlsx, ...), so a flush
+# costs only its own orders and checkout never touches a workbook. Archiving
+# moves the batch folder aside. addresses.xlsx is reference data only.
+EXCEL_EXPORT_DIR = 'data/exports'
+EXCEL_EXPORT_BATCH_DIR = os.path.join(EXCEL_EXPORT_DIR, 'current')
+EXCEL_EXPORT_STATE_PATH = 'data/excel_export.json'
+EXCEL_EXPORT_LOCK_PATH = 'data/excel_export.lock'
+# Seconds to wait after an order so a burst lands in one workbook save
+EXCEL_EXPORT_DELAY = float(os.getenv('EXCEL_EXPORT_DELAY', '2.0'))
+# Seconds between idle checks for orders journaled by other workers
+EXCEL_EXPORT_POLL = float(os.getenv('EXCEL_EXPORT_POLL', '30'))
+
+_excel_export = {'thread': None, 'pid': None, 'event': threading.Event(),
+                 'flushes': 0, 'exported': 0, 'errors': 0, 'last_error': None,
+                 'last_flush_ms': 0.0, 'last_flush_at': None}
+
+@contextmanager
+def excel_export_lock(blocking=True):
+    """flock on the export cursor; yields False if another worker holds it"""
+    os.makedirs(os.path.dirname(EXCEL_EXPORT_LOCK_PATH), exist_ok=True)
+    lock_fd = os.open(EXCEL_EXPORT_LOCK_PATH, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+        yield True
+    finally:
+        os.close(lock_fd)
+
+def _load_excel_export_state():
+    try:
+        with open(EXCEL_EXPORT_STATE_PATH, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'ino': None, 'offset': 0, 'batch': 0}
+
+def _save_excel_export_state(state):
+    temp_path = EXCEL_EXPORT_STATE_PATH + '.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(temp_path, EXCEL_EXPORT_STATE_PATH)
+
+def _pending_journal_range(state):
+    """Return (ino, start, end) of journal bytes not yet exported"""
+    try:
+        st = os.stat(ORDERS_JOURNAL_PATH)
+    except OSError:
+        return None, 0, 0
+    start = state.get('offset', 0) if state.get('ino') == st.st_ino else 0
+    return st.st_ino, min(start, st.st_size), st.st_size
+
+def excel_export_batches():
+    """Batch workbooks written since the last archive, oldest first"""
+    if not os.path.isdir(EXCEL_EXPORT_BATCH_DIR):
+        return []
+    return [os.path.join(EXCEL_EXPORT_BATCH_DIR, name) for name in sorted(os.listdir(EXCEL_EXPORT_BATCH_DIR))
+            if name.startswith('orders_') and name.endswith('.xlsx')]
+
+def _flush_excel_export_locked():
+    """Export pending journal orders as the next batch workbook; caller holds excel_export_lock"""
+    state = _load_excel_export_state()
+    ino, start, end = _pending_journal_range(state)
+    if ino is None or start >= end:
+        return 0
+    started = time.perf_counter()
+    orders, offset = [], start
+    # Only complete lines; a half-written tail is picked up next time
+    for entry, offset in iter_journal_entries(ORDERS_JOURNAL_PATH, start, end):
+        if is_order_entry(entry):
+            orders.append(entry)
+    if offset == start:
+        return 0
+    # The batch number only advances with the saved offset, so a flush that
+    # dies before saving rewrites the same workbook instead of duplicating it
+    batch = state.get('batch', 0)
+    if orders:
+        batch += 1
+        with span('excel_export'):
+            write_orders_workbook(os.path.join(EXCEL_EXPORT_BATCH_DIR, f'orders_{batch:06d}.xlsx'), orders)
+    _save_excel_export_state({'ino': ino, 'offset': offset, 'batch': batch})
+    _excel_export['flushes'] += 1
+    _excel_export['exported'] += len(orders)
+    _excel_export['last_flush_ms'] = round((time.perf_counter() - started) * 1000, 3)
+    _excel_export['last_flush_at'] = datetime.datetime.utcnow().isoformat()
+    return len(orders)
+
+def flush_excel_export(blocking=True):
+    """Export pending orders now; returns rows written (None if another worker is flushing)"""
+    with excel_export_lock(blocking) as acquired:
+        if not acquired:
+            return None
+        try:
+            return _flush_excel_export_locked()
+        except Exception as e:
+            _excel_export['errors'] += 1
+            _excel_export['last_error'] = str(e)
+            logger.exception("Error exporting orders to Excel")
+            return 0
+
+def _excel_export_worker():
+    event = _excel_export['event']
+    while True:
+        event.wait(EXCEL_EXPORT_POLL)
+        if event.is_set():
+            time.sleep(EXCEL_EXPORT_DELAY)  # coalesce the burst
+            event.clear()
+        flush_excel_export(blocking=False)
+        # Keep the stats and the order index warm; their readers also catch up on demand
+        try:
+            refresh_order_views()
+        except Exception:
+            logger.exception("Error updating order stats/index")
+
+def schedule_excel_export():
+    """Wake (or start) this process's export thread"""
+    thread = _excel_export['thread']
+    if thread is None or _excel_export['pid'] != os.getpid() or not thread.is_alive():
+        with _journal_lock:
+            thread = _excel_export['thread']
+            if thread is None or _excel_export['pid'] != os.getpid() or not thread.is_alive():
+                _excel_export['event'] = threading.Event()
+                _excel_export['pid'] = os.getpid()
+                _excel_export['thread'] = threading.Thread(target=_excel_export_worker, name='excel-export', daemon=True)
+                _excel_export['thread'].start()
+    _excel_export['event'].set()
+
+def excel_export_status():
+    """Queue depth and flush latency of the Excel export"""
+    ino, start, end = _pending_journal_range(_load_excel_export_state())
+    pending, oldest = 0, None
+    if ino is not None and end > start:
+        # Status events share the journal but are not exported
+        for entry, _ in iter_journal_entries(ORDERS_JOURNAL_PATH, start, end):
+            if is_order_entry(entry):
+                pending += 1
+                oldest = oldest or entry.get('created_at')
+    return {
+        'path': EXCEL_EXPORT_BATCH_DIR,
+        'batches': len(excel_export_batches()),
+        'pending_orders': pending,
+        'pending_bytes': end - start,
+        'oldest_pending_at': oldest,
+        'flushes': _excel_export['flushes'],
+        'exported': _excel_export['exported'],
+        'errors': _excel_export['errors'],
+        'last_error': _excel_export['last_error'],
+        'last_flush_ms': _excel_export['last_flush_ms'],
+        'last_flush_at': _excel_export['last_flush_at'],
+    }
+
+# Order intake guards. Each order is claimed under its Idempotency-Key
+# header (if sent) and under a hash of product, quantity and phone, in a
+# small SQLite store shared by the workers. A retry or double-tap replays
+# the first response instead of creating a second order; a claim still in
+# flight makes the duplicate wait for it. The per-phone rate limit is kept
+# in memory (per worker) and runs before any file is touched.
+IDEMPOTENCY_PATH = 'data/idempotency.sqlite3'
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', str(24 * 3600)))  # seconds a header key is remembered
+DUPLICATE_ORDER_WINDOW = int(os.getenv('DUPLICATE_ORDER_WINDOW', '600'))  # same product/quantity/phone
+IDEMPOTENCY_MAX_KEYS = int(os.getenv('IDEMPOTENCY_MAX_KEYS', '100000'))
+IDEMPOTENCY_PENDING_TIMEOUT = 30  # seconds before a claim left by a crashed worker can be taken over
+IDEMPOTENCY_WAIT = 3.0  # seconds a duplicate waits for the first request to finish
+IDEMPOTENCY_PRUNE_INTERVAL = 60
+# Orders per phone per window, 0 to disable. Counted in each worker's memory
+# so a flood is rejected without disk I/O: with WEB_CONCURRENCY workers a phone
+# can get up to WEB_CONCURRENCY * ORDER_RATE_LIMIT orders through, and a
+# worker recycled by GUNICORN_MAX_REQUESTS starts counting from zero.
+ORDER_RATE_LIMIT = int(os.getenv('ORDER_RATE_LIMIT', '5'))
+ORDER_RATE_WINDOW = int(os.getenv('ORDER_RATE_WINDOW', '600'))
+ORDER_RATE_MAX_PHONES = 50000
+
+_idempotency = {'conn': None, 'pid': None, 'lock': threading.Lock(), 'pruned_at': 0.0,
+                'stats': {'claims': 0, 'replays': 0, 'conflicts': 0, 'waits': 0}}
+_order_rate = {'hits': {}, 'lock': threading.Lock(), 'rejected': 0}
+
+def _recent_order_hits(phone, now):
+    return [hit for hit in _order_rate['hits'].get(phone, ()) if now - hit[0] < ORDER_RATE_WINDOW]
+
+def check_order_rate(phone, keys):
+    """0 if phone may order now, else the seconds until it may (sliding window, this worker only).
+
+    A request carrying the keys of an order this worker already took is let
+    through, so retries reach the idempotency store and get their replay.
+    """
+    if ORDER_RATE_LIMIT <= 0:
+        return 0
+    now = time.monotonic()
+    names = {key for key, _ in keys}
+    with _order_rate['lock']:
+        recent = _recent_order_hits(phone, now)
+        if len(recent) < ORDER_RATE_LIMIT or any(names.intersection(hit[1]) for hit in recent):
+            return 0
+        _order_rate['hits'][phone] = recent
+        _order_rate['rejected'] += 1
+        return max(1, math.ceil(ORDER_RATE_WINDOW - (now - recent[0][0])))
+
+def record_order_rate(phone, keys):
+    """Count an order that was actually written against phone's rate limit"""
+    if ORDER_RATE_LIMIT <= 0:
+        return
+    now = time.monotonic()
+    with _order_rate['lock']:
+        hits = _order_rate['hits']
+        hits[phone] = _recent_order_hits(phone, now) + [(now, tuple(key for key, _ in keys))]
+        if len(hits) > ORDER_RATE_MAX_PHONES:
+            for key in [key for key, recent in hits.items() if now - recent[-1][0] >= ORDER_RATE_WINDOW]:
+                del hits[key]
+
+ORDER_CONTENT_FIELDS = ('name', 'city', 'area', 'address')
+
+def order_idempotency_keys(product_id, quantity, phone, customer, header_key=None):
+    """[(store key, ttl)] for an order: the client's key, then its content within DUPLICATE_ORDER_WINDOW.
+
+    The content covers the folded customer fields too, so a resubmission
+    that corrects the address is a new order, not a replay of the old one.
+    """
+    keys = []
+    if header_key:
+        keys.append(('h:' + hashlib.sha256(header_key.encode()).hexdigest(), IDEMPOTENCY_TTL))
+    content = json.dumps([str(product_id), quantity, phone] +
+                         [' '.join(fold_arabic_words(customer.get(field))) for field in ORDER_CONTENT_FIELDS])
+    keys.append(('o:' + hashlib.sha256(content.encode()).hexdigest(), DUPLICATE_ORDER_WINDOW))
+    return keys
+
+def _idempotency_conn():
+    """This process's connection, created on first use (and again after fork)"""
+    if _idempotency['conn'] is None or _idempotency['pid'] != os.getpid():
+        os.makedirs(os.path.dirname(IDEMPOTENCY_PATH), exist_ok=True)
+        conn = sqlite3.connect(IDEMPOTENCY_PATH, timeout=30, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript('''
+            CREATE TABLE IF NOT EXISTS claims (
+                key TEXT PRIMARY KEY, fingerprint TEXT, status INTEGER, body TEXT,
+                created_at REAL, expires_at REAL);
+            CREATE INDEX IF NOT EXISTS claims_expires ON claims (expires_at);
+        ''')
+        _idempotency['conn'], _idempotency['pid'] = conn, os.getpid()
+    return _idempotency['conn']
+
+def _prune_idempotency(conn, now):
+    """Drop expired claims, then the oldest ones past IDEMPOTENCY_MAX_KEYS"""
+    conn.execute('DELETE FROM claims WHERE expires_at <= ?', (now,))
+    conn.execute('''
+        DELETE FROM claims WHERE key IN (
+            SELECT key FROM claims ORDER BY expires_at
+            LIMIT max(0, (SELECT count(*) FROM claims) - ?))
+    ''', (IDEMPOTENCY_MAX_KEYS,))
+
+def claim_idempotency_keys(keys, fingerprint):
+    """Claim keys for a new request.
+
+    Returns ('claimed', None), ('replay', (status, body)) for a finished
+    duplicate, ('pending', None) while the first request is still running,
+    or ('conflict', None) when a client key was used for a different request.
+    """
+    now = time.time()
+    with _idempotency['lock']:
+        conn = _idempotency_conn()
+        with _sqlite_write(conn):
+            if now - _idempotency['pruned_at'] >= IDEMPOTENCY_PRUNE_INTERVAL:
+                _prune_idempotency(conn, now)
+                _idempotency['pruned_at'] = now
+            names = [key for key, _ in keys]
+            rows = conn.execute(
+                f"SELECT key, fingerprint, status, body, created_at FROM claims "
+                f"WHERE key IN ({','.join('?' * len(names))}) AND expires_at > ?", names + [now]).fetchall()
+            for key, stored, status, body, created_at in sorted(rows, key=lambda row: names.index(row[0])):
+                if key.startswith('h:') and stored != fingerprint:
+                    _idempotency['stats']['conflicts'] += 1
+                    return 'conflict', None
+                if status is not None:
+                    _idempotency['stats']['replays'] += 1
+                    return 'replay', (status, body)
+                if now - created_at < IDEMPOTENCY_PENDING_TIMEOUT:
+                    return 'pending', None
+            conn.executemany('INSERT OR REPLACE INTO claims VALUES (?, ?, NULL, NULL, ?, ?)',
+                             [(key, fingerprint, now, now + ttl) for key, ttl in keys])
+    _idempotency['stats']['claims'] += 1
+    return 'claimed', None
+
+def complete_idempotency_keys(keys, status, body):
+    """Store the response to replay for the claimed keys"""
+    now = time.time()
+    with _idempotency['lock']:
+        conn = _idempotency_conn()
+        conn.executemany('UPDATE claims SET status = ?, body = ?, expires_at = ? WHERE key = ?',
+                         [(status, body, now + ttl, key) for key, ttl in keys])
+
+def release_idempotency_keys(keys):
+    """Forget claims whose request failed, so a retry runs again"""
+    with _idempotency['lock']:
+        conn = _idempotency_conn()
+        conn.executemany('DELETE FROM claims WHERE key = ? AND status IS NULL', [(key,) for key, _ in keys])
+
+def wait_idempotency_claim(keys, fingerprint):
+    """claim_idempotency_keys(), waiting up to IDEMPOTENCY_WAIT while the first request is still running"""
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    outcome, response = claim_idempotency_keys(keys, fingerprint)
+    if outcome == 'pending':
+        _idempotency['stats']['waits'] += 1
+    while outcome == 'pending' and time.monotonic() < deadline:
+        time.sleep(0.05)
+        outcome, response = claim_idempotency_keys(keys, fingerprint)
+    return outcome, response
+
+def order_intake_stats():
+    with _order_rate['lock']:
+        phones = len(_order_rate['hits'])
+    return dict(_idempotency['stats'], rate_limited=_order_rate['rejected'], rate_limit_phones=phones)
+
+# Routes
+@app.route('/')
+def index():
+    snapshot = get_catalog_snapshot()
+    try:
+        filters = search_args(request.args)
+    except ValueError:
+        filters = search_args({'q': request.args.get('q', '')})
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+    except ValueError:
+        page = 1
+    positions, facets = search_products(snapshot=snapshot, **filters)
+    pages = max(1, -(-len(positions) // INDEX_PAGE_SIZE))
+    page = min(page, pages)
+    start = (page - 1) * INDEX_PAGE_SIZE
+    products = [snapshot.products[pos] for pos in positions[start:start + INDEX_PAGE_SIZE].tolist()]
+    # Current query args, for the facet and page links
+    args = {k: v for k, v in request.args.items() if k in ('q', 'brand', 'catalog', 'min_price', 'max_price') and v}
+    with span('render'):
+        return render_template('index.html', products=products, facets=facets, total=len(positions),
+                               page=page, pages=pages, args=args)
+
+@app.route('/api/search')
+def api_search():
+    snapshot = get_catalog_snapshot()
+    last_modified = catalog_last_modified(snapshot)
+    etag = f"{catalog_etag(snapshot)}-{hashlib.sha256(request.query_string).hexdigest()[:12]}"
+    if is_not_modified(etag, last_modified):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    try:
+        filters = search_args(request.args)
+        limit = max(1, min(int(request.args.get('limit', 20)), SEARCH_MAX_LIMIT))
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        return jsonify({'error': 'Invalid search parameters'}), 400
+
+    positions, facets = search_products(snapshot=snapshot, **filters)
+    fields = [f for f in request.args.get('fields', '').split(',') if f]
+    products = []
+    for pos in positions[offset:offset + limit].tolist():
+        p = snapshot.products[pos]
+        products.append({f: p[f] for f in fields if f in p} if fields else p)
+
+    payload = {'ok': True, 'query': filters['query'], 'total': len(positions), 'count': len(products),
+               'offset': offset, 'products': products, 'facets': facets}
+    if offset + len(products) < len(positions):
+        payload['next_offset'] = offset + len(products)
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/products')
+def api_products():
+    snapshot = get_catalog_snapshot()
+    last_modified = catalog_last_modified(snapshot)
+    if not request.args:
+        # Common unfiltered call: served from the body encoded once per catalog version
+        return precompressed_response(full_products_body(snapshot), last_modified=last_modified)
+
+    etag = f"{catalog_etag(snapshot)}-{hashlib.sha256(request.query_string).hexdigest()[:12]}"
+    if is_not_modified(etag, last_modified):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    try:
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+        offset = max(0, int(request.args.get('offset', 0)))
+        cursor = int(request.args['cursor']) if 'cursor' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'Invalid pagination parameters'}), 400
+    if limit is not None:
+        limit = max(1, min(limit, API_PRODUCTS_MAX_LIMIT))
+
+    # Filters: brand (case-insensitive), catalog (sku prefix from BUSINESS_CATALOGS), free_shipping
+    filters = product_filter_positions(snapshot)
+    selected = None
+    for name, value in (('brand', request.args.get('brand', '').strip().lower() or None),
+                        ('catalog', request.args.get('catalog', '').strip().upper() or None),
+                        ('free_shipping', request.args.get('free_shipping', '').strip().lower() or None)):
+        if value is None:
+            continue
+        if name == 'free_shipping':
+            value = 'true' if value in ('1', 'true', 'yes') else 'false'
+        positions = filters[name].get(value, [])
+        selected = positions if selected is None else sorted(set(selected).intersection(positions))
+    if selected is None:
+        selected = range(len(snapshot.products))
+
+    start = bisect.bisect_right(selected, cursor) if cursor is not None else offset
+    page = selected[start:start + limit] if limit is not None else selected[start:]
+    fields = [f for f in request.args.get('fields', '').split(',') if f]
+    products = []
+    for pos in page:
+        p = snapshot.products[pos]
+        products.append({f: p[f] for f in fields if f in p} if fields else p)
+
+    payload = {'ok': True, 'count': len(products), 'total': len(selected), 'products': products}
+    if limit is not None and start + len(page) < len(selected):
+        payload['next_cursor'] = str(page[-1])
+        payload['next_offset'] = start + len(page)
+    response = jsonify(payload)
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/img/<image_hash>/<int:width>')
+def product_image(image_hash, width):
+    if not re.fullmatch(r'[0-9a-f]{32}', image_hash) or width not in IMAGE_WIDTHS:
+        return jsonify({'error': 'الصورة غير موجودة'}), 404
+    fmt = 'webp' if request.accept_mimetypes['image/webp'] else 'jpeg'
+    path, mimetype = image_path(image_hash, f'{width}.{fmt}'), IMAGE_MIMETYPES[fmt]
+    if not os.path.exists(path):
+        # Not resized (no Pillow when it was cached): serve the original
+        path, fmt = image_path(image_hash, 'source'), 'source'
+        if not os.path.exists(path):
+            return jsonify({'error': 'الصورة غير موجودة'}), 404
+        with open(path, 'rb') as f:
+            mimetype = _sniff_image_type(f.read(12)) or 'application/octet-stream'
+    # Content-addressed, so a URL never changes meaning. send_file resolves
+    # relative paths against the app root, data/ is relative to the cwd
+    response = send_file(os.path.abspath(path), mimetype=mimetype, etag=f'{image_hash}-{width}-{fmt}', conditional=True)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.vary.add('Accept')
+    return response
+
+@app.route('/landing/<slug>')
+def product_landing(slug):
     product = find_product_by_slug(slug)
-    print(f"Product found: {product is not None}")
-    print(f"City areas dict size: {len(CITY_AREA_DICT)}")
-    print(f"Sample city areas: {dict(list(CITY_AREA_DICT.items())[:3])}")
-    
+    get_city_area_dict()
+
+    if not product:
+        # Fallback
+        products, _ = load_catalog()
+        product = products[0] if products else None
     if product:
-        return render_template('product_landing.html', product=product, city_areas=dict(CITY_AREA_DICT))
-    # Fallback
-    products, _ = load_catalog()
-    if products:
-        return render_template('product_landing.html', product=products[0], city_areas=dict(CITY_AREA_DICT))
+        return precompressed_response(render_landing_page(product), mimetype='text/html')
     return render_template('index.html', products=[])
 
+@app.route('/api/city_areas')
+def api_city_areas():
+    return precompressed_response(city_area_bodies(), cache_control=_city_area_cache_control())
+
+@app.route('/api/city_areas/<city>')
+def api_city_area(city):
+    bodies = city_area_bodies(city)
+    if bodies is None and resolve_city(city):
+        bodies = city_area_bodies(resolve_city(city))
+    if bodies is None:
+        return jsonify({'error': 'المدينة غير موجودة'}), 404
+    return precompressed_response(bodies, cache_control=_city_area_cache_control())
+
+def parse_quantity(value):
+    """Ordered quantity as a positive int; raises ValueError with the customer message"""
+    try:
+        quantity = int(value)
+    except (TypeError, ValueError):
+        quantity = 0
+    if quantity < 1:
+        raise ValueError('الكمية غير صحيحة')
+    return quantity
+
+def _quote_lines(items, rules):
+    """[(PricingRule, quantity)] for the request's items; raises ValueError with the customer message"""
+    if not isinstance(items, list) or not items:
+        raise ValueError('السلة فارغة')
+    if len(items) > QUOTE_MAX_ITEMS:
+        raise ValueError(f'الحد الأقصى {QUOTE_MAX_ITEMS} منتج في السلة')
+    lines = []
+    for item in items:
+        item = item if isinstance(item, dict) else {}
+        rule = rules.get(str(item.get('product_id')))
+        if rule is None:
+            raise ValueError(f"المنتج غير موجود: {item.get('product_id')}")
+        lines.append((rule, parse_quantity(item.get('quantity', 1))))
+    return lines
+
+@app.route('/api/quote', methods=['POST'])
+def api_quote():
+    """Price carts without placing an order: {items, city}, {items, cities} or {carts: [{items, city}]}"""
+    data = request.get_json(silent=True) or {}
+    if 'carts' in data:
+        carts = data['carts'] if isinstance(data['carts'], list) else []
+        requested = [((cart or {}).get('items'), (cart or {}).get('city')) for cart in carts if isinstance(cart, dict)]
+    elif 'cities' in data:
+        cities = data['cities'] if isinstance(data['cities'], list) else []
+        requested = [(data.get('items'), city) for city in cities]
+    else:
+        requested = [(data.get('items'), data.get('city'))]
+    if not requested:
+        return jsonify({'error': 'لا توجد سلة للتسعير'}), 400
+    if len(requested) > QUOTE_MAX_QUOTES:
+        return jsonify({'error': f'الحد الأقصى {QUOTE_MAX_QUOTES} تسعيرة في الطلب'}), 400
+
+    rules = pricing_rules()
+    quotes = []
+    try:
+        for items, city in requested:
+            quote = quote_cart(_quote_lines(items, rules), city)
+            for amounts in [quote] + quote['lines']:
+                for key in ('subtotal', 'discount', 'shipping', 'total'):
+                    if key in amounts:
+                        amounts[key] = round(amounts[key], 2)
+            quotes.append(quote)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'ok': True, 'quotes': quotes})
+
 @app.route('/api/landing_order', methods=['POST'])
 def landing_order():
     try:
@@ -433,12 +3819,16 @@ def landing_order():
                     pass
 
         product_id = data.get('product_id')
-        quantity = int(data.get('quantity', 1))
         customer = data.get('customer', {})
 
         # Validate required fields
         if not product_id:
             return jsonify({'error': 'معرف المنتج مطلوب'}), 400
+
+        try:
+            quantity = parse_quantity(data.get('quantity', 1))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         if not customer.get('name'):
             return jsonify({'error': 'اسم المستلم مطلوب'}), 400
@@ -446,14 +3836,48 @@ def landing_order():
         if not customer.get('phone'):
             return jsonify({'error': 'هاتف المستلم مطلوب'}), 400
 
-        products, _ = load_catalog()
-        product = next((p for p in products if str(p.get('id', '')) == str(product_id)), None)
+        # Floods are turned away before the catalog or the journal is touched;
+        # only written orders count, and retries of them pass through to their replay
+        phone = normalize_phone(customer.get('phone'))
+        keys = order_idempotency_keys(product_id, quantity, phone, customer,
+                                      request.headers.get('Idempotency-Key', '').strip()[:200] or None)
+        rate_keys = keys
+        retry_after = check_order_rate(phone, keys)
+        if retry_after:
+            response = jsonify({'error': 'طلبات كثيرة من نفس الرقم، حاول مرة أخرى لاحقاً'})
+            response.headers['Retry-After'] = str(retry_after)
+            return response, 429
+
+        product = find_product_by_id(product_id)
         if not product:
             return jsonify({'error': 'المنتج غير موجود'}), 400
 
         customer_city = customer.get('city')
+        if customer_city:
+            city = resolve_city(customer_city)
+            if city is None and get_city_area_dict():
+                return jsonify({'error': 'المدينة غير معروفة'}), 400
+            if city:
+                # Price on the canonical city; the customer's own city stays on the shipping label
+                customer_city = city
         subtotal, discount, shipping_applied, total = calculate_order(product, quantity, customer_city)
 
+        # A retried or double-tapped order gets the first one's response back; the content
+        # key doubles as the fingerprint, so a client key reused for other details conflicts
+        try:
+            outcome, replay = wait_idempotency_claim(keys, keys[-1][0])
+        except sqlite3.Error:
+            # Taking the order without the duplicate check beats losing it
+            logger.exception("Idempotency store unavailable")
+            outcome, keys = 'claimed', []
+        if outcome == 'replay':
+            status, body = replay
+            return Response(body, status=status, mimetype='application/json', headers={'Idempotent-Replayed': 'true'})
+        if outcome == 'conflict':
+            return jsonify({'error': 'مفتاح الطلب مستخدم لطلب مختلف'}), 422
+        if outcome == 'pending':
+            return jsonify({'error': 'الطلب قيد المعالجة، حاول مرة أخرى بعد قليل'}), 409
+
         order = {
             'id': str(uuid.uuid4()),
             'created_at': datetime.datetime.utcnow().isoformat(),
@@ -465,44 +3889,33 @@ def landing_order():
             'total': total,
             'status': 'new',
             'customer': customer,
+            'city_id': resolve_city(customer_city),  # canonical city, for pricing, stats and the index only
             'raw': data
         }
 
-        # Load existing orders
-        if os.path.exists('data/orders.json'):
-            try:
-                with open('data/orders.json', 'r', encoding='utf-8') as f:
-                    orders = json.load(f)
-                if not isinstance(orders, list):
-                    orders = []
-            except Exception as e:
-                print(f"Error loading orders: {e}")
-                orders = []
-        else:
-            orders = []
-
-        # Insert at top
-        orders.insert(0, order)
-
-        # Save orders
+        # Save order
         try:
-            with open('data/orders.json', 'w', encoding='utf-8') as f:
-                json.dump(orders, f, ensure_ascii=False, indent=2)
+            append_order(order)
         except Exception as e:
-            print(f"Error saving orders: {e}")
+            logger.exception("Error saving orders")
+            if keys:
+                release_idempotency_keys(keys)
             return jsonify({'error': 'فشل حفظ الطلب'}), 500
+        record_order_rate(phone, rate_keys)
 
-        # Add to Excel (non-blocking)
-        try:
-            add_order_to_excel(order)
-        except Exception as e:
-            print(f"Error adding to Excel: {e}")
-            # Don't fail the request if Excel fails
+        # Excel export and the order stats/index catch-up happen in the background from the journal
+        schedule_excel_export()
 
-        return jsonify({'ok': True, 'order_id': order['id']})
+        response = jsonify({'ok': True, 'order_id': order['id']})
+        if keys:
+            try:
+                complete_idempotency_keys(keys, response.status_code, response.get_data(as_text=True))
+            except sqlite3.Error:
+                logger.exception("Could not record idempotency keys for order %s", order['id'])
+        return response
 
     except Exception as e:
-        print(f"Error in landing_order: {e}")
+        logger.exception("Error in landing_order")
         return jsonify({'error': f'خطأ في المعالجة: {str(e)}'}), 500
 
 @app.route('/dashboard')
@@ -512,28 +3925,9 @@ def dashboard():
         return jsonify({'error': 'Admin access denied'}), 403
 
     products, _ = load_catalog()
-    if os.path.exists('data/orders.json'):
-        try:
-            with open('data/orders.json', 'r', encoding='utf-8') as f:
-                orders = json.load(f)
-        except:
-            orders = []
-    else:
-        orders = []
-
-    today = datetime.datetime.utcnow().date().isoformat()
-    today_orders = [o for o in orders if o.get('created_at', '').startswith(today)]
-    today_sales = sum(float(o.get('total', 0)) for o in today_orders)
-
-    stats = {
-        'total_orders': len(orders),
-        'today_orders': len(today_orders),
-        'today_sales': today_sales,
-        'total_products': len(products),
-        'free_shipping_products': len([p for p in products if p.get('free_shipping')])
-    }
-
-    return render_template('dashboard.html', stats=stats, products=products)
+    stats = dashboard_stats()
+    with span('render'):
+        return render_template('dashboard.html', stats=stats, products=products)
 
 @app.route('/admin')
 def admin():
@@ -542,49 +3936,200 @@ def admin():
         return jsonify({'error': 'Admin access denied'}), 403
 
     products, _ = load_catalog()
-    if os.path.exists('data/orders.json'):
+    stats = dashboard_stats()
+    with span('render'):
+        return render_template('admin.html', stats=stats, products=products, statuses=ORDER_STATUSES)
+
+@app.route('/api/stats')
+def api_stats():
+    if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    today = datetime.datetime.utcnow().date()
+    try:
+        date_to = datetime.date.fromisoformat(request.args.get('to') or today.isoformat())
+        date_from = datetime.date.fromisoformat(request.args.get('from') or (date_to - datetime.timedelta(days=29)).isoformat())
+    except ValueError:
+        return jsonify({'error': 'from/to must be YYYY-MM-DD dates'}), 400
+    if date_from > date_to:
+        return jsonify({'error': 'from must not be after to'}), 400
+
+    result = order_stats_range(date_from.isoformat(), date_to.isoformat())
+    result['ok'] = True
+    result['all_time'] = dashboard_stats()
+    return jsonify(result)
+
+@app.route('/api/orders')
+def api_orders():
+    if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    try:
+        limit = int(request.args.get('limit', 50))
+        cursor = int(request.args['cursor']) if request.args.get('cursor') else None
+        date_from, date_to = request.args.get('from'), request.args.get('to')
+        for value in (date_from, date_to):
+            if value:
+                datetime.date.fromisoformat(value)
+    except ValueError:
+        return jsonify({'error': 'limit/cursor must be integers and from/to YYYY-MM-DD dates'}), 400
+    if not 1 <= limit <= ORDERS_QUERY_MAX_LIMIT:
+        return jsonify({'error': f'limit must be between 1 and {ORDERS_QUERY_MAX_LIMIT}'}), 400
+
+    filters = {field: request.args.get(field) for field in ORDER_QUERY_FIELDS}
+    orders, next_cursor = query_orders(filters, date_from, date_to, limit, cursor)
+    return jsonify({'ok': True, 'count': len(orders), 'orders': orders, 'next_cursor': next_cursor})
+
+ORDERS_BATCH_MAX = 5000
+
+def _order_selection(data):
+    """ids/filters/from/to from a batch request body; raises ValueError when invalid"""
+    ids = data.get('ids')
+    if ids is not None and (not isinstance(ids, list) or len(ids) > ORDERS_BATCH_MAX):
+        raise ValueError(f'ids must be a list of at most {ORDERS_BATCH_MAX} order ids')
+    filters = data.get('filters') or {}
+    if not isinstance(filters, dict) or set(filters) - set(ORDER_QUERY_FIELDS):
+        raise ValueError(f'filters may only use {", ".join(ORDER_QUERY_FIELDS)}')
+    for value in (data.get('from'), data.get('to')):
+        if value:
+            datetime.date.fromisoformat(value)
+    return ids, filters, data.get('from'), data.get('to')
+
+@app.route('/api/orders/status', methods=['POST'])
+def api_orders_status():
+    if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.get_json(silent=True) or {}
+    ids = data.get('ids')
+    if not isinstance(ids, list) or not ids or len(ids) > ORDERS_BATCH_MAX:
+        return jsonify({'error': f'ids must be a list of 1 to {ORDERS_BATCH_MAX} order ids'}), 400
+    try:
+        updated, unknown = update_order_statuses(ids, data.get('status'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'ok': True, 'status': data.get('status'), 'updated': len(updated), 'unknown': unknown})
+
+@app.route('/api/export_orders', methods=['POST'])
+def api_export_orders():
+    if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    data = request.get_json(silent=True) or {}
+    try:
+        ids, filters, date_from, date_to = _order_selection(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    set_status = data.get('set_status')
+    if set_status and set_status not in ORDER_STATUSES:
+        return jsonify({'error': f'set_status must be one of {", ".join(ORDER_STATUSES)}'}), 400
+
+    # Rows go straight from the index into a write-only workbook
+    exported = []
+    def selected():
+        for order in iter_selected_orders(ids, filters, date_from, date_to):
+            exported.append(str(order['id']))
+            yield order
+
+    os.makedirs(EXCEL_EXPORT_DIR, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(suffix='.xlsx', dir=EXCEL_EXPORT_DIR)
+    os.close(fd)
+    try:
+        with span('excel_export'):
+            write_orders_workbook(temp_path, selected())
+        if set_status and exported:
+            update_order_statuses(exported, set_status)
+    except Exception as e:
+        os.remove(temp_path)
+        logger.exception("Export error")
+        return jsonify({'error': str(e)}), 500
+
+    def stream():
         try:
-            with open('data/orders.json', 'r', encoding='utf-8') as f:
-                orders = json.load(f)
-        except:
-            orders = []
-    else:
-        orders = []
+            with open(temp_path, 'rb') as f:
+                yield from iter(lambda: f.read(65536), b'')
+        finally:
+            os.remove(temp_path)
 
-    today = datetime.datetime.utcnow().date().isoformat()
-    today_orders = [o for o in orders if o.get('created_at', '').startswith(today)]
-    today_sales = sum(float(o.get('total', 0)) for o in today_orders)
+    filename = f"speedaf_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
+    return Response(stream(), mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', headers={
+        'Content-Disposition': f'attachment; filename={filename}',
+        'Content-Length': str(os.path.getsize(temp_path)),
+        'X-Order-Count': str(len(exported)),
+    })
 
-    stats = {
-        'total_orders': len(orders),
-        'today_orders': len(today_orders),
-        'today_sales': today_sales,
-        'total_products': len(products),
-        'free_shipping_products': len([p for p in products if p.get('free_shipping')])
-    }
+@app.route('/api/reports/<group>')
+def api_reports(group):
+    if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
 
-    return render_template('admin.html', stats=stats, products=products, orders=orders[:50])  # last 50
+    if group not in REPORT_GROUPS:
+        return jsonify({'error': f'report must be one of {", ".join(REPORT_GROUPS)}'}), 404
+    fmt = request.args.get('format', 'json')
+    if fmt not in ('json', 'csv', 'parquet'):
+        return jsonify({'error': 'format must be json, csv or parquet'}), 400
+    if fmt == 'parquet' and pyarrow is None:
+        return jsonify({'error': 'Parquet downloads need pyarrow installed'}), 400
+    date_from, date_to = request.args.get('from'), request.args.get('to')
+    try:
+        for value in (date_from, date_to):
+            if value:
+                datetime.date.fromisoformat(value)
+    except ValueError:
+        return jsonify({'error': 'from/to must be YYYY-MM-DD dates'}), 400
+
+    entry, key = order_report(group, date_from, date_to, request.args.get('status'))
+    if fmt == 'json':
+        return precompressed_response(entry['json'])
+    report = entry['frame']
+    etag = hashlib.sha1(repr((key, fmt)).encode()).hexdigest()
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache',
+               'Content-Disposition': f'attachment; filename=orders_{group}.{fmt}'}
+    if is_not_modified(etag):
+        return Response(status=304, headers=headers)
+    if fmt == 'csv':
+        return Response(report.to_csv(index=False), mimetype='text/csv', headers=headers)
+    buffer = io.BytesIO()
+    report.to_parquet(buffer, index=False)
+    return Response(buffer.getvalue(), mimetype='application/vnd.apache.parquet', headers=headers)
+
+@app.route('/api/rebuild_stats', methods=['POST'])
+def api_rebuild_stats():
+    if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
+
+    stats = rebuild_order_stats()
+    return jsonify({'ok': True, 'total_orders': stats['total_orders'], 'total_sales': stats['total_sales'], 'days': len(stats['days'])})
 
 @app.route('/api/update_catalog', methods=['POST'])
 def api_update_catalog():
     if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
         return jsonify({'error': 'Unauthorized'}), 401
 
-    new_products = update_catalogs()
-    if new_products:
-        # Merge with existing without duplicates based on id
-        old_products, _ = load_catalog()
-        seen_ids = {p.get('id'): i for i, p in enumerate(old_products)}
-        for np in new_products:
-            pid = np['id']
-            if pid in seen_ids:
-                # Update existing
-                old_products[seen_ids[pid]] = np
-            else:
-                old_products.append(np)
-        generate_landing_links(old_products, write_back=True)
-        return jsonify({'ok': True, 'total': len(old_products)})
-    return jsonify({'ok': False, 'message': 'No new products'})
+    data = request.get_json(silent=True) or {}
+    mode = request.args.get('mode') or data.get('mode') or 'full'
+    if mode not in ('full', 'incremental'):
+        return jsonify({'error': 'mode must be full or incremental'}), 400
+
+    job, started = start_catalog_job(mode)
+    if job is None:
+        return jsonify({'ok': False, 'message': 'A catalog sync is already running'}), 409
+    return jsonify({
+        'ok': True,
+        'job_id': job['job_id'],
+        'status': job['status'],
+        'deduplicated': not started,
+        'status_url': url_for('api_update_catalog_status', job_id=job['job_id'])
+    }), 202
+
+@app.route('/api/update_catalog/<job_id>')
+def api_update_catalog_status(job_id):
+    if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
+    job = read_catalog_job(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify({'ok': True, **job})
 
 @app.route('/api/update_product', methods=['POST'])
 def api_update_product():
@@ -596,16 +4141,35 @@ def api_update_product():
     if not pid:
         return jsonify({'error': 'Product ID required'}), 400
 
-    products, path = load_catalog()
-    for p in products:
-        if str(p.get('id')) == str(pid):
-            for k in ['title', 'price', 'shipping_price', 'free_shipping']:
-                if k in data:
-                    p[k] = data[k]
-            save_catalog_products(products)
-            return jsonify({'ok': True})
+    snapshot = get_catalog_snapshot()
+    products = list(snapshot.products)
+    i = snapshot.index['id'].get(str(pid))
+    if i is not None:
+        products[i] = dict(products[i], **{k: data[k] for k in ['title', 'price', 'shipping_price', 'free_shipping'] if k in data})
+        save_catalog_products(products, changed={i})
+        invalidate_landing_cache([pid])
+        return jsonify({'ok': True})
     return jsonify({'error': 'Product not found'})
 
+@app.route('/api/catalog_stats')
+def api_catalog_stats():
+    if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({'ok': True, 'stats': catalog_stats(), 'landing_cache': landing_cache_stats(),
+                    'search': search_stats()})
+
+@app.route('/api/export_status')
+def api_export_status():
+    if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({'ok': True, 'excel': excel_export_status()})
+
+@app.route('/api/compact_orders', methods=['POST'])
+def api_compact_orders():
+    if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
+    return jsonify({'ok': True, **compact_order_journal()})
+
 @app.route('/api/archive_orders', methods=['POST'])
 def api_archive_orders():
     if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
@@ -613,15 +4177,88 @@ def api_archive_orders():
 
     success, archive_path = archive_and_reset_orders()
     if success:
-        # Reset orders.json too? or just Excel sheet
-        with open('data/orders.json', 'w', encoding='utf-8') as f:
-            json.dump([], f)
         return jsonify({'ok': True, 'archive_path': archive_path})
     return jsonify({'error': 'Archive failed'})
 
+# Startup: warm_up() fills every per-process cache. Under gunicorn it runs
+# once in the master (preload_app), so forked workers start warm and share
+# the loaded data copy-on-write instead of each rebuilding it.
+WARM_STATE = {'ready': False, 'warmed_at': None, 'duration_ms': 0.0, 'steps': {}, 'errors': {}}
+
+def warm_up():
+    """Load city data, catalog, product indexes, search index, pricing rules and order views"""
+    started = time.perf_counter()
+    steps = [
+        ('city_areas', lambda: (load_city_area_dict(), city_index())),
+        ('catalog', lambda: get_catalog_snapshot()),
+        ('product_lists', lambda: (product_filter_positions(get_catalog_snapshot()), full_products_body(get_catalog_snapshot()))),
+        ('pricing', lambda: pricing_rules()),
+        ('search', lambda: search_products()),
+        ('order_stats', lambda: refresh_order_stats()),
+        ('order_index', lambda: refresh_order_index()),
+    ]
+    for name, step in steps:
+        step_started = time.perf_counter()
+        try:
+            step()
+            WARM_STATE['errors'].pop(name, None)
+        except Exception as e:
+            # A missing file or bad journal shouldn't keep the app from serving
+            WARM_STATE['errors'][name] = str(e)
+            logger.error("Warm-up step %s failed: %s", name, e)
+        WARM_STATE['steps'][name] = round((time.perf_counter() - step_started) * 1000, 3)
+    # Workers open their own SQLite connection; don't hand this one across fork()
+    with _order_index['lock']:
+        if _order_index['conn'] is not None:
+            _order_index['conn'].close()
+            _order_index['conn'] = None
+    WARM_STATE.update(ready=True, warmed_at=datetime.datetime.utcnow().isoformat(),
+                      duration_ms=round((time.perf_counter() - started) * 1000, 3))
+    logger.info("Warm-up finished in %sms with %d products", WARM_STATE['duration_ms'], len(get_catalog_snapshot().products))
+    # Record the warm-up spans (catalog_load, ...) under the master before workers fork
+    flush_metrics()
+
+def create_app(warm=True):
+    """Application factory for gunicorn ('app:create_app()'): the warmed-up app"""
+    if warm and not WARM_STATE['ready']:
+        warm_up()
+    return app
+
+@app.route('/ready')
+def ready():
+    snapshot = CATALOG_SNAPSHOT
+    caches = {
+        'catalog': snapshot.version > 0,
+        'city_areas': CITY_AREA_VERSION is not None,
+        'pricing': _pricing_rules['version'] == snapshot.version,
+        'order_stats': _order_stats['stats'] is not None,
+    }
+    body = dict(WARM_STATE, ok=WARM_STATE['ready'], pid=os.getpid(), products=len(snapshot.products), caches=caches)
+    return jsonify(body), 200 if WARM_STATE['ready'] else 503
+
+@app.route('/metrics')
+def metrics():
+    if request.headers.get('Authorization') != f"Bearer {ADMIN_TOKEN}":
+        return jsonify({'error': 'Unauthorized'}), 401
+    snapshot = CATALOG_SNAPSHOT
+    intake = order_intake_stats()
+    gauges = [
+        ('argento_ready', 'Whether warm-up has finished', int(WARM_STATE['ready'])),
+        ('argento_catalog_products', 'Products in the live catalog snapshot', len(snapshot.products)),
+        ('argento_catalog_version', 'Catalog snapshot version in this worker', snapshot.version),
+        ('argento_landing_cache_bytes', 'Encoded landing pages cached by this worker', landing_cache_stats()['bytes']),
+        ('argento_excel_export_pending_orders', 'Journaled orders not yet in the Excel export',
+         excel_export_status()['pending_orders']),
+        ('argento_order_replays', 'Duplicate orders answered with the first response by this worker',
+         intake['replays']),
+        ('argento_order_rate_limited', 'Orders turned away by the per-phone rate limit in this worker',
+         intake['rate_limited']),
+    ]
+    return Response(render_metrics(collect_metrics(), gauges), mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
-    load_city_area_dict()
-    products, _ = load_catalog()
-    if not products:
-        print("No products found, you may need to update catalog via /api/update_catalog")
+    create_app()
+    if not get_catalog_snapshot().products:
+        logger.warning("No products found, you may need to update catalog via /api/update_catalog")
+    start_catalog_scheduler()
     app.run(host='0.0.0.0', port=5000, debug=True)
@@ -0,0 +1,648 @@
+"""Load and micro benchmarks for the storefront and order paths.
+
+Builds a throwaway data directory per size (synthetic catalog across the
+BUSINESS_CATALOGS prefixes, an order journal and an addresses.xlsx), serves
+the catalog and a set of fixture product images from a local Graph API stub,
+and measures the app two ways:
+
+  client    the Flask test client in a fresh process, plus update_catalogs(),
+            sync_catalog() and a cold image cache (download and resize)
+            against the stub, then /img/<hash>/<width> from that cache
+  gunicorn  a local `gunicorn 'app:create_app()'` driven over HTTP
+
+Each endpoint gets p50/p99 latency, throughput and memory; the report is
+JSON on stdout (or --output). Example:
+
+    python bench.py --products 1000,10000,100000 --orders 50000 --requests 500 --concurrency 16
+"""
+import argparse
+import datetime
+import hashlib
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from openpyxl import Workbook
+from PIL import Image
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+BENCH_ADMIN_TOKEN = 'bench-admin'
+BENCH_BRANDS = ('Argento', 'Castel', 'Fofo', 'Sudi', 'Dove', 'Lipton', 'Knorr', 'Rexona', 'Clear', 'Signal')
+BENCH_STATUSES = ('new', 'new', 'new', 'confirmed', 'shipped', 'delivered', 'returned')
+BENCH_IMAGES = 32  # distinct fixture images, shared round-robin by the products
+BENCH_IMAGE_SIZE = (1200, 1200)
+
+
+def log(message):
+    print(f"[bench] {message}", file=sys.stderr, flush=True)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def rss_mb(pid='self'):
+    """Resident set size of a process in MB (Linux /proc), None elsewhere"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024.0, 1)
+    except OSError:
+        pass
+    return None
+
+
+def pss_mb(pid):
+    """Proportional set size in MB: shared pages are split between the processes mapping them"""
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    return round(int(line.split()[1]) / 1024.0, 1)
+    except OSError:
+        pass
+    return None
+
+
+def child_pids(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# --- synthetic data ---------------------------------------------------------
+
+def fixture_images(count, seed):
+    """count distinct JPEGs (gradients with some noise), about the size of a catalog photo"""
+    images = []
+    for i in range(count):
+        bands = []
+        for band in range(3):
+            gradient = Image.radial_gradient('L') if (i + band) % 2 else Image.linear_gradient('L')
+            noise = Image.effect_noise(BENCH_IMAGE_SIZE, 20 + (seed + i + band) % 20)
+            bands.append(Image.blend(gradient.resize(BENCH_IMAGE_SIZE), noise, 0.25))
+        out = io.BytesIO()
+        Image.merge('RGB', bands).save(out, 'JPEG', quality=85)
+        images.append(out.getvalue())
+    return images
+
+
+def image_hash(data):
+    """The content hash store_image() files an image under"""
+    return hashlib.sha256(data).hexdigest()[:32]
+
+
+def synthetic_products(count, catalogs, seed, image_base=''):
+    """count catalog products spread round-robin over the catalog prefixes
+
+    With image_base, each product points at one of the BENCH_IMAGES fixtures served there.
+    """
+    rng = random.Random(seed)
+    prefixes = list(catalogs)
+    products = []
+    for i in range(count):
+        prefix = prefixes[i % len(prefixes)]
+        pid = str(10 ** 15 + i)
+        brand = rng.choice(BENCH_BRANDS)
+        offers = []
+        if i % 7 == 0:
+            offers.append({'type': 'percentage', 'value': rng.choice([5, 10, 15]), 'min_quantity': 2})
+        products.append({
+            'id': pid,
+            'sku': f"{prefix}-{pid}",
+            'title': f"{brand} منتج {i} - {rng.choice(['500 مل', '1 لتر', 'عبوة 3', 'حجم عائلي'])}",
+            'description': f"وصف المنتج رقم {i} من {brand}. " * rng.randint(1, 4),
+            'price': float(rng.randint(30, 2500)),
+            'currency': 'EGP',
+            'brand': brand,
+            'image_url': f"{image_base}/images/{i % BENCH_IMAGES}.jpg?sig={seed}" if image_base else '',
+            'shipping_price': 50.0,
+            'free_shipping': i % 5 == 0,
+            'offers': offers,
+            'website': f"/landing/{pid}",
+        })
+    return products
+
+
+def graph_item(product):
+    """The Graph API item product_from_graph() turns back into product"""
+    return {
+        'id': product['id'],
+        'name': product['title'],
+        'description': product['description'],
+        'price': f"EGP{product['price']:,.2f}",
+        'currency': product['currency'],
+        'availability': 'in stock',
+        'brand': product['brand'],
+        'image_url': product['image_url'],
+    }
+
+
+def synthetic_cities(city_names, rows):
+    """{city: [areas]} with about rows areas in total"""
+    per_city = max(1, rows // max(1, len(city_names)))
+    return {city: [f"{city} Area {n}" for n in range(1, per_city + 1)] for city in city_names}
+
+
+def write_addresses(path, cities):
+    wb = Workbook(write_only=True)
+    sheet = wb.create_sheet('Speedaf standard address data')
+    sheet.append(['Province', 'City', 'Area'])
+    for city, areas in cities.items():
+        for area in areas:
+            sheet.append([city, city, area])
+    wb.save(path)
+
+
+def random_phone(rng):
+    return '01' + rng.choice('0125') + ''.join(rng.choice('0123456789') for _ in range(8))
+
+
+def write_orders(path, count, products, cities, seed):
+    """An orders.jsonl journal of count orders over the last 180 days"""
+    rng = random.Random(seed)
+    now = datetime.datetime.utcnow()
+    city_names = list(cities)
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(count):
+            product = products[rng.randrange(len(products))]
+            quantity = rng.randint(1, 3)
+            city = rng.choice(city_names)
+            subtotal = product['price'] * quantity
+            shipping = 0 if product['free_shipping'] else 65
+            created_at = now - datetime.timedelta(seconds=rng.randint(0, 180 * 86400))
+            customer = {'name': f"عميل {i}", 'phone': random_phone(rng), 'city': city,
+                        'area': rng.choice(cities[city]), 'address': f"شارع {rng.randint(1, 300)}"}
+            order = {
+                'id': f"{seed:08x}-{i:012d}",
+                'created_at': created_at.isoformat(),
+                'product': {k: product[k] for k in ('id', 'title', 'price')},
+                'quantity': quantity,
+                'subtotal': subtotal,
+                'discount': 0,
+                'shipping': shipping,
+                'total': subtotal + shipping,
+                'status': rng.choice(BENCH_STATUSES),
+                'customer': customer,
+                'raw': {'product_id': product['id'], 'quantity': quantity, 'customer': customer},
+            }
+            f.write(json.dumps(order, ensure_ascii=False) + '\n')
+
+
+def build_workdir(root, products, orders, address_rows, catalogs, city_names, seed, image_base=''):
+    """Create data/catalog_cache.json, data/orders.jsonl and addresses.xlsx under root"""
+    os.makedirs(os.path.join(root, 'data'), exist_ok=True)
+    catalog = synthetic_products(products, catalogs, seed, image_base)
+    cities = synthetic_cities(city_names, address_rows)
+    catalog_path = os.path.join(root, 'data', 'catalog_cache.json')
+    with open(catalog_path, 'w', encoding='utf-8') as f:
+        json.dump(catalog, f, ensure_ascii=False)
+    write_orders(os.path.join(root, 'data', 'orders.jsonl'), orders, catalog, cities, seed)
+    write_addresses(os.path.join(root, 'addresses.xlsx'), cities)
+    return catalog, cities, {
+        'catalog_bytes': os.path.getsize(catalog_path),
+        'orders_bytes': os.path.getsize(os.path.join(root, 'data', 'orders.jsonl')),
+        'addresses_bytes': os.path.getsize(os.path.join(root, 'addresses.xlsx')),
+    }
+
+
+# --- Graph API stub ---------------------------------------------------------
+
+class GraphStub:
+    """Serves /<catalog_id>/products with Graph-style paging.next links, and /images/<n>.jpg fixtures"""
+
+    def __init__(self, items_by_catalog, latency=0.0, images=()):
+        self.items = items_by_catalog
+        self.latency = latency
+        self.images = list(images)
+        self.pages = 0
+        self.image_requests = 0
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                parts = url.path.strip('/').split('/')
+                if len(parts) == 2 and parts[0] == 'images':
+                    return self._send_image(parts[1])
+                if len(parts) != 2 or parts[1] != 'products' or parts[0] not in stub.items:
+                    return self._send(404, {'error': {'message': 'Unknown path', 'code': 803}})
+                query = parse_qs(url.query)
+                limit = int(query.get('limit', ['500'])[0])
+                after = int(query.get('after', ['0'])[0])
+                items = stub.items[parts[0]]
+                page = {'data': items[after:after + limit]}
+                if after + limit < len(items):
+                    page['paging'] = {'next': f"{stub.url}/{parts[0]}/products?limit={limit}&after={after + limit}"}
+                if stub.latency:
+                    time.sleep(stub.latency)
+                stub.pages += 1
+                self._send(200, page)
+
+            def _send_image(self, name):
+                index = name[:-len('.jpg')] if name.endswith('.jpg') else ''
+                if not index.isdigit() or int(index) >= len(stub.images):
+                    return self._send(404, {'error': {'message': 'Unknown image', 'code': 803}})
+                body = stub.images[int(index)]
+                stub.image_requests += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _send(self, status, payload):
+                body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, name='graph-stub', daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# --- load generator ---------------------------------------------------------
+
+def run_load(call, requests_count, concurrency, warmup=5):
+    """Run call(i) -> status code requests_count times over concurrency threads"""
+    for i in range(min(warmup, requests_count)):
+        call(i)
+    latencies = [0.0] * requests_count
+    errors = Counter()
+    lock = threading.Lock()
+    counter = iter(range(requests_count))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            started = time.perf_counter()
+            try:
+                status = call(i)
+            except Exception as e:
+                status = type(e).__name__
+            latencies[i] = time.perf_counter() - started
+            if not isinstance(status, int) or status >= 400:
+                with lock:
+                    errors[str(status)] += 1
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    ordered = sorted(latencies)
+    return {
+        'requests': requests_count,
+        'concurrency': concurrency,
+        'errors': sum(errors.values()),
+        'error_statuses': dict(errors),
+        'seconds': round(elapsed, 3),
+        'rps': round(requests_count / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(ordered, 50) * 1000, 3),
+        'p99_ms': round(percentile(ordered, 99) * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def endpoint_calls(send, products, cities, seed, image_hashes=()):
+    """{name: call(i)} for each benchmarked endpoint; send(method, path, json=None) -> status"""
+    rng = random.Random(seed)
+    image_hashes = list(image_hashes)
+    ids = [p['id'] for p in products]
+    city_names = list(cities)
+    prefixes = sorted({p['sku'].split('-', 1)[0] for p in products})
+
+    def landing(i):
+        return send('GET', f"/landing/{rng.choice(ids)}")
+
+    def api_products(i):
+        return send('GET', '/api/products')
+
+    def api_products_page(i):
+        return send('GET', f"/api/products?limit=50&catalog={rng.choice(prefixes)}&offset={rng.randrange(0, 500)}")
+
+    def landing_order(i):
+        city = rng.choice(city_names)
+        return send('POST', '/api/landing_order', {
+            'product_id': rng.choice(ids),
+            'quantity': rng.randint(1, 3),
+            'customer': {'name': f"عميل {i}", 'phone': random_phone(rng), 'city': city,
+                         'area': rng.choice(cities[city]), 'address': 'شارع التحرير'},
+        })
+
+    def admin(i):
+        return send('GET', f"/admin?token={BENCH_ADMIN_TOKEN}")
+
+    def image(i):
+        # Only served once a sync has cached the fixtures
+        return send('GET', f"/img/{rng.choice(image_hashes)}/{rng.choice((160, 320, 640))}")
+
+    return {
+        'landing': landing,
+        'api_products': api_products,
+        'api_products_page': api_products_page,
+        'landing_order': landing_order,
+        'admin': admin,
+        'image': image,
+    }
+
+
+def bench_endpoints(calls, names, requests_count, concurrency, memory):
+    results = {}
+    for name in names:
+        before = memory()
+        result = run_load(calls[name], requests_count, concurrency)
+        after = memory()
+        result.update(rss_before_mb=before, rss_after_mb=after)
+        results[name] = result
+        log(f"  {name}: p50 {result['p50_ms']}ms p99 {result['p99_ms']}ms {result['rps']} req/s"
+            f"{' errors=%d' % result['errors'] if result['errors'] else ''}")
+    return results
+
+
+# --- modes ------------------------------------------------------------------
+
+def client_run(workdir):
+    """Runs in a fresh process with cwd=workdir: test client plus catalog sync timings"""
+    with open('bench_config.json', encoding='utf-8') as f:
+        config = json.load(f)
+    rss_start = rss_mb()
+    started = time.perf_counter()
+    import app as store
+    import_ms = (time.perf_counter() - started) * 1000
+    started = time.perf_counter()
+    flask_app = store.create_app()
+    result = {
+        'rss_start_mb': rss_start,
+        'import_ms': round(import_ms, 3),
+        'warm_up_ms': round((time.perf_counter() - started) * 1000, 3),
+        'warm_steps_ms': dict(store.WARM_STATE['steps']),
+        'rss_warm_mb': rss_mb(),
+    }
+    with open(os.path.join('data', 'catalog_cache.json'), encoding='utf-8') as f:
+        products = json.load(f)
+    with open('bench_cities.json', encoding='utf-8') as f:
+        cities = json.load(f)
+
+    local = threading.local()
+
+    def send(method, path, body=None):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = flask_app.test_client()
+        response = client.open(path, method=method, json=body)
+        response.get_data()
+        return response.status_code
+
+    calls = endpoint_calls(send, products, cities, config['seed'], config['image_hashes'])
+    result['endpoints'] = bench_endpoints(calls, config['endpoints'], config['requests'], config['concurrency'], rss_mb)
+
+    def cold_image_cache():
+        # Every fixture downloaded and resized again, as for a new catalog
+        shutil.rmtree(store.IMAGE_DIR, ignore_errors=True)
+        store.cache_product_images(products, refresh_ids={str(p['id']) for p in products})
+        return len(store._load_image_sources())
+
+    for name, fn in (('update_catalogs', lambda: len(store.update_catalogs())),
+                     ('sync_catalog', lambda: store.sync_catalog('full')['total']),
+                     ('cache_images', cold_image_cache)):
+        timings = []
+        count = None
+        before = rss_mb()
+        for _ in range(config['catalog_runs']):
+            started = time.perf_counter()
+            count = fn()
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        result[name] = {'runs': len(timings), 'products': count,
+                        'p50_ms': round(percentile(timings, 50) * 1000, 3),
+                        'max_ms': round(timings[-1] * 1000, 3),
+                        'rss_before_mb': before, 'rss_after_mb': rss_mb()}
+        log(f"  {name}: p50 {result[name]['p50_ms']}ms for {count} {'images' if name == 'cache_images' else 'products'}")
+    # The fixtures are cached now, so the image route serves resized variants
+    result['endpoints'].update(bench_endpoints(calls, ['image'], config['requests'], config['concurrency'], rss_mb))
+    store.flush_order_journal()
+    result['rss_end_mb'] = rss_mb()
+    with open('bench_client_result.json', 'w', encoding='utf-8') as f:
+        json.dump(result, f)
+
+
+def run_client(workdir, env):
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--client-run', workdir],
+                          cwd=workdir, env=env, stdout=subprocess.DEVNULL)
+    if proc.returncode != 0:
+        return {'error': f"client run exited with {proc.returncode}"}
+    with open(os.path.join(workdir, 'bench_client_result.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+
+def gunicorn_rss(pid):
+    """RSS per process, and the PSS total (what the server really uses: pages shared by fork counted once)"""
+    pids = [pid] + child_pids(pid)
+    rss = [rss_mb(p) for p in pids]
+    pss = [pss_mb(p) for p in pids]
+    return {'master_mb': rss[0], 'workers_mb': [r for r in rss[1:] if r is not None],
+            'total_mb': round(sum(r for r in rss if r is not None), 1) if rss[0] is not None else None,
+            'pss_total_mb': round(sum(p for p in pss if p is not None), 1) if pss[0] is not None else None}
+
+
+def run_gunicorn(workdir, env, products, cities, args):
+    port = free_port()
+    env = dict(env, PORT=str(port), WEB_CONCURRENCY=str(args.workers))
+    log_path = os.path.join(workdir, 'gunicorn.log')
+    started = time.perf_counter()
+    with open(log_path, 'wb') as log_file:
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'gunicorn', '--config', os.path.join(REPO_DIR, 'gunicorn.conf.py'),
+             '--chdir', workdir, '--pythonpath', REPO_DIR, '--bind', f"127.0.0.1:{port}", 'app:create_app()'],
+            cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+        try:
+            base = f"http://127.0.0.1:{port}"
+            ready = None
+            deadline = time.monotonic() + args.startup_timeout
+            while time.monotonic() < deadline and proc.poll() is None:
+                try:
+                    response = requests.get(f"{base}/ready", timeout=2)
+                    if response.status_code == 200:
+                        ready = response.json()
+                        break
+                except requests.RequestException:
+                    pass
+                time.sleep(0.1)
+            if ready is None:
+                return {'error': f"gunicorn did not become ready, see {log_path}"}
+            result = {'workers': args.workers, 'ready_ms': round((time.perf_counter() - started) * 1000, 3),
+                      'warm_up_ms': ready.get('duration_ms'), 'warm_steps_ms': ready.get('steps'),
+                      'rss_ready': gunicorn_rss(proc.pid)}
+            local = threading.local()
+
+            def send(method, path, body=None):
+                session = getattr(local, 'session', None)
+                if session is None:
+                    session = local.session = requests.Session()
+                response = session.request(method, base + path, json=body, timeout=60)
+                return response.status_code
+
+            calls = endpoint_calls(send, products, cities, args.seed)
+            result['endpoints'] = bench_endpoints(calls, args.endpoints, args.requests, args.concurrency,
+                                                  lambda: gunicorn_rss(proc.pid)['total_mb'])
+            result['rss_end'] = gunicorn_rss(proc.pid)
+
+            # One admin edit rewrites the catalog; every worker then reloads it on its own
+            started = time.perf_counter()
+            status = requests.post(f"{base}/api/update_product", timeout=300,
+                                   headers={'Authorization': f"Bearer {BENCH_ADMIN_TOKEN}"},
+                                   json={'id': products[0]['id'], 'price': products[0]['price'] + 1}).status_code
+            result['catalog_update'] = {'status': status, 'ms': round((time.perf_counter() - started) * 1000, 3)}
+            result['catalog_update']['landing_after'] = run_load(calls['landing'], args.requests, args.concurrency)
+            result['rss_after_update'] = gunicorn_rss(proc.pid)
+            log(f"  catalog update: {result['catalog_update']['ms']}ms, "
+                f"PSS {result['rss_end']['pss_total_mb']} -> {result['rss_after_update']['pss_total_mb']}MB")
+            return result
+        finally:
+            proc.terminate()
+            try:
+                proc.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--products', default='1000,10000', help='comma separated catalog sizes')
+    parser.add_argument('--orders', type=int, default=20000, help='orders in the synthetic journal')
+    parser.add_argument('--address-rows', type=int, default=5000, help='city/area rows in addresses.xlsx')
+    parser.add_argument('--requests', type=int, default=300, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--endpoints', default='landing,api_products,api_products_page,landing_order,admin')
+    parser.add_argument('--modes', default='client,gunicorn')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--catalog-runs', type=int, default=3, help='update_catalogs/sync_catalog/cache_images runs')
+    parser.add_argument('--graph-page-limit', type=int, default=500)
+    parser.add_argument('--graph-latency', type=float, default=0.0, help='seconds the Graph stub waits per page')
+    parser.add_argument('--startup-timeout', type=float, default=300)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help='keep the generated data directories')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--client-run', metavar='WORKDIR', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.client_run:
+        return client_run(args.client_run)
+
+    args.endpoints = [e for e in args.endpoints.split(',') if e]
+    modes = [m for m in args.modes.split(',') if m]
+    sys.path.insert(0, REPO_DIR)
+    from app import BUSINESS_CATALOGS, SHIPPING_PRICES
+
+    report = {
+        'started_at': datetime.datetime.utcnow().isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': {k: v for k, v in vars(args).items() if k not in ('client_run', 'output')},
+        'runs': [],
+    }
+    images = fixture_images(BENCH_IMAGES, args.seed)
+    for size in [int(s) for s in args.products.split(',') if s]:
+        workdir = tempfile.mkdtemp(prefix=f'argento-bench-{size}-')
+        log(f"{size} products, {args.orders} orders in {workdir}")
+        try:
+            # The stub's URL goes into the catalog, so it is bound before the data is built
+            stub = GraphStub({}, args.graph_latency, images)
+            products, cities, sizes = build_workdir(workdir, size, args.orders, args.address_rows,
+                                                    BUSINESS_CATALOGS, list(SHIPPING_PRICES), args.seed, stub.url)
+            with open(os.path.join(workdir, 'bench_cities.json'), 'w', encoding='utf-8') as f:
+                json.dump(cities, f, ensure_ascii=False)
+            with open(os.path.join(workdir, 'bench_config.json'), 'w', encoding='utf-8') as f:
+                json.dump({'seed': args.seed, 'endpoints': args.endpoints, 'requests': args.requests,
+                           'concurrency': args.concurrency, 'catalog_runs': args.catalog_runs,
+                           'image_hashes': [image_hash(data) for data in images]}, f)
+            for p in products:
+                stub.items.setdefault(BUSINESS_CATALOGS[p['sku'].split('-', 1)[0]], []).append(graph_item(p))
+            run = dict(sizes, products=size, orders=args.orders, address_rows=args.address_rows)
+            with stub:
+                env = dict(os.environ, GRAPH_API_URL=stub.url, GRAPH_PAGE_LIMIT=str(args.graph_page_limit),
+                           FBACCSESSTOKEN='bench', ADMIN_TOKEN=BENCH_ADMIN_TOKEN, CATALOG_SYNC_INTERVAL='0',
+                           PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+                if 'client' in modes:
+                    log('client mode')
+                    run['client'] = run_client(workdir, env)
+                if 'gunicorn' in modes:
+                    log('gunicorn mode')
+                    run['gunicorn'] = run_gunicorn(workdir, env, products, cities, args)
+                run['graph_pages'] = stub.pages
+                run['image_requests'] = stub.image_requests
+            report['runs'].append(run)
+        finally:
+            if not args.keep:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    report['finished_at'] = datetime.datetime.utcnow().isoformat()
+    body = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(body + '\n')
+        log(f"report written to {args.output}")
+    else:
+        print(body)
+
+
+if __name__ == '__main__':
+    main()
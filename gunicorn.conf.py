@@ -0,0 +1,41 @@
+# Gunicorn settings, picked up automatically by `gunicorn 'app:create_app()'` (see Procfile)
+import gc
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+
+# Import and warm the app once in the master; workers fork with the catalog,
+# indexes and city data already loaded
+preload_app = True
+
+# Threaded workers: requests mostly wait on disk and the network, and the
+# shared caches are per process, so a few processes with several threads each
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_CONCURRENCY', str(max(2, multiprocessing.cpu_count()))))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+
+# Reuse connections from the proxy instead of reconnecting per request
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', '5'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+graceful_timeout = 30
+
+# Recycle workers now and then so slow leaks can't pile up; the jitter keeps
+# them from all restarting at once. New workers fork from the warm master.
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '2000'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '200'))
+
+# Worker heartbeat files on tmpfs rather than a possibly slow disk
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+
+def when_ready(server):
+    """Move the warmed-up objects out of the GC's reach so collections in workers don't dirty shared pages"""
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    """Start the optional catalog schedule in each worker (only one sync runs at a time)"""
+    from app import start_catalog_scheduler
+    start_catalog_scheduler()